@@ -2,8 +2,10 @@ import subprocess
 import json
 import re
 import os
+import threading
 from datetime import datetime, timezone
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from utils import metrics # Enabled with the METRICS_FILE environment variable, see utils/metrics.py
 
 now = datetime.now()
 
@@ -22,10 +24,17 @@ label = config.get('label')
 repo_add = config.get('repo_add')
 helm_install = config.get('helm_install')
 use_oci = config.get('use_oci')
+slot_count = config.get('slots', 1)
+slot_mode = config.get('slot_mode', 'profile')
+capture_mode = config.get('capture_mode', 'copy')
 
 # Check if JSON fields are correctly parsed
 if not name or not isinstance(reruns, int) or not timeout or (not url or (not repo_add and not helm_install)):
     raise ValueError("Error: Missing or invalid fields in the JSON configuration file.")
+if not isinstance(slot_count, int) or slot_count < 1 or slot_mode not in ('profile', 'namespace'):
+    raise ValueError("Error: slots must be a positive integer and slot_mode either profile or namespace.")
+if capture_mode not in ('copy', 'stream'):
+    raise ValueError("Error: capture_mode must be either copy or stream.")
 
 print(f"Configuration loaded:")
 print(f"Name: {name}")
@@ -33,6 +42,9 @@ print(f"Default reruns: {reruns}")
 print(f"Timeout: {timeout}")
 print(f"Label: {label}")
 print(f"Jobs: {jobs}")
+if slot_count > 1:
+    print(f"Slots: {slot_count} ({slot_mode}s)")
+print(f"Capture mode: {capture_mode}")
 if use_oci:
     print(f"Using OCI registry.")
     print(f"URL: {url}")
@@ -42,8 +54,64 @@ else:
     print(f"Helm install: {helm_install}")
 print("--------------------------------\n")
     
+# SLOTS
+
+# A slot is an isolated target that runs one helm release at a time. With more than one slot the captures run in
+# parallel, every slot on its own queue of (version, run) pairs with its own tcpdump, copy and filter steps:
+#   profile   - every slot is its own minikube profile (cluster). The releases look exactly the same as with one slot.
+#   namespace - all the slots share one minikube cluster, every slot installs its own release (<label>-<slot>) in its
+#               own namespace (<name>-<slot>) and captures to its own file on the node. The node sees the traffic of
+#               all the slots, the filter step keeps the traffic of the slot's own pods. The release and namespace
+#               names differ between the slots and can show up in the captured traffic.
+# A single slot runs the same commands as before slots were added.
+class Slot:
+    def __init__(self, index, profile=None, namespace=None, release=None):
+        self.index = index
+        self.profile = profile
+        self.namespace = namespace
+        self.release = release or label
+        self.node = profile or 'minikube'
+        self.remote_pcap = '/tmp/minikube_traffic.pcap' if slot_count == 1 else f'/tmp/minikube_traffic_{index}.pcap'
+        self.name = profile or namespace or 'minikube'
+        self.labels = {'slot': self.name} if slot_count > 1 else {} # Metric labels
+        self.prefix = f"[{self.name}] " if slot_count > 1 else ''
+
+    def minikube(self):
+        return f"minikube -p {self.profile}" if self.profile else "minikube"
+
+    def kubectl_args(self):
+        args = ["kubectl"]
+        if self.profile:
+            args += ["--context", self.profile] # minikube names the kubectl context after the profile
+        if self.namespace:
+            args += ["--namespace", self.namespace]
+        return args
+
+    def kubectl(self):
+        return ' '.join(self.kubectl_args())
+
+    def helm_options(self, install=False):
+        options = ''
+        if self.profile:
+            options += f" --kube-context {self.profile}"
+        if self.namespace:
+            options += f" --namespace {self.namespace}" + (" --create-namespace" if install else '')
+        return options
+
+def create_slots():
+    if slot_count == 1:
+        return [Slot(0)]
+    if slot_mode == 'profile':
+        return [Slot(k, profile=f"{name}-{k}") for k in range(slot_count)]
+    return [Slot(k, namespace=f"{name}-{k}", release=f"{label}-{k}") for k in range(slot_count)]
+
 # HELPERS
 
+NO_PODS_TIMEOUT = 120 # Seconds to wait for the first pod of the release to show up after helm install
+
+# The pod metadata file and output.csv are shared by all the slots
+output_lock = threading.Lock()
+
 def update_json_file(file_path, new_data):
     if not os.path.exists(file_path):
         # If the file doesn't exist, create it with an empty list
@@ -61,87 +129,123 @@ def update_json_file(file_path, new_data):
     with open(file_path, 'w') as f:
         json.dump(data, f, indent=4)
 
-def run_command(command, shell=True, background=False, accept_timeout=False):
-    """Executes a shell command and prints the output. Can run in the background."""
+def run_command(command, shell=True, background=False, accept_timeout=False, output_file=None):
+    """Executes a shell command and prints the output. Can run in the background. The standard output can be written to output_file instead."""
     print(f"Running command: {command}")
     if background:
         process = subprocess.Popen(command, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
         return process
+    elif output_file:
+        with open(output_file, 'wb') as f:
+            result = subprocess.run(command, shell=shell, stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.PIPE, text=True)
     else:
         result = subprocess.run(command, shell=shell, capture_output=True, text=True)
-        timeout_occurred = bool(re.search(r'status 124|exit.*124', result.stderr))
-        if result.returncode != 0 and (not timeout_occurred or not accept_timeout):
-            print(f"Command failed with error: {result.stderr}")
-            raise Exception(f"Command failed with error: {result.stderr}")
 
-        return result
+    timeout_occurred = bool(re.search(r'status 124|exit.*124', result.stderr))
+    if result.returncode != 0 and (not timeout_occurred or not accept_timeout):
+        print(f"Command failed with error: {result.stderr}")
+        raise Exception(f"Command failed with error: {result.stderr}")
+
+    return result
 
-def get_pod_names():
-    command = f"kubectl get pods -l 'app.kubernetes.io/instance={label}' -o json"
+def get_pod_names(slot):
+    command = f"{slot.kubectl()} get pods -l 'app.kubernetes.io/instance={slot.release}' -o json"
     result = run_command(command)
     pods_json = json.loads(result.stdout)
 
     if pods_json.get('items') is None or not pods_json['items']:
         # If no pods are found with the instance label, try to find pods with the release label
-        print("No pods found with the instance label. Trying to find pods with the release label.")
-        alternate_command = f"kubectl get pods -l 'release={label}' -o json"
+        print(f"{slot.prefix}No pods found with the instance label. Trying to find pods with the release label.")
+        alternate_command = f"{slot.kubectl()} get pods -l 'release={slot.release}' -o json"
         result = run_command(alternate_command)
         pods_json = json.loads(result.stdout)
 
     return [pod['metadata']['name'] for pod in pods_json['items']]
 
-def wait_for_pod(pod_name):
-    command = f"kubectl wait --for=condition=ready pod/{pod_name} --timeout=900s"
+# True if the pod belongs to the release of the slot, by the instance label or else the release label (see get_pod_names)
+def is_release_pod(slot, pod):
+    labels = pod['metadata'].get('labels') or {}
+    return labels.get('app.kubernetes.io/instance') == slot.release or labels.get('release') == slot.release
+
+def is_ready(pod):
+    conditions = pod.get('status', {}).get('conditions') or []
+    return not pod['metadata'].get('deletionTimestamp') and any(c['type'] == 'Ready' and c['status'] == 'True' for c in conditions)
+
+# Pod objects from the output of kubectl get pods --watch -o json. kubectl writes every pod as a separate indented
+# JSON object, an object is complete at the closing brace of the top level.
+def iter_watched_pods(stream):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for line in stream:
+        buffer += line
+        if line.startswith('}'):
+            pod, _ = decoder.raw_decode(buffer.strip())
+            buffer = ''
+            yield pod
+
+def wait_for_first_ready_pod(slot, timeout=900, no_pods_timeout=NO_PODS_TIMEOUT):
+    # A single watch over the pods of the namespace replaces a kubectl wait per pod. It first lists the current pods and
+    # then prints every change, so the first pod is seen as soon as it turns ready.
+    process = run_command(f"{slot.kubectl()} get pods --watch -o json", background=True)
+    seen = set()
+
+    def stop_if_no_pods():
+        if not seen:
+            process.kill()
+
+    timers = [threading.Timer(timeout, process.kill), threading.Timer(no_pods_timeout, stop_if_no_pods)]
+    for timer in timers:
+        timer.start()
     try:
-        run_command(command)
-        return pod_name, True
-    except Exception as e:
-        return pod_name, False
-
-def wait_for_first_ready_pod():
-    # Fetch pod names dynamically
-    pod_names = get_pod_names()
-    print(f"Found pods: {pod_names}")
-
-    if not pod_names:
+        for pod in iter_watched_pods(process.stdout):
+            if not is_release_pod(slot, pod):
+                continue
+            pod_name = pod['metadata']['name']
+            if pod_name not in seen:
+                seen.add(pod_name)
+                print(f"{slot.prefix}Found pod: {pod_name}")
+            if is_ready(pod):
+                return pod_name
+    finally:
+        for timer in timers:
+            timer.cancel()
+        process.kill()
+        process.wait()
+
+    if not seen:
         print("No pods found matching the label.")
         raise Exception("No pods found matching the label.")
-
-    with ThreadPoolExecutor(max_workers=len(pod_names)) as executor:
-        futures = {executor.submit(wait_for_pod, pod_name): pod_name for pod_name in pod_names}
-        try:
-            for future in as_completed(futures):
-                result = future.result()
-                if result and result[1]:
-                    return result
-        finally:
-            for future in futures:
-                future.cancel()
-
     print("No pods became ready within the timeout period.")
     raise Exception("No pods became ready within the timeout period.")    
 
-def get_pods_ips():
-    """Fetches the IPs of the pods."""
-    command = "kubectl get pods -o wide | awk 'NR>1 {for(i=1;i<=NF;i++) if($i ~ /^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$/) print $i}'" # Fetch only the IPs by pattern matching
-    result = run_command(command)
-    if result.returncode == 0:
-        ips = [ip.strip() for ip in result.stdout.splitlines()]
-        return ips
-    return []
-
-def get_pods_info(version, run, calibration_run=False):
-    # Get pod information in JSON format
-    kubectl_cmd = ["kubectl", "get", "pods", "-o", "json"]
-    result = subprocess.run(kubectl_cmd, capture_output=True, text=True)
-    pods_json = json.loads(result.stdout)
+# One kubectl get pods of the namespace, the pod IPs and the pod metadata of a run are both read from it
+def get_pods_snapshot(slot):
+    result = run_command(f"{slot.kubectl()} get pods -o json")
+    return json.loads(result.stdout)
+
+# Pods of the namespace that do not have an IP yet, the pods that are being deleted are left out
+def pods_without_ip(pods_json):
+    return [pod['metadata']['name'] for pod in pods_json['items'] if not pod['metadata'].get('deletionTimestamp') and not pod.get('status', {}).get('podIP')]
 
+def host_filter(ips):
+    return ' or '.join([f'host {ip}' for ip in ips])
+
+def get_pods_ips(pods_json):
+    """Fetches the IPv4 addresses of the pods."""
+    ips = []
+    for pod in pods_json['items']:
+        status = pod.get('status', {})
+        pod_ips = [address['ip'] for address in status.get('podIPs') or []] or [status.get('podIP')]
+        ips.extend(ip for ip in pod_ips if ip and re.fullmatch(r'[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+', ip))
+    return ips
+
+def get_pods_info(slot, pods_json, version, run, calibration_run=False):
     pod_info = []
     for pod in pods_json['items']:
         pod_name = pod['metadata']['name']
         
         # Find the last ready condition
-        ready_condition = next((c for c in reversed(pod['status']['conditions']) if c['type'] == 'Ready' and c['status'] == 'True'), None)
+        ready_condition = next((c for c in reversed(pod.get('status', {}).get('conditions') or []) if c['type'] == 'Ready' and c['status'] == 'True'), None)
         
         if ready_condition:
             ready_time = datetime.strptime(ready_condition['lastTransitionTime'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
@@ -160,35 +264,42 @@ def get_pods_info(version, run, calibration_run=False):
         "pods": pod_info,
         "calibration_run": calibration_run
     }
+    if slot_count > 1:
+        output_data["slot"] = slot.name
 
     return output_data
 
-def calibrate(label, url, version, helm_install, use_oci):
+def calibrate(slot, url, version, helm_install, use_oci):
     """Calibrates the environment by installing the specified version of the service. This is useful when installing the version for the first time as it may take significantly longer to start the pods."""
-    print(f"Calibrating the environment for version {version}.")
-    run_helm_install(label=label, url=url, use_oci=use_oci, version=version, helm_install=helm_install)
-    wait_for_first_ready_pod()
-    cleanup(label=label)
-    print(f"Calibration completed for version {version}.")
-    pod_info = get_pods_info(version=version, run=0, calibration_run=True)
+    print(f"{slot.prefix}Calibrating the environment for version {version}.")
+    run_helm_install(slot=slot, url=url, use_oci=use_oci, version=version, helm_install=helm_install)
+    wait_for_first_ready_pod(slot)
+    cleanup(slot)
+    print(f"{slot.prefix}Calibration completed for version {version}.")
+    pod_info = get_pods_info(slot, get_pods_snapshot(slot), version=version, run=0, calibration_run=True)
     return pod_info
 
-def run_helm_install(label, url, version, use_oci, helm_install):
-    helm_command = f"helm install {label} {url} --version {version} --timeout 2m" if use_oci else f"{helm_install} --version {version} --timeout 2m"
+def run_helm_install(slot, url, version, use_oci, helm_install):
+    install_command = helm_install
+    if not use_oci and slot.release != label:
+        # The label in the install command is replaced with the release of the slot
+        install_command = ' '.join(slot.release if word == label else word for word in helm_install.split())
+    helm_command = f"helm install {slot.release} {url} --version {version} --timeout 2m" if use_oci else f"{install_command} --version {version} --timeout 2m"
+    helm_command += slot.helm_options(install=True)
     try:
         run_command(helm_command)
     except Exception as e:
         # Sometimes the helm install command fails due to a timeout but the pods are still created. In that case, we can try to proceed.
-        print(f"Error: {e}")
-        pods = get_pod_names()
+        print(f"{slot.prefix}Error: {e}")
+        pods = get_pod_names(slot)
         if not pods:
             raise Exception("No pods found after the helm install command failed.")
-        print(f"Pods found after the helm install command failed: {pods}")
+        print(f"{slot.prefix}Pods found after the helm install command failed: {pods}")
 
-def cleanup(label):
-    run_command(f"helm uninstall {label} --ignore-not-found")
-    run_command("kubectl delete pvc --all") # Helm might not delete all PVCs, need to delete them manually
-    run_command("minikube ssh '[ -f /tmp/minikube_traffic.pcap ] && sudo rm -f /tmp/minikube_traffic.pcap || true'") # Delete the pcap file, if exists
+def cleanup(slot):
+    run_command(f"helm uninstall {slot.release} --ignore-not-found{slot.helm_options()}")
+    run_command(f"{slot.kubectl()} delete pvc --all") # Helm might not delete all PVCs, need to delete them manually
+    run_command(f"{slot.minikube()} ssh '[ -f {slot.remote_pcap} ] && sudo rm -f {slot.remote_pcap} || true'") # Delete the pcap file, if exists
 
 timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
 output_dir = f'data/{name}-{timestamp}'
@@ -203,19 +314,34 @@ if not use_oci:
     run_command(helm_update)
     chart_keyword = helm_install.split()[-1] # The last word in the helm install command is the chart keyword that can be used to search for the chart (If not installing with OCI)
 
-for job in jobs:
-    version = job['version']
-    check_version_command = f"helm show chart {chart_keyword} --version {version}"
-    result = run_command(check_version_command)
+with metrics.stage('check_versions'):
+    for job in jobs:
+        version = job['version']
+        check_version_command = f"helm show chart {chart_keyword} --version {version}"
+        result = run_command(check_version_command)
 print("All versions are available.")
 
-# Step 2: Start minikube
-run_command("minikube start")
-print("Minikube started.")
+slots = create_slots()
+# Profiles are separate clusters, the namespaces share the cluster of the default profile
+clusters = slots if slot_mode == 'profile' else slots[:1]
+
+def start_cluster(slot):
+    # Step 2: Start minikube
+    with metrics.stage('minikube_start', **slot.labels):
+        run_command(f"{slot.minikube()} start")
+    print(f"{slot.prefix}Minikube started.")
+
+    # Step 3: Start tcpdump on minikube
+    tcpdump_install_command = f"{slot.minikube()} ssh 'sudo apt update && sudo apt install -y tcpdump'"
+    with metrics.stage('tcpdump_install', **slot.labels):
+        run_command(tcpdump_install_command)
+
+def run_in_slots(function, slot_list):
+    with ThreadPoolExecutor(max_workers=len(slot_list)) as executor:
+        for future in [executor.submit(function, slot) for slot in slot_list]:
+            future.result()
 
-# Step 3: Start tcpdump on minikube
-tcpdump_install_command = f"minikube ssh 'sudo apt update && sudo apt install -y tcpdump'"
-run_command(tcpdump_install_command)
+run_in_slots(start_cluster, clusters)
 
 # Check if data/name directory exists. Create if it doesn't.
 if not os.path.exists('data'):
@@ -234,73 +360,135 @@ highest_rerun_value = max([job.get('reruns', reruns) for job in jobs]) # Find th
 
 # This loop nesting is better than nesting the rerun loop inside jobs loop. If iterate through the versions and wait until all the reruns are completed for that version, we can run into issues where a specific version has too similar timestamps and IPs which can mess up the fingerprint.
 # For example, if we run version 1 for 5 times and it takes an hour or less to complete all the runs -> the timestamp values within version 1 are then for that specific hour. Rather if we run version 1, then version 2 and only then loop back to run the next rerun values, we can mix the timestamps.  
-for i in range(0, highest_rerun_value + 1):
-    for job in jobs:
+# With several slots the runs are dealt out in the same order, run i of the j-th version goes to slot (i + j) % slots. Every slot keeps the interleaved order and every version rotates over all the slots, so that nothing specific to one slot (like the node IP of a profile) ends up in the captures of only one version.
+# Every slot first calibrates the versions it runs, the same as the first run without slots.
+def create_queues():
+    queues = [[] for _ in slots]
+    for i in range(1, highest_rerun_value + 1):
+        for j, job in enumerate(jobs):
+            version = job['version']
+            rerun_value = job.get('reruns', reruns) # Check if reruns are specified for this version, use the default reruns otherwise
+            if rerun_value < i: # If rerun_value for the specific version is less than the current run, then skip. This can happen if the rerun_value is specified for this version and it is lower than the default value or vice versa. 
+                continue
+            queues[(i + j) % len(slots)].append((version, i))
+
+    # Use the first run to calibrate the environment. This makes it so that the first run is not included in the results. First run is often significantly slower than the rest. 
+    calibrations = [[] for _ in slots]
+    for j, job in enumerate(jobs):
         version = job['version']
-        rerun_value = job.get('reruns', reruns) # Check if reruns are specified for this version, use the default reruns otherwise
-        if rerun_value < i: # If rerun_value for the specific version is less than the current run, then skip. This can happen if the rerun_value is specified for this version and it is lower than the default value or vice versa. 
-            continue
-        # Use the first run to calibrate the environment. This makes it so that the first run is not included in the results. First run is often significantly slower than the rest. 
-        if i == 0:
-            pod_info = calibrate(label=label, url=url, version=version, helm_install=helm_install, use_oci=use_oci)
-            update_json_file(pod_metadata_file, pod_info)
-            continue
+        slots_of_version = [k for k, queue in enumerate(queues) if any(v == version for v, _ in queue)] or [j % len(slots)]
+        for k in slots_of_version:
+            calibrations[k].append((version, 0))
+    return [calibration + queue for calibration, queue in zip(calibrations, queues)]
 
-        print(f"Run {i} of {rerun_value}. Version: {version}")
-
-        try:
-            # Step 4: Deploy a service using helm
-            run_helm_install(label=label, url=url, version=version, helm_install=helm_install, use_oci=use_oci)
-
-            # Step 5: Wait for any pod to be ready, pod related traffic is not generated before that
-            # Then start listening with tcpdump
-            pod_name = wait_for_first_ready_pod()
-            print(f"Pod {pod_name} is ready. Starting tcpdump...")
-            tcpdump_command = f"minikube ssh 'sudo timeout {timeout} tcpdump -i any -w /tmp/minikube_traffic.pcap'"
-            run_command(command=tcpdump_command, accept_timeout=True)
-
-            # Step 6: Discover all services and their IPs. Save pods metadata.
-            print("Fetching pods and their IPs...")
-            pod_ips = get_pods_ips()
-            pod_info = get_pods_info(version=version, run=i)
-            update_json_file(pod_metadata_file, pod_info)
-
-            # Step 7: Copy captured pcap to the local machine
-            pcap_filename = f"traffic_{name}_{version}_{i}.pcap"
-            pcap_filepath = f"{output_dir}/{pcap_filename}"
-            copy_command = f"minikube cp minikube:/tmp/minikube_traffic.pcap ./{pcap_filepath}"
-            run_command(copy_command)
-
-            # Step 8: Filter out traffic that doesn't relate to the pods
-            # Adjust IP addresses based on the output of Step 5
-            if pod_ips:
-                ip_filter = ' or '.join([f'host {ip}' for ip in pod_ips])
-                filtered_pcap_filename = f"{name}_{version}_{i}.pcap"
-                filtered_pcap_path = f"{output_dir}/{filtered_pcap_filename}"
-                filter_command = f"tcpdump -r ./{pcap_filepath} -w ./{filtered_pcap_path} 'not arp and ({ip_filter})'"
+def capture(slot, version, i, rerun_value):
+    print(f"{slot.prefix}Run {i} of {rerun_value}. Version: {version}")
+
+    try:
+        # Step 4: Deploy a service using helm
+        with metrics.stage('helm_install', version=version, run=i, **slot.labels):
+            run_helm_install(slot=slot, url=url, version=version, helm_install=helm_install, use_oci=use_oci)
+
+        # Step 5: Wait for any pod to be ready, pod related traffic is not generated before that
+        # Then start listening with tcpdump
+        with metrics.stage('wait_for_pod', version=version, run=i, **slot.labels):
+            pod_name = wait_for_first_ready_pod(slot)
+        print(f"{slot.prefix}Pod {pod_name} is ready. Starting tcpdump...")
+        pcap_filepath = f"{output_dir}/traffic_{name}_{version}_{i}.pcap"
+        filtered_pcap_path = f"{output_dir}/{name}_{version}_{i}.pcap"
+        capture_ips = None
+        if capture_mode == 'stream':
+            # The capture is streamed over the ssh standard output instead of being written in the node. If all the pods
+            # already have their IP the pod filter is applied by tcpdump in the node and the stream is the final pcap file.
+            # Otherwise all the traffic except arp is streamed and filtered in Step 8 with the IPs after the capture.
+            pods_json = get_pods_snapshot(slot)
+            missing_ips = pods_without_ip(pods_json)
+            if missing_ips:
+                print(f"{slot.prefix}Pods without an IP yet: {missing_ips}. Filtering after the capture.")
+            else:
+                capture_ips = get_pods_ips(pods_json)
+            capture_filter = f"not arp and ({host_filter(capture_ips)})" if capture_ips else "not arp"
+            capture_file = filtered_pcap_path if capture_ips else pcap_filepath
+            tcpdump_command = f"{slot.minikube()} ssh 'sudo timeout {timeout} tcpdump -i any -U -w - \"{capture_filter}\"'"
+        else:
+            capture_file = None
+            tcpdump_command = f"{slot.minikube()} ssh 'sudo timeout {timeout} tcpdump -i any -w {slot.remote_pcap}'"
+        with metrics.stage('capture', version=version, run=i, **slot.labels) as stage:
+            run_command(command=tcpdump_command, accept_timeout=True, output_file=capture_file)
+            if capture_file:
+                stage.add(bytes=os.path.getsize(capture_file))
+
+        # Step 6: Discover all services and their IPs. Save pods metadata.
+        print(f"{slot.prefix}Fetching pods and their IPs...")
+        with metrics.stage('pod_metadata', version=version, run=i, **slot.labels):
+            pods_json = get_pods_snapshot(slot)
+            pod_ips = get_pods_ips(pods_json)
+            pod_info = get_pods_info(slot, pods_json, version=version, run=i)
+            with output_lock:
+                update_json_file(pod_metadata_file, pod_info)
+
+        # Step 7: Copy captured pcap to the local machine, unless it was streamed
+        if capture_mode == 'copy':
+            copy_command = f"{slot.minikube()} cp {slot.node}:{slot.remote_pcap} ./{pcap_filepath}"
+            with metrics.stage('copy_pcap', version=version, run=i, **slot.labels) as stage:
+                run_command(copy_command)
+                stage.add(bytes=os.path.getsize(pcap_filepath))
+
+        # Step 8: Filter out traffic that doesn't relate to the pods, unless it was filtered during the capture
+        # Adjust IP addresses based on the output of Step 5
+        if capture_ips:
+            new_ips = [ip for ip in pod_ips if ip not in capture_ips]
+            if new_ips:
+                print(f"{slot.prefix}Warning: pods with the IPs {new_ips} started during the capture. Only their traffic with the other pods was captured.")
+        elif pod_ips:
+            filter_command = f"tcpdump -r ./{pcap_filepath} -w ./{filtered_pcap_path} 'not arp and ({host_filter(pod_ips)})'"
+            with metrics.stage('filter_pcap', version=version, run=i, **slot.labels) as stage:
                 run_command(filter_command)
+                stage.add(bytes=os.path.getsize(filtered_pcap_path))
 
-                # Step 9: Aggregate the pcap to CSV. This creates a single row entry for the pcap file.
-                output_csv = f"{output_dir}/output.csv"
-                sum_pcap_command = f"python3 ./utils/sum_pcap_to_csv.py {filtered_pcap_path} {output_csv} {version}"
+        if capture_ips or pod_ips:
+            # Step 9: Aggregate the pcap to CSV. This creates a single row entry for the pcap file.
+            output_csv = f"{output_dir}/output.csv"
+            sum_pcap_command = f"python3 ./utils/sum_pcap_to_csv.py {filtered_pcap_path} {output_csv} {version}"
+            with metrics.stage('sum_pcap_to_csv', version=version, run=i, **slot.labels), output_lock:
                 run_command(sum_pcap_command)
 
-                # Step 10: Remove the unfiltered pcap file
+            # Step 10: Remove the unfiltered pcap file
+            if not capture_ips:
                 os.remove(pcap_filepath)
-        except Exception as e:
-                print(f"Error: {e}")
+    except Exception as e:
+        print(f"{slot.prefix}Error: {e}")
+
+    print(f"{slot.prefix}Completed Run {i} / {rerun_value}. Version: {version}")
 
-        print(f"Completed Run {i} / {rerun_value}. Version: {version}")
+    # Step 11: Cleanup
+    with metrics.stage('cleanup', version=version, run=i, **slot.labels):
+        cleanup(slot)
 
-        # Step 11: Cleanup
-        cleanup(label=label)
+def run_slot(slot, queue):
+    reruns_by_version = {job['version']: job.get('reruns', reruns) for job in jobs}
+    for version, i in queue:
+        if i == 0:
+            with metrics.stage('calibrate', version=version, **slot.labels):
+                pod_info = calibrate(slot=slot, url=url, version=version, helm_install=helm_install, use_oci=use_oci)
+            with output_lock:
+                update_json_file(pod_metadata_file, pod_info)
+            continue
+        capture(slot, version, i, reruns_by_version[version])
+
+queues = create_queues()
+run_in_slots(lambda slot: run_slot(slot, queues[slot.index]), slots)
 
 print("All runs completed.")
 
 # Cleanup: Stop and delete Minikube
 print("Stopping and deleting Minikube...")
-run_command("minikube stop")
-run_command("minikube delete")
+def delete_cluster(slot):
+    with metrics.stage('minikube_delete', **slot.labels):
+        run_command(f"{slot.minikube()} stop")
+        run_command(f"{slot.minikube()} delete")
+
+run_in_slots(delete_cluster, clusters)
 
 print("--------------------------------\n")
 
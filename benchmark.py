@@ -0,0 +1,314 @@
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time as time_module
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from utils.synthetic_pcap import DEFAULT_PROTO_MIX, LENGTH_DISTRIBUTIONS, generate_dataset
+
+# Benchmark of the pipeline stages on a synthetic dataset (see utils/synthetic_pcap.py), so the throughput can be
+# measured without the real dataset or a Kubernetes cluster and compared between commits.
+#
+# Every stage runs in a fresh process, which makes the peak RSS of a stage independent of the stages before it. The
+# inputs of a stage (the outputs of the previous stages) are prepared before its timer starts, so the time covers only
+# the stage itself. The results are written to a JSON file. With --baseline the results are compared to an earlier
+# results file.
+
+STAGES = ['common_payload_indices', 'extract_pcap', 'create_version_fingerprint', 'compare_pcap_to_fingerprint', 'compare_pcap_to_features', 'filter_pcap', 'aggregate_diffs', 'classify']
+FILTER_EVERY = 10 # filter_pcap keeps every FILTER_EVERY-th packet
+# Size of the (proto, length) key used by common_payload_indices, e.g. a large response that repeats in every capture
+KEY_PAYLOADS = 2000
+KEY_LENGTH = 1400
+KEY_MUTATIONS = 3 # Positions that change in every payload
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _pcap_files(pcap_dir):
+    return sorted(glob.glob(os.path.join(pcap_dir, '*.pcap')))
+
+def _comparisons(pcap_dir):
+    import fingerprint
+    jobs, versions = fingerprint.load_configuration(config_file=None, pcap_dir=pcap_dir)
+    for fingerprint_version in versions:
+        fingerprint_pcap_files, test_pcap_files, result_dir = fingerprint.choose_files(pcap_dir=pcap_dir, fingerprint_version=fingerprint_version, test_versions=versions)
+        yield fingerprint_version, fingerprint_pcap_files, [os.path.join(pcap_dir, f) for f in test_pcap_files], result_dir
+
+# The stages. Each one prepares its inputs and returns the timed part as a function that returns its counters. Stages
+# that write outputs for the later stages yield the counters first, the rest of the function is not timed.
+
+# The per character loop the stable positions of a key were originally computed with: the positions where every
+# payload equals the first one. Only kept as the reference for the common_payload_indices stage.
+def _common_positions_loop(payloads):
+    reference = payloads[0]
+    positions = set(range(len(reference)))
+    for payload in payloads[1:]:
+        positions.difference_update([i for i in positions if reference[i] != payload[i]])
+    return positions
+
+# The stable positions of one large key with FingerprintEntry.update. The original per character loop
+# (_common_positions_loop) is run on the same key before the timer starts, its time is reported as loop_seconds.
+# Does not use the dataset.
+def stage_common_payload_indices(pcap_dir, backend):
+    import random
+    from utils.compact_fingerprint import FingerprintEntry
+    rng = random.Random(0)
+    reference = bytearray(rng.randbytes(KEY_LENGTH))
+    payloads = []
+    for _ in range(KEY_PAYLOADS):
+        payload = bytearray(reference)
+        for position in rng.sample(range(KEY_LENGTH // 2), KEY_MUTATIONS):
+            payload[position] = rng.randrange(256)
+        payloads.append(payload.decode('latin-1'))
+
+    start = time_module.perf_counter()
+    expected = _common_positions_loop(payloads)
+    loop_seconds = time_module.perf_counter() - start
+
+    def run():
+        entry = FingerprintEntry(payloads[0])
+        entry.update(payloads, len(payloads))
+        entry.finalize(is_common=True)
+        if entry.common_payload_indices != expected:
+            raise RuntimeError('FingerprintEntry and the reference loop disagree on the stable positions')
+        return {'packets': len(payloads), 'bytes': len(payloads) * KEY_LENGTH, 'stable_positions': len(entry.stable_indices), 'loop_seconds': loop_seconds}
+    return run
+
+def stage_extract_pcap(pcap_dir, backend):
+    import fingerprint
+    pcap_files = _pcap_files(pcap_dir)
+
+    def run():
+        packets = sum(len(fingerprint.extract_pcap(f, backend=backend)) for f in pcap_files)
+        return {'files': len(pcap_files), 'packets': packets, 'bytes': sum(os.path.getsize(f) for f in pcap_files)}
+    return run
+
+def stage_create_version_fingerprint(pcap_dir, backend):
+    import fingerprint
+    from utils.fingerprint_store import build_parameters, fingerprint_path, save_fingerprint
+    comparisons = list(_comparisons(pcap_dir))
+
+    def run():
+        packets = 0
+        fingerprints = []
+        for fingerprint_version, fingerprint_pcap_files, _, _ in comparisons:
+            version_fingerprint = fingerprint.create_version_fingerprint(fingerprint_pcap_files, backend=backend)
+            packets += sum(entry.packet_count for key, entry in version_fingerprint.items() if key != 'common_packets')
+            fingerprints.append((fingerprint_version, fingerprint_pcap_files, version_fingerprint))
+        counters = {'files': sum(len(c[1]) for c in comparisons), 'packets': packets, 'bytes': sum(os.path.getsize(f) for c in comparisons for f in c[1])}
+
+        # Saved for the next stages, outside of the measured time
+        yield counters
+        for fingerprint_version, fingerprint_pcap_files, version_fingerprint in fingerprints:
+            save_fingerprint(version_fingerprint, fingerprint_path(pcap_dir, fingerprint_version), build_parameters(fingerprint_version, fingerprint_pcap_files, None, backend))
+    return run
+
+def stage_compare_pcap_to_fingerprint(pcap_dir, backend):
+    import fingerprint
+    from utils.fingerprint_store import fingerprint_path, load_fingerprint
+    comparisons = list(_comparisons(pcap_dir))
+    fingerprints = {v: load_fingerprint(fingerprint_path(pcap_dir, v))[0] for v, _, _, _ in comparisons}
+    test_files = sorted(set(f for c in comparisons for f in c[2]))
+    packets = {f: fingerprint.extract_pcap(f, backend=backend) for f in test_files}
+
+    def run():
+        compared_packets = 0
+        compared_bytes = 0
+        for fingerprint_version, _, test_pcap_files, result_dir in comparisons:
+            for pcap_file in test_pcap_files:
+                fingerprint.compare_pcap_to_fingerprint(fingerprint=fingerprints[fingerprint_version], pcap_file=pcap_file, result_dir=result_dir, fingerprint_version=fingerprint_version, backend=backend, packets=packets[pcap_file])
+                compared_packets += len(packets[pcap_file])
+                compared_bytes += os.path.getsize(pcap_file)
+        return {'files': sum(len(c[2]) for c in comparisons), 'packets': compared_packets, 'bytes': compared_bytes}
+    return run
+
+# The comparison with --features_only: the aggregated results rows are computed in memory, no files are written
+def stage_compare_pcap_to_features(pcap_dir, backend):
+    import fingerprint
+    from utils.fingerprint_store import fingerprint_path, load_fingerprint
+    comparisons = list(_comparisons(pcap_dir))
+    fingerprints = {v: load_fingerprint(fingerprint_path(pcap_dir, v))[0] for v, _, _, _ in comparisons}
+    test_files = sorted(set(f for c in comparisons for f in c[2]))
+    packets = {f: fingerprint.extract_pcap(f, backend=backend) for f in test_files}
+
+    def run():
+        rows = []
+        compared_packets = 0
+        for fingerprint_version, _, test_pcap_files, result_dir in comparisons:
+            for pcap_file in test_pcap_files:
+                rows.extend(fingerprint.compare_pcap_to_fingerprint(fingerprint=fingerprints[fingerprint_version], pcap_file=pcap_file, result_dir=result_dir, fingerprint_version=fingerprint_version, backend=backend, packets=packets[pcap_file], write_diffs=False, compute_features=True))
+                compared_packets += len(packets[pcap_file])
+        return {'files': sum(len(c[2]) for c in comparisons), 'packets': compared_packets, 'rows': len(rows)}
+    return run
+
+def stage_filter_pcap(pcap_dir, backend):
+    import fingerprint
+    from utils.pcap_reader import build_record_index
+    pcap_files = _pcap_files(pcap_dir)
+    packet_counts = {f: len(build_record_index(f).numbers) - 1 for f in pcap_files} # Without the file header
+    output_dir = tempfile.mkdtemp(dir=pcap_dir)
+
+    def run():
+        for pcap_file in pcap_files:
+            fingerprint.filter_pcap(input_file=pcap_file, output_file=os.path.join(output_dir, os.path.basename(pcap_file)), packet_numbers=range(1, packet_counts[pcap_file] + 1, FILTER_EVERY))
+        yield {'files': len(pcap_files), 'packets': sum(packet_counts.values()), 'bytes': sum(os.path.getsize(f) for f in pcap_files)}
+        shutil.rmtree(output_dir)
+    return run
+
+def stage_aggregate_diffs(pcap_dir, backend):
+    from utils.aggregate_diffs import aggregate_diffs
+    result_dir = os.path.join(pcap_dir, 'fingerprint_comparison')
+    csv_files = glob.glob(os.path.join(result_dir, '*_to_*.csv'))
+
+    def run():
+        aggregate_diffs(result_dir, use_manifest=False)
+        return {'files': len(csv_files), 'bytes': sum(os.path.getsize(f) for f in csv_files)}
+    return run
+
+def stage_classify(pcap_dir, backend):
+    from classify import classify
+    from utils.aggregate_diffs import aggregate_filename
+    aggregated_results = os.path.join(pcap_dir, 'fingerprint_comparison', aggregate_filename)
+    with open(aggregated_results) as f:
+        rows = sum(1 for _ in f) - 1
+
+    def run():
+        classify(aggregated_results, save_models=False)
+        return {'rows': rows}
+    return run
+
+def _run_stage(stage, pcap_dir, backend, verbose):
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+        run = globals()[f'stage_{stage}'](pcap_dir, backend)
+        baseline_rss_mb = _peak_rss_mb()
+        start = time_module.perf_counter()
+        result = run()
+        if hasattr(result, '__next__'):
+            # Stages that leave outputs for the next stages yield their counters before writing them
+            counters = next(result)
+            seconds = time_module.perf_counter() - start
+            peak_rss_mb = _peak_rss_mb()
+            for _ in result:
+                pass
+        else:
+            counters = result
+            seconds = time_module.perf_counter() - start
+            peak_rss_mb = _peak_rss_mb()
+
+    measurement = {'seconds': seconds, 'peak_rss_mb': peak_rss_mb, 'baseline_rss_mb': baseline_rss_mb}
+    measurement.update(counters)
+    for counter in ('packets', 'bytes', 'rows'):
+        if counter in counters:
+            measurement[f'{counter}_per_second'] = counters[counter] / seconds if seconds > 0 else None
+    return measurement
+
+# Run every stage in a new process. With repeat > 1 the fastest run of each stage is kept.
+def run_benchmark(pcap_dir, backend='raw', stages=STAGES, repeat=1, verbose=False):
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                runs.append(executor.submit(_run_stage, stage, pcap_dir, backend, verbose).result())
+        best = min(runs, key=lambda r: r['seconds'])
+        best['peak_rss_mb'] = max(r['peak_rss_mb'] for r in runs)
+        best['runs'] = [r['seconds'] for r in runs]
+        results[stage] = best
+        print(f"{stage}: {best['seconds']:.3f} s" + (f", {best['packets_per_second']:.0f} packets/s" if best.get('packets_per_second') else '') + f", peak RSS {best['peak_rss_mb']:.1f} MB"
+              + (f", {best['loop_seconds'] / best['seconds']:.0f}x faster than the loop ({best['loop_seconds']:.3f} s)" if best.get('loop_seconds') and best['seconds'] > 0 else ''))
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_to_baseline(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"\nCompared to {baseline_file} (commit {baseline.get('commit')}):")
+    for stage, measurement in results.items():
+        previous = baseline.get('stages', {}).get(stage)
+        if not previous:
+            continue
+        print(f"{stage}: {measurement['seconds'] / previous['seconds']:.2f}x time, {measurement['peak_rss_mb'] / previous['peak_rss_mb']:.2f}x peak RSS")
+
+def parse_proto_mix(value):
+    proto_mix = {}
+    for item in value.split(','):
+        proto, weight = item.split('=')
+        proto_mix[proto.strip().upper()] = float(weight)
+    return proto_mix
+
+def main(output_file, data_dir=None, backend='raw', stages=STAGES, repeat=1, baseline=None, keep=False, verbose=False, **dataset_parameters):
+    work_dir = data_dir or tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        print(f"Generating the dataset in {work_dir}")
+        start = time_module.perf_counter()
+        pcap_dir = generate_dataset(work_dir, **dataset_parameters)
+        print(f"Generated in {time_module.perf_counter() - start:.1f} s\n")
+
+        results = {
+            'created': datetime.now().isoformat(),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'backend': backend,
+            'dataset': dataset_parameters,
+            'stages': run_benchmark(pcap_dir, backend=backend, stages=stages, repeat=repeat, verbose=verbose),
+        }
+    finally:
+        if not data_dir and not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults have been written to {output_file}")
+
+    if baseline:
+        compare_to_baseline(results['stages'], baseline)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on a synthetic dataset.')
+    parser.add_argument('-o', '--output_file', required=False, type=str, default='benchmark_results.json', help='JSON file for the results')
+    parser.add_argument('-d', '--data_dir', required=False, type=str, help='Folder for the synthetic dataset. A temporary folder is used and removed by default')
+    parser.add_argument('-b', '--backend', required=False, type=str, choices=['pyshark', 'tshark', 'raw'], default='raw', help='Packet extraction backend')
+    parser.add_argument('-s', '--stages', required=False, type=str, nargs='+', choices=STAGES, default=STAGES, help='Stages to run. A stage needs the outputs of the stages before it')
+    parser.add_argument('-r', '--repeat', required=False, type=int, default=1, help='Run every stage this many times and keep the fastest run')
+    parser.add_argument('--baseline', required=False, type=str, help='Earlier results file to compare to')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary dataset')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the stages')
+    # Dataset parameters
+    parser.add_argument('--versions', required=False, type=int, default=3, help='Number of versions')
+    parser.add_argument('--runs', required=False, type=int, default=10, help='Number of captures per version')
+    parser.add_argument('--packets', required=False, type=int, default=1000, help='Number of packets per capture')
+    parser.add_argument('--proto_mix', required=False, type=parse_proto_mix, default=DEFAULT_PROTO_MIX, help='Protocol weights, e.g. HTTP=0.3,TLS=0.3,DNS=0.1,DATA=0.3')
+    parser.add_argument('--length_distribution', required=False, type=str, choices=LENGTH_DISTRIBUTIONS, default='lognormal', help='Distribution of the payload lengths')
+    parser.add_argument('--mean_length', required=False, type=int, default=200, help='Mean payload length in bytes')
+    parser.add_argument('--max_length', required=False, type=int, default=1400, help='Maximum payload length in bytes')
+    parser.add_argument('--message_types', required=False, type=int, default=50, help='Number of distinct message types per version')
+    parser.add_argument('--mutation_rate', required=False, type=float, default=0.1, help='Share of the message types that change from one version to the next')
+    parser.add_argument('--seed', required=False, type=int, default=0, help='Random seed, the same seed gives the same dataset')
+
+    args = parser.parse_args()
+    main(output_file=args.output_file, data_dir=args.data_dir, backend=args.backend, stages=args.stages, repeat=args.repeat, baseline=args.baseline, keep=args.keep, verbose=args.verbose,
+         versions=args.versions, runs=args.runs, packets=args.packets, proto_mix=args.proto_mix, length_distribution=args.length_distribution, mean_length=args.mean_length,
+         max_length=args.max_length, message_types=args.message_types, mutation_rate=args.mutation_rate, seed=args.seed)
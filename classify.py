@@ -1,113 +1,153 @@
+import numpy as np
 import pandas as pd
-import re
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import classification_report, accuracy_score, confusion_matrix
 import argparse
 import os
 import semver
+from concurrent.futures import ProcessPoolExecutor
+from utils import metrics
+from utils.incremental_forest import DEFAULT_TREES_PER_BATCH, IncrementalForest, load_state, save_state, state_dir
+from utils.model_store import model_dir, save_index, save_model
 
-def classify(file_path):
-    # Step 1: Load the CSV file
-    df = pd.read_csv(file_path)
-    dir_path = os.path.dirname(file_path)
+# Regex to extract versions from filename pattern 'xx.yy.zz[-suffix]_to_xx.yy.zz[-suffix]_num.csv'
+FILENAME_PATTERN = r"^(\d+\.\d+\.\d+(?:-[\w\.]+)?)_to_(\d+\.\d+\.\d+(?:-[\w\.]+)?)_\d+\.csv"
+
+# Add the version columns parsed from the filenames. Every distinct version string is parsed with semver only once.
+def add_version_columns(df):
+    versions = df['filename'].str.extract(FILENAME_PATTERN)
+    fingerprint_versions, compared_versions = versions[0], versions[1]
 
-    # Step 2: Define a function to extract version info and is_same_version
-    def extract_versions(filename):
-        # Regex to extract versions from filename pattern 'xx.yy.zz[-suffix]_to_xx.yy.zz[-suffix]_num.csv'
-        match = re.match(r"(\d+\.\d+\.\d+(?:-[\w\.]+)?)_to_(\d+\.\d+\.\d+(?:-[\w\.]+)?)_\d+\.csv", filename)
-        if match:
-            fingerprint_version = match.group(1)
-            compared_version = match.group(2)
-            is_same_version = int(fingerprint_version == compared_version)
-            
-            # Determine if the major versions are the same
+    majors = {}
+    for version in pd.unique(versions.values.ravel()):
+        if isinstance(version, str):
             try:
-                fingerprint_parsed = semver.VersionInfo.parse(fingerprint_version)
-                compared_parsed = semver.VersionInfo.parse(compared_version)
-                is_same_major_version = int(fingerprint_parsed.major == compared_parsed.major)
+                majors[version] = semver.VersionInfo.parse(version).major
             except ValueError:
-                # If version parsing fails, set is_same_major_version to 0
-                is_same_major_version = 0
-            
-            return fingerprint_version, compared_version, is_same_version, is_same_major_version
-        return None, None, 0, 0
+                # If version parsing fails, the version is not the same major version as any other
+                majors[version] = None
+    fingerprint_majors = fingerprint_versions.map(majors)
+    compared_majors = compared_versions.map(majors)
 
-    # Step 3: Apply the function to extract versions
-    df['fingerprint_version'], df['compared_version'], df['is_same_version'], df['is_same_major_version'] = zip(
-        *df['filename'].apply(extract_versions)
-    )
+    df['fingerprint_version'] = fingerprint_versions
+    df['compared_version'] = compared_versions
+    df['is_same_version'] = (fingerprint_versions.notna() & (fingerprint_versions == compared_versions)).astype(int)
+    df['is_same_major_version'] = (fingerprint_majors.notna() & compared_majors.notna() & (fingerprint_majors == compared_majors)).astype(int)
+    return df
 
-    # # Step 4: Drop rows where is_same_major_version is True but is_same_version is False. Uncomment this if you want to only classify major versions. 
-    # df = df[~((df['is_same_major_version'] == 1) & (df['is_same_version'] == 0))]
+# The prediction_results.csv row of a version: the evaluation on the test rows and the feature importances
+def evaluation_result(version, y_test, y_pred, feature_columns, feature_importances):
+    # Calculate accuracy and classification report
+    accuracy = accuracy_score(y_test, y_pred)
+    classification_rep = classification_report(y_test, y_pred, output_dict=True)
+    confusion = confusion_matrix(y_test, y_pred)
+    tp = confusion[1][1] if len(confusion) > 1 else 0
+    fp = confusion[0][1] if len(confusion) > 1 else 0
+    tn = confusion[0][0] if len(confusion) > 1 else 0
+    fn = confusion[1][0] if len(confusion) > 1 else 0
+    importances = pd.DataFrame({'feature': feature_columns, 'importance': feature_importances})
+    importances = importances.sort_values('importance', ascending=False).reset_index(drop=True)
+    feature_importance_tuples = list(zip(importances['feature'], importances['importance']))
+
+    result = {
+        'version': version,
+        'accuracy': accuracy,
+        'true precision': classification_rep['1']['precision'] if '1' in classification_rep else 0,
+        'false precision': classification_rep['0']['precision'] if '0' in classification_rep else 0,
+        'true recall': classification_rep['1']['recall'] if '1' in classification_rep else 0,
+        'false recall': classification_rep['0']['recall'] if '0' in classification_rep else 0,
+        'true f1-score': classification_rep['1']['f1-score'] if '1' in classification_rep else 0,
+        'false f1-score': classification_rep['0']['f1-score'] if '0' in classification_rep else 0,
+        'true support': classification_rep['1']['support'] if '1' in classification_rep else 0,
+        'false support': classification_rep['0']['support'] if '0' in classification_rep else 0,
+        'total_support': classification_rep['macro avg']['support'],
+        'true positive': tp,
+        'false positive': fp,
+        'true negative': tn,
+        'false negative': fn
+    }
+
+    for feature, importance in feature_importance_tuples:
+        result[feature] = importance
+
+    return result
+
+# Split the rows of a fingerprint version into training and test sets, train a classifier on them and evaluate it. The
+# classifier is saved to models_dir if it is given. Returns the evaluation results and the description of the saved model.
+def train_and_evaluate(version, X, y, feature_columns, tree_jobs=1, models_dir=None):
+    print(f"\nTraining classifier for fingerprint version: {version}")
 
-    # Step 5: Identify unique fingerprint versions
-    unique_fingerprint_versions = df['fingerprint_version'].unique()
-
-    # Step 6: Iterate over each unique fingerprint version
-    results = []
-    for version in unique_fingerprint_versions:
-        print(f"\nTraining classifier for fingerprint version: {version}")
-        
-        # Step 7: Subset the data for the current fingerprint version
-        df_version = df[df['fingerprint_version'] == version]
-        
-        # Step 8: Drop unnecessary columns (filename, fingerprint_version, compared_version)
-        df_cleaned = df_version.drop(columns=['filename', 'fingerprint_version', 'compared_version'])
-        
-        # Step 9: Split the data into features (X) and labels (y)
-        X = df_cleaned.drop(columns=['is_same_version', 'is_same_major_version'])
-        y = df_cleaned['is_same_version']  
-        
-        # Step 10: Split the data into training and test sets
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
-        
-        # Step 11: Train the RandomForestClassifier
-        clf = RandomForestClassifier(random_state=42)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
+
+    # The trees are the same for any number of jobs, they only depend on random_state
+    clf = RandomForestClassifier(random_state=42, n_jobs=tree_jobs)
+    with metrics.stage('train_classifier', version=version) as stage:
         clf.fit(X_train, y_train)
-        
-        # Step 12: Make predictions and evaluate the model
+        stage.add(rows=len(X_train))
+
+    with metrics.stage('predict', version=version) as stage:
         y_pred = clf.predict(X_test)
-        
-        # Step 13: Calculate accuracy and classification report
-        accuracy = accuracy_score(y_test, y_pred)
-        classification_rep = classification_report(y_test, y_pred, output_dict=True)
-        confusion = confusion_matrix(y_test, y_pred)
-        tp = confusion[1][1] if len(confusion) > 1 else 0
-        fp = confusion[0][1] if len(confusion) > 1 else 0
-        tn = confusion[0][0] if len(confusion) > 1 else 0
-        fn = confusion[1][0] if len(confusion) > 1 else 0
-        feature_importances = pd.DataFrame({'feature': X.columns.tolist(), 'importance': clf.feature_importances_})
-        feature_importances = feature_importances.sort_values('importance', ascending=False).reset_index(drop=True)
-        feature_importance_tuples = list(zip(feature_importances['feature'], feature_importances['importance']))
-
-        result = {
-            'version': version,
-            'accuracy': accuracy,
-            'true precision': classification_rep['1']['precision'] if '1' in classification_rep else 0,
-            'false precision': classification_rep['0']['precision'] if '0' in classification_rep else 0,
-            'true recall': classification_rep['1']['recall'] if '1' in classification_rep else 0,
-            'false recall': classification_rep['0']['recall'] if '0' in classification_rep else 0,
-            'true f1-score': classification_rep['1']['f1-score'] if '1' in classification_rep else 0,
-            'false f1-score': classification_rep['0']['f1-score'] if '0' in classification_rep else 0,
-            'true support': classification_rep['1']['support'] if '1' in classification_rep else 0,
-            'false support': classification_rep['0']['support'] if '0' in classification_rep else 0,
-            'total_support': classification_rep['macro avg']['support'],
-            'true positive': tp,
-            'false positive': fp,
-            'true negative': tn,
-            'false negative': fn
-        }
-
-        for feature, importance in feature_importance_tuples:
-            result[feature] = importance
-
-        # Store results for this version
-        results.append(result)
+        stage.add(rows=len(X_test))
+
+    result = evaluation_result(version, y_test, y_pred, feature_columns, clf.feature_importances_)
+
+    model = None
+    if models_dir:
+        # Saved for predicting single captures, which do not need the tree threads
+        clf.set_params(n_jobs=None)
+        with metrics.stage('save_model', version=version):
+            model = save_model(models_dir, version, clf, train_rows=len(X_train), test_rows=len(X_test), accuracy=result['accuracy'])
+
+    return result, model
+
+# Split the available CPUs between the versions trained in parallel (processes) and the trees of each forest
+# (threads), so that at most jobs CPUs are busy. jobs < 1 uses all the CPUs.
+def split_jobs(jobs, versions, tree_jobs=None):
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    if tree_jobs:
+        version_jobs = max(1, min(versions, jobs // tree_jobs))
+    else:
+        version_jobs = max(1, min(versions, jobs))
+        tree_jobs = max(1, jobs // version_jobs)
+    return version_jobs, tree_jobs
+
+# Load aggregated_results.csv into one feature matrix. Returns the DataFrame, the feature columns, the features and
+# labels of all the rows and {fingerprint_version: row indices} in the order the versions appear in the file.
+def load_feature_matrix(file_path):
+    # Step 1: Load the CSV file
+    with metrics.stage('load_aggregated_results') as stage:
+        df = pd.read_csv(file_path)
+        stage.add(rows=len(df))
+
+    # Step 2: Features are all the aggregated columns except the filename
+    feature_columns = [column for column in df.columns if column != 'filename']
 
+    # Step 3: Extract the versions and is_same_version from the filenames
+    add_version_columns(df)
+
+    # # Step 4: Drop rows where is_same_major_version is True but is_same_version is False. Uncomment this if you want to only classify major versions. 
+    # df = df[~((df['is_same_major_version'] == 1) & (df['is_same_version'] == 0))]
+
+    # Step 5: One feature matrix for all the versions, the rows of each fingerprint version are taken from it by index
+    X = df[feature_columns].to_numpy(dtype=np.float64)
+    y = df['is_same_version'].to_numpy()
+    indices = df.groupby('fingerprint_version', sort=False).indices
+    rows_by_version = {version: indices[version] for version in pd.unique(df['fingerprint_version'].dropna())}
+    return df, feature_columns, X, y, rows_by_version
+
+# Call function with every tuple of arguments, in version_jobs processes if version_jobs > 1
+def run_versions(function, arguments, version_jobs, tree_jobs):
+    if version_jobs > 1:
+        print(f"Training {len(arguments)} classifiers in {version_jobs} processes with {tree_jobs} jobs each")
+        with ProcessPoolExecutor(max_workers=version_jobs) as executor:
+            return list(executor.map(function, *zip(*arguments)))
+    return [function(*a) for a in arguments]
+
+def save_results(results, results_file_path):
     # Save the results to a CSV file
     results_df = pd.DataFrame(results)
-    results_file_path = os.path.join(dir_path, 'prediction_results.csv')
     results_df.to_csv(results_file_path, index=False)
 
     # Optional: Print a summary of the results
@@ -115,11 +155,90 @@ def classify(file_path):
     for result in results:
         print(f"Version: {result['version']}, Accuracy: {result['accuracy']}, Total Support: {result['total_support']}")
 
+def classify(file_path, jobs=1, tree_jobs=None, save_models=True):
+    dir_path = os.path.dirname(file_path)
+    df, feature_columns, X, y, rows_by_version = load_feature_matrix(file_path)
+
+    # Step 6: Train a classifier for every fingerprint version
+    version_jobs, tree_jobs = split_jobs(jobs, len(rows_by_version), tree_jobs)
+    models_dir = model_dir(dir_path) if save_models else None
+    arguments = [(version, X[rows], y[rows], feature_columns, tree_jobs, models_dir) for version, rows in rows_by_version.items()]
+    outputs = run_versions(train_and_evaluate, arguments, version_jobs, tree_jobs)
+    results = [result for result, _ in outputs]
+
+    # The models are listed together with the feature columns they expect, predict.py uses them for new captures
+    if save_models:
+        save_index(models_dir, feature_columns, {version: model for version, (_, model) in zip(rows_by_version, outputs)}, aggregated_results=file_path)
+        print(f"Saved the classifiers to {models_dir}")
+
+    save_results(results, os.path.join(dir_path, 'prediction_results.csv'))
+    return results
+
+# Update the incremental forest of a version with the rows it has not seen yet and evaluate it on the test rows of all
+# the batches so far. Returns the evaluation results, or None if there are no test rows yet.
+def update_and_evaluate(version, X, y, filenames, feature_columns, tree_jobs, incremental_dir, trees_per_batch, max_trees):
+    forest = load_state(incremental_dir, version)
+    if forest is None or forest.feature_columns != feature_columns:
+        if forest is not None:
+            print(f"The features of version {version} changed, training it from the start")
+        forest = IncrementalForest(feature_columns, trees_per_batch=trees_per_batch, max_trees=max_trees)
+    forest.trees_per_batch = trees_per_batch
+    forest.max_trees = max_trees
+
+    new_rows = np.array([filename not in forest.seen for filename in filenames], dtype=bool)
+    if new_rows.any():
+        print(f"\nUpdating classifier for fingerprint version: {version} with {new_rows.sum()} new rows")
+        with metrics.stage('train_classifier', version=version, incremental=True) as stage:
+            train_rows, test_rows = forest.add_batch(X[new_rows], y[new_rows], filenames[new_rows], n_jobs=tree_jobs)
+            stage.add(rows=train_rows)
+        save_state(incremental_dir, version, forest)
+        print(f"Version {version}: batch {forest.batches}, {train_rows} training rows, {test_rows} test rows, {forest.n_trees} trees")
+    else:
+        print(f"\nNo new rows for fingerprint version: {version}")
+
+    if len(forest.test_y) == 0:
+        print(f"Version {version} has no test rows yet")
+        return None
+
+    with metrics.stage('predict', version=version) as stage:
+        y_pred = forest.predict(forest.test_X)
+        stage.add(rows=len(forest.test_y))
+    return evaluation_result(version, forest.test_y, y_pred, feature_columns, forest.feature_importances_)
+
+# Incremental training: every version keeps its forest in fingerprint_comparison/incremental and only the rows of
+# aggregated_results.csv that it has not been trained or tested on are used (see utils/incremental_forest.py). The
+# results are written to incremental/prediction_results.csv, with the same columns as prediction_results.csv.
+def classify_incremental(file_path, jobs=1, tree_jobs=None, trees_per_batch=DEFAULT_TREES_PER_BATCH, max_trees=None):
+    incremental_dir = state_dir(os.path.dirname(file_path))
+    df, feature_columns, X, y, rows_by_version = load_feature_matrix(file_path)
+    filenames = df['filename'].to_numpy()
+
+    version_jobs, tree_jobs = split_jobs(jobs, len(rows_by_version), tree_jobs)
+    arguments = [(version, X[rows], y[rows], filenames[rows], feature_columns, tree_jobs, incremental_dir, trees_per_batch, max_trees) for version, rows in rows_by_version.items()]
+    results = [result for result in run_versions(update_and_evaluate, arguments, version_jobs, tree_jobs) if result is not None]
+
+    os.makedirs(incremental_dir, exist_ok=True)
+    save_results(results, os.path.join(incremental_dir, 'prediction_results.csv'))
+    return results
+
 
 if __name__ == "__main__":
     # Step 0: Define the parser
     parser = argparse.ArgumentParser(description='Predict changes in versions.')
     parser.add_argument('file_path', type=str, help='Path to the CSV file containing version info')
+    parser.add_argument('-j', '--jobs', required=False, type=int, default=1, help='Number of CPUs used to train the classifiers of the fingerprint versions in parallel. -1 uses all the CPUs')
+    parser.add_argument('--tree_jobs', required=False, type=int, help='Number of threads each classifier uses to build its trees. By default the CPUs given with --jobs are split between the versions and the trees')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Only train on the rows added since the last incremental run, keeping the classifiers in fingerprint_comparison/incremental')
+    parser.add_argument('--trees_per_batch', required=False, type=int, default=DEFAULT_TREES_PER_BATCH, help='Number of trees added for every batch of new rows with --incremental')
+    parser.add_argument('--max_trees', required=False, type=int, help='With --incremental, drop the trees of the oldest batches once a classifier has more trees than this')
+    parser.add_argument('--no_models', action='store_true', help='Do not save the trained classifiers for predict.py')
+    parser.add_argument('--metrics_file', required=False, type=str, help='Write stage timings and peak memory to this file')
+    parser.add_argument('--metrics_format', required=False, type=str, choices=metrics.METRICS_FORMATS, default='jsonl', help='Format of the metrics file: JSON lines, or a Prometheus textfile')
     args = parser.parse_args()
+    if args.metrics_file:
+        metrics.enable(args.metrics_file, format=args.metrics_format)
     file_path = args.file_path
-    classify(file_path)
+    if args.incremental:
+        classify_incremental(file_path, jobs=args.jobs, tree_jobs=args.tree_jobs, trees_per_batch=args.trees_per_batch, max_trees=args.max_trees)
+    else:
+        classify(file_path, jobs=args.jobs, tree_jobs=args.tree_jobs, save_models=not args.no_models)
@@ -1,15 +1,21 @@
 import argparse
 import os
-from scapy.all import *
 import pyshark
 import binascii
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from datetime import datetime
-import pandas as pd
 import json
 from typing import List
-from utils.aggregate_diffs import aggregate_diffs
-from concurrent.futures import ThreadPoolExecutor
+from utils.aggregate_diffs import aggregate_diffs, write_aggregated_results
+from utils.pcap_reader import read_packets, build_record_index, subset_pcap
+from utils import tshark_fields
+from utils.compact_fingerprint import FingerprintEntry
+from utils.diff_writer import DiffWriter
+from utils.diff_features import DiffFeatures
+from utils.fingerprint_store import FingerprintFormatError, build_parameters, describe_source_files, fingerprint_path, load_fingerprint, read_parameters, save_fingerprint
+from utils.packet_cache import PacketCache, CACHE_DIR_NAME, DEFAULT_MAX_SIZE_MB
+from utils import metrics
+from concurrent.futures import ProcessPoolExecutor
 
 def create_diff_string(diff_indices, payload, invisible=False):
     diff_string = ''
@@ -21,39 +27,16 @@ def create_diff_string(diff_indices, payload, invisible=False):
             diff_string += payload[i] if not invisible else '\u2800'
     return diff_string
 
-# Filter the packets in the input pcap file based on the packet numbers and write the filtered packets to the output pcap file
+# Filter the packets in the input pcap file based on the packet numbers and write the filtered packets to the output pcap file.
+# The records are copied without dissecting them. The record offset index of the input file is kept in the packet cache, so filtering the same file again (e.g. against another fingerprint version) only reads the needed records.
 def filter_pcap(input_file, output_file, packet_numbers):
-    packets = rdpcap(input_file)
-    filtered_packets = [packet for i, packet in enumerate(packets, start=1) if i in packet_numbers]
-    wrpcap(output_file, filtered_packets)
-
-def compare_strings(s1, s2):
-    return [i for i in range(min(len(s1), len(s2))) if s1[i] == s2[i]]
-
-# Compares two strings and given set of indices. Return a list of indices where the indices are different.
-def compare_strings_with_indices(s1, s2, indices):
-    return [i for i in indices if s1[i] != s2[i]]
-    
-
-def compare_string_to_all_strings(string, strings):
-    mutual_indices = set()
-    for i in range(len(strings)):
-      s = strings[i]
-      if i == 0:
-         mutual_indices = set(compare_strings(string, s))
-      else: 
-         different_indices = compare_strings_with_indices(string, s, mutual_indices)
-         mutual_indices = mutual_indices.difference(different_indices)
-
-    return mutual_indices
-
-def find_diffs(new_string, common_indices, common_string):
-    not_matching_indices = []
-    for m in common_indices:
-        if common_string[m] != new_string[m]:
-            not_matching_indices.append(m)
-            
-    return not_matching_indices
+    index = None
+    if packet_cache is not None:
+        index = packet_cache.get_index(input_file)
+        if index is None:
+            index = build_record_index(input_file)
+            packet_cache.put_index(input_file, index)
+    subset_pcap(input_file=input_file, output_file=output_file, packet_numbers=packet_numbers, index=index)
 
 def escape_csv_delimiter(s):
     s = s.replace('"', '""')
@@ -82,146 +65,352 @@ def extract_packet(packet):
 
     return data
 
-# Cache parsed packets
-parsed_packets_map = {}
+# Persistent cache of parsed packets (see utils/packet_cache.py). Set in main, None disables caching.
+packet_cache = None
 
-def extract_pcap(pcap_file, time=None):
-    # if pcap_file in parsed_packets_map:
-    #     return parsed_packets_map[pcap_file]
-    # else:
-        display_filter = f"frame.time_relative < {time}" if time else None
-        packets = pyshark.FileCapture(pcap_file, include_raw=False, use_json=True, display_filter=display_filter) # There are some bugs with the include_raw parameter in pyshark (and poor documentation, false types etc.). So set it to false. 
-        extracted_packets = [extract_packet(packet) for packet in packets]
-        parsed_packets = [(p['proto'], p['length'], p['payload'], p['packet_number']) for p in extracted_packets]
+# Packet extraction backends. 'pyshark' dissects the packets with tshark and is the reference implementation. 'tshark' also uses tshark for dissection but streams only the needed fields as text, which avoids the JSON and pyshark object overhead. 'raw' reads the pcap records directly and classifies the protocols with port/payload heuristics, it does not need tshark at all.
+EXTRACTION_BACKENDS = ['pyshark', 'tshark', 'raw']
+DEFAULT_EXTRACTION_BACKEND = 'pyshark'
 
-        # parsed_packets_map[pcap_file] = parsed_packets
+def extract_pcap_pyshark(pcap_file, time=None):
+    display_filter = f"frame.time_relative < {time}" if time else None
+    packets = pyshark.FileCapture(pcap_file, include_raw=False, use_json=True, display_filter=display_filter) # There are some bugs with the include_raw parameter in pyshark (and poor documentation, false types etc.). So set it to false. 
+    extracted_packets = [extract_packet(packet) for packet in packets]
+    parsed_packets = [(p['proto'], p['length'], p['payload'], p['packet_number']) for p in extracted_packets]
 
-        packets.close()
+    packets.close()
 
+    return parsed_packets
+
+def extract_pcap_raw(pcap_file, time=None):
+    # Payloads are decoded with latin-1 so that they are the same strings as the ones extract_packet produces
+    return [(proto, len(payload), payload.decode('latin-1'), number) for proto, payload, number in read_packets(pcap_file, time=time)]
+
+def extract_pcap(pcap_file, time=None, backend=DEFAULT_EXTRACTION_BACKEND):
+    if backend not in EXTRACTION_BACKENDS:
+        raise ValueError(f"Unknown extraction backend: {backend}. Available backends: {EXTRACTION_BACKENDS}")
+
+    with metrics.stage('extract_pcap', backend=backend, file=os.path.basename(pcap_file)) as stage:
+        if packet_cache is not None:
+            parsed_packets = packet_cache.get(pcap_file, backend, time)
+            if parsed_packets is not None:
+                stage.add(cache_hits=1, packets=len(parsed_packets), bytes=os.path.getsize(pcap_file))
+                return parsed_packets
+
+        if backend == 'raw':
+            parsed_packets = extract_pcap_raw(pcap_file, time=time)
+        elif backend == 'tshark':
+            parsed_packets = tshark_fields.read_packets(pcap_file, time=time)
+        else:
+            parsed_packets = extract_pcap_pyshark(pcap_file, time=time)
+
+        if packet_cache is not None:
+            packet_cache.put(pcap_file, backend, time, parsed_packets)
+
+        stage.add(packets=len(parsed_packets), bytes=os.path.getsize(pcap_file))
         return parsed_packets
 
+# Process pool entry point for extract_pcaps. Module globals are not shared with spawned worker processes, so the packet cache is recreated in the worker if needed.
+def extract_pcap_worker(pcap_file, time, backend, cache_dir, cache_size_mb):
+  global packet_cache
+  if cache_dir and (packet_cache is None or packet_cache.cache_dir != cache_dir):
+    packet_cache = PacketCache(cache_dir, max_size_mb=cache_size_mb)
+  return extract_pcap(pcap_file, time=time, backend=backend)
+
+# Extract a list of pcap files. Yields (pcap_file, parsed_packets) in the same order as pcap_files.
+#
+# With workers > 1 the files are extracted in parallel in a process pool. At most 2 * workers files are in flight at a time so that the memory use stays bounded, and the results are yielded in the pcap_files order as soon as they are available.
+# The tshark backend processes the files with a single long lived worker that dissects the next files while the current one is being handled.
+def extract_pcaps(pcap_files, time=None, backend=DEFAULT_EXTRACTION_BACKEND, workers=1):
+  if workers > 1:
+    cache_dir = packet_cache.cache_dir if packet_cache is not None else None
+    cache_size_mb = packet_cache.max_size_mb if packet_cache is not None else None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      pending = deque()
+      files = iter(pcap_files)
+      for pcap_file in files:
+        pending.append((pcap_file, executor.submit(extract_pcap_worker, pcap_file, time, backend, cache_dir, cache_size_mb)))
+        if len(pending) >= 2 * workers:
+          break
+
+      while pending:
+        pcap_file, future = pending.popleft()
+        parsed_packets = future.result()
+        next_file = next(files, None)
+        if next_file is not None:
+          pending.append((next_file, executor.submit(extract_pcap_worker, next_file, time, backend, cache_dir, cache_size_mb)))
+        yield pcap_file, parsed_packets
+  elif backend == 'tshark':
+    # Only the files that are not in the packet cache need to go through tshark
+    uncached_files = [f for f in pcap_files if packet_cache is None or not packet_cache.contains(f, backend, time)]
+    with tshark_fields.TsharkFieldsExtractor() as extractor:
+      extracted = extractor.extract_many(uncached_files, time=time)
+      for pcap_file in pcap_files:
+        if uncached_files and pcap_file == uncached_files[0]:
+          uncached_files.pop(0)
+          # Same stage as extract_pcap. The time includes waiting for the dissection that ran in the background.
+          with metrics.stage('extract_pcap', backend=backend, file=os.path.basename(pcap_file)) as stage:
+            _, parsed_packets = next(extracted)
+            if packet_cache is not None:
+              packet_cache.put(pcap_file, backend, time, parsed_packets)
+            stage.add(packets=len(parsed_packets), bytes=os.path.getsize(pcap_file))
+          yield pcap_file, parsed_packets
+        else:
+          yield pcap_file, extract_pcap(pcap_file, time=time, backend=backend)
+  else:
+    for pcap_file in pcap_files:
+      yield pcap_file, extract_pcap(pcap_file, time=time, backend=backend)
+
 # Creates a version fingerprint from the given pcap files list. 
-def create_version_fingerprint(pcap_files, limit=None, time=None):
+def create_version_fingerprint(pcap_files, limit=None, time=None, backend=DEFAULT_EXTRACTION_BACKEND, workers=1, keep_payloads=False):
   pcap_files.sort()
   common_packets = set()
   fingerprint = {}
 
   limit = len(pcap_files)
-  print('Extracting packets from old pcap files...')
-  for i in range(limit):
-    packets = set()
-    pcap_file = pcap_files[i]
-    print(f'Extracting packets from {pcap_file}... Progress: {i+1}/{limit}')
-    parsed_packets = extract_pcap(pcap_file=pcap_file, time=time)
-    for packet in parsed_packets:
-      proto, length, payload, number = packet
-      packets.add((proto, length))
-      if (proto, length) not in fingerprint:
-        fingerprint[(proto, length)] = {
-          'payloads': set([payload])
-        }
-      else: 
-        fingerprint[(proto, length)]['payloads'].add(payload)
-
-      if i == 0:
-        common_packets.add((proto, length))
-
-    common_packets = common_packets.intersection(packets)
-
-  print('Finished extracting packets from old pcap files.')
-
-  print('Determining the common values between the old packets. I.e. fingerprinting the version...')
-
-  def process_key(key):
-    if key not in common_packets:
-      return key, None
-    
-    payloads = list(fingerprint[key]['payloads'])
-    common_indices = compare_string_to_all_strings(payloads[0], payloads)
-    return key, common_indices
-
-  with ThreadPoolExecutor() as executor:
-    results = list(executor.map(process_key, fingerprint.keys()))
-
-  for key, common_indices in results:
-    if common_indices is not None:
-      fingerprint[key]['common_payload_indices'] = common_indices
+  print('Extracting packets from old pcap files and fingerprinting the version...')
+  with metrics.stage('create_version_fingerprint', backend=backend) as stage:
+    for i, (pcap_file, parsed_packets) in enumerate(extract_pcaps(pcap_files, time=time, backend=backend, workers=workers)):
+      print(f'Extracted packets from {pcap_file}... Progress: {i+1}/{limit}')
+      add_pcap_to_fingerprint(fingerprint=fingerprint, parsed_packets=parsed_packets, keep_payloads=keep_payloads)
+      packets = set((proto, length) for proto, length, _, _ in parsed_packets)
+      common_packets = packets if i == 0 else common_packets.intersection(packets)
+      stage.add(files=1, packets=len(parsed_packets))
+
+    for key, entry in fingerprint.items():
+      entry.finalize(is_common=key in common_packets)
 
   fingerprint['common_packets'] = common_packets
   print('Version fingerprinting completed.')
   return fingerprint
 
-def add_diff_packet_to_df(df, packet_number, total_packets, proto, length, payload, new_packet, missing_packet, diff_indices, fingerprint_indices):
-  payload_diff = escape_csv_delimiter(create_diff_string(diff_indices, payload)) if not new_packet and not missing_packet else ''
-  payload_diff_invisible = escape_csv_delimiter(create_diff_string(diff_indices, payload, invisible=True)) if not new_packet and not missing_packet else ''
-  payload = escape_csv_delimiter(payload) 
-
-  return pd.concat([df, pd.DataFrame({
-    'packet_number': [packet_number],
-    'total_packets': [total_packets],
-    'proto': [proto],
-    'length': [length],
-    'new_packet': [new_packet],
-    'missing_packet': [missing_packet],
-    'payload': [payload],
-    'payload_diff': [payload_diff],
-    'payload_diff_invisible': [payload_diff_invisible],
-    'diff_indices': [diff_indices if not new_packet and not missing_packet else ''],
-    'fingerprint_indices': [fingerprint_indices if not new_packet else '']
-  })], ignore_index=True)
-
-# Compare a pcap file to a fingerprint. Save the differences to a new pcap file and a CSV file.
-def compare_pcap_to_fingerprint(fingerprint, pcap_file, result_dir, fingerprint_version, time=None):
-  common_packets = fingerprint['common_packets'].copy()
-
-  print(f'\tExtracting packets from the pcap file...')
-
-  new_version_packets = extract_pcap(pcap_file, time=time)
+# Update an existing fingerprint in place with additional pcap files. All the fingerprint operations are monotone (the common packets can only shrink, the stable payload positions can only be narrowed down), so only the new files need to be extracted and the result is the same as rebuilding the fingerprint from all the files.
+def update_version_fingerprint(fingerprint, pcap_files, time=None, backend=DEFAULT_EXTRACTION_BACKEND, workers=1):
+  pcap_files = sorted(pcap_files)
+  common_packets = fingerprint.setdefault('common_packets', set())
+  is_empty = len(fingerprint) == 1
+  ever_common = set(common_packets) # Keys whose stable positions were kept at some point of the update
 
-  print(f'\tFinished extracting packets from the pcap file.')
-
-  different_packets_df = pd.DataFrame(columns=['packet_number', 'total_packets', 'proto', 'length', 'new_packet', 'missing_packet', 'payload', 'payload_diff', 'payload_diff_invisible', 'diff_indices', 'fingerprint_indices'])
-
-  print(f'\tComparing packets with the fingerprint...')
-  total_packets = len(new_version_packets)
-  for packet in new_version_packets:
-    proto, length, payload, number = packet
-    common_packets.discard((proto, length))
+  limit = len(pcap_files)
+  print('Updating the fingerprint with new pcap files...')
+  with metrics.stage('update_version_fingerprint', backend=backend) as stage:
+    for i, (pcap_file, parsed_packets) in enumerate(extract_pcaps(pcap_files, time=time, backend=backend, workers=workers)):
+      print(f'Extracted packets from {pcap_file}... Progress: {i+1}/{limit}')
+      add_pcap_to_fingerprint(fingerprint=fingerprint, parsed_packets=parsed_packets)
+      packets = set((proto, length) for proto, length, _, _ in parsed_packets)
+      common_packets = packets if is_empty and i == 0 else common_packets.intersection(packets)
+      ever_common.update(common_packets)
+      stage.add(files=1, packets=len(parsed_packets))
+
+      # Keys seen for the first time are not common, unless this is the first file of the fingerprint
+      for key in packets:
+        entry = fingerprint[key]
+        if entry.stable_mask is not None:
+          entry.finalize(is_common=key in common_packets)
+
+  # Keys that dropped out of the common packets do not need their stable positions anymore
+  for key in ever_common - common_packets:
+    fingerprint[key].stable_indices = None
 
-    if (proto, length) in fingerprint:
-      packet_is_different = False
+  fingerprint['common_packets'] = common_packets
+  print('Fingerprint update completed.')
+  return fingerprint
 
-      if (proto, length) in fingerprint['common_packets']:
-        fingerprint_packets = fingerprint[(proto, length)]
+# Load the fingerprint of a version from its fingerprint file (see utils/fingerprint_store.py) if it was built from the same pcap files with the same parameters, otherwise create it and save it for the next runs.
+def load_or_create_version_fingerprint(pcap_dir, fingerprint_version, pcap_files, time=None, backend=DEFAULT_EXTRACTION_BACKEND, workers=1, rebuild=False):
+  path = fingerprint_path(pcap_dir, fingerprint_version)
+  parameters = build_parameters(fingerprint_version=fingerprint_version, pcap_files=pcap_files, time=time, backend=backend)
 
-        # Find the different indices in strings between the new payload and the fingerprint payload
-        diffs = find_diffs(new_string=payload, common_indices=fingerprint_packets['common_payload_indices'], common_string=list(fingerprint_packets['payloads'])[0])
+  if not rebuild and os.path.exists(path):
+    try:
+      stored_parameters = read_parameters(path)
+      stored_files = stored_parameters.get('source_files', [])
+      same_build = all(stored_parameters.get(key) == parameters[key] for key in ('fingerprint_version', 'time', 'backend'))
+      if same_build and stored_files == parameters['source_files']:
+        with metrics.stage('load_fingerprint', version=fingerprint_version) as stage:
+          fingerprint, _ = load_fingerprint(path)
+          stage.add(bytes=os.path.getsize(path))
+        print(f'Loaded fingerprint version {fingerprint_version} from {path}')
+        return fingerprint
+      if same_build and all(f in parameters['source_files'] for f in stored_files):
+        # New captures have been added since the fingerprint was built, only those need to be processed
+        return update_fingerprint_file(pcap_dir=pcap_dir, fingerprint_version=fingerprint_version, pcap_files=pcap_files, workers=workers)
+      print(f'Fingerprint file {path} was built with different parameters, rebuilding it.')
+    except FingerprintFormatError as e:
+      print(f'Could not load fingerprint file {path}: {e}. Rebuilding it.')
+
+  fingerprint = create_version_fingerprint(pcap_files=pcap_files, time=time, backend=backend, workers=workers)
+  with metrics.stage('save_fingerprint', version=fingerprint_version):
+    save_fingerprint(fingerprint, path, parameters)
+  print(f'Saved fingerprint version {fingerprint_version} to {path}')
+  return fingerprint
 
-        # Packet is different if diffs is not empty
-        packet_is_different = len(diffs) > 0
+# Update a saved fingerprint file with the given pcap files. Files that the fingerprint was already built from are skipped. The time cutoff and backend stored in the file are used so that the result is the same as a rebuild.
+def update_fingerprint_file(pcap_dir, fingerprint_version, pcap_files, workers=1):
+  path = fingerprint_path(pcap_dir, fingerprint_version)
+  fingerprint, parameters = load_fingerprint(path)
+  stored_names = set(f['name'] for f in parameters['source_files'])
+  new_pcap_files = [f for f in pcap_files if os.path.basename(f) not in stored_names]
+  if not new_pcap_files:
+    print(f'Fingerprint version {fingerprint_version} already contains all the given pcap files.')
+    return fingerprint
+
+  update_version_fingerprint(fingerprint=fingerprint, pcap_files=new_pcap_files, time=parameters['time'], backend=parameters['backend'], workers=workers)
+  source_files = sorted(parameters['source_files'] + describe_source_files(new_pcap_files), key=lambda f: f['name'])
+  save_fingerprint(fingerprint, path, {'fingerprint_version': fingerprint_version, 'source_files': source_files, 'time': parameters['time'], 'backend': parameters['backend']})
+  print(f'Updated fingerprint version {fingerprint_version} in {path} with {len(new_pcap_files)} new pcap files')
+  return fingerprint
 
-      if packet_is_different:
-        different_packets_df = add_diff_packet_to_df(df=different_packets_df, packet_number=number, total_packets=total_packets, proto=proto, length=length, payload=payload, new_packet=False, missing_packet=False, diff_indices=diffs, fingerprint_indices=fingerprint_packets['common_payload_indices'])
-    else: 
-      different_packets_df = add_diff_packet_to_df(df=different_packets_df, packet_number=number, total_packets=total_packets, proto=proto, length=length, payload=payload, new_packet=True, missing_packet=False, diff_indices='', fingerprint_indices='')
+# Add the packets of one pcap file to the fingerprint that is being built. The stable payload positions of every (proto, length) key are narrowed down with the distinct payloads of the file.
+# The full payload sets are only kept if keep_payloads is set, which is meant for debugging.
+def add_pcap_to_fingerprint(fingerprint, parsed_packets, keep_payloads=False):
+  payloads_by_key = {}
+  packet_counts = {}
+  for proto, length, payload, number in parsed_packets:
+    key = (proto, length)
+    if key not in payloads_by_key:
+      payloads_by_key[key] = set()
+      packet_counts[key] = 0
+    payloads_by_key[key].add(payload)
+    packet_counts[key] += 1
+
+  for key, payloads in payloads_by_key.items():
+    payloads = list(payloads)
+    if key not in fingerprint:
+      fingerprint[key] = FingerprintEntry(reference_payload=payloads[0], keep_payloads=keep_payloads)
+    fingerprint[key].update(payloads, packet_count=packet_counts[key])
+
+# Write a differing packet to the comparison CSV file
+def add_diff_packet(writer, packet_number, total_packets, proto, length, payload, new_packet, missing_packet, diff_indices, fingerprint_indices):
+  payload_diff = escape_csv_delimiter(create_diff_string(diff_indices, payload)) if not new_packet and not missing_packet else ''
+  payload_diff_invisible = escape_csv_delimiter(create_diff_string(diff_indices, payload, invisible=True)) if not new_packet and not missing_packet else ''
+  payload = escape_csv_delimiter(payload) 
 
-  # Add all the missing packets
-  for proto, length in list(common_packets):
-    different_packets_df = add_diff_packet_to_df(df=different_packets_df, packet_number=0, total_packets=total_packets, proto=proto, length=length, payload=list(fingerprint[(proto, length)]['payloads'])[0], new_packet=False, missing_packet=True, diff_indices='', fingerprint_indices='')
+  writer.write([
+    packet_number,
+    total_packets,
+    proto,
+    length,
+    new_packet,
+    missing_packet,
+    payload,
+    payload_diff,
+    payload_diff_invisible,
+    diff_indices if not new_packet and not missing_packet else '',
+    fingerprint_indices if not new_packet else ''
+  ])
+
+# Combined lookup of the (proto, length) keys of several fingerprints ({fingerprint_version: fingerprint}): key -> list of (fingerprint index, entry, is_common). The fingerprint index is the position of the version in the dict.
+def build_fingerprint_lookup(fingerprints):
+  lookup = {}
+  for i, fingerprint in enumerate(fingerprints.values()):
+    for key, entry in fingerprint.items():
+      if key != 'common_packets':
+        lookup.setdefault(key, []).append((i, entry, key in fingerprint['common_packets']))
+  return lookup
 
+# Compare a pcap file to a fingerprint. Save the differences to a new pcap file and a CSV file.
+def compare_pcap_to_fingerprint(fingerprint, pcap_file, result_dir, fingerprint_version, time=None, backend=DEFAULT_EXTRACTION_BACKEND, packets=None, write_diffs=True, compute_features=False):
+  return compare_pcap_to_fingerprints(fingerprints={fingerprint_version: fingerprint}, pcap_file=pcap_file, result_dir=result_dir, time=time, backend=backend, packets=packets, write_diffs=write_diffs, compute_features=compute_features)
+
+# Compare a pcap file to several fingerprints ({fingerprint_version: fingerprint}) in a single pass over its packets. The output for every fingerprint version is the same as with compare_pcap_to_fingerprint.
+#
+# With compute_features the aggregated_results.csv row of every comparison (see utils/aggregate_diffs.py) is computed
+# while comparing and the rows are returned. The comparison CSV and PCAP files are then only needed for debugging and
+# can be left out with write_diffs=False.
+#
+# The comparisons are named <fingerprint version>_to_<new_version>. new_version is taken from the <app>_<version>_<run>.pcap file name unless it is given.
+def compare_pcap_to_fingerprints(fingerprints, pcap_file, result_dir, time=None, backend=DEFAULT_EXTRACTION_BACKEND, packets=None, write_diffs=True, compute_features=False, new_version=None):
+  if not write_diffs and not compute_features:
+    raise ValueError("Nothing to do: the comparison needs write_diffs or compute_features (or both)")
+
+  # The packets can be given if they have already been extracted from the pcap file
+  if packets is None:
+    print(f'\tExtracting packets from the pcap file...')
+
+    new_version_packets = extract_pcap(pcap_file, time=time, backend=backend)
+
+    print(f'\tFinished extracting packets from the pcap file.')
+  else:
+    new_version_packets = packets
+
+  if new_version is None:
+    file_end = pcap_file.split('/')[-1].split('_')
+    new_version = file_end[1] + '_' + file_end[2].split('.')[0]
+
+  # Per fingerprint comparison state
+  versions = list(fingerprints)
+  filenames = [f"{fingerprint_version}_to_{new_version}" for fingerprint_version in versions]
+  writers = [DiffWriter(os.path.join(result_dir, f'{filename}.csv')) for filename in filenames] if write_diffs else None
+  features = [DiffFeatures() for _ in versions] if compute_features else None
+  remaining_common_packets = [fingerprints[v]['common_packets'].copy() for v in versions]
+  different_packet_numbers = [[] for _ in versions]
+  fingerprint_indices_by_key = [{} for _ in versions]
+  total_packets = len(new_version_packets)
 
-  file_end = pcap_file.split('/')[-1].split('_')
-  new_version = file_end[1] + '_' + file_end[2].split('.')[0]
-  filename = f"{fingerprint_version}_to_{new_version}"
+  lookup = build_fingerprint_lookup(fingerprints)
 
-  # Write the different packets to a new pcap file
-  different_packet_numbers = different_packets_df['packet_number'].tolist()
-  output_pcap_file = os.path.join(result_dir, f'{filename}.pcap')
-  filter_pcap(input_file=pcap_file, output_file=output_pcap_file, packet_numbers=different_packet_numbers)
+  def add_difference(i, packet_number, proto, length, payload, new_packet, missing_packet, diff_indices='', fingerprint_indices=''):
+    if writers:
+      add_diff_packet(writer=writers[i], packet_number=packet_number, total_packets=total_packets, proto=proto, length=length, payload=payload, new_packet=new_packet, missing_packet=missing_packet, diff_indices=diff_indices, fingerprint_indices=fingerprint_indices)
+      if not missing_packet:
+        different_packet_numbers[i].append(packet_number)
+    if features:
+      features[i].add(proto=proto, length=length, payload=payload, new_packet=new_packet, missing_packet=missing_packet, diff_indices=diff_indices, fingerprint_indices=fingerprint_indices)
 
-  # Write the different packets to a CSV file
-  output_csv_file = os.path.join(result_dir, f'{filename}.csv')
-  different_packets_df.to_csv(output_csv_file, index=False, escapechar='\\')
+  # The different packets are streamed to the CSV files as they are found
+  with metrics.stage('compare_pcap', file=os.path.basename(pcap_file), fingerprints=len(versions)) as stage:
+    try:
+      print(f'\tComparing packets with the fingerprint...')
+      for packet in new_version_packets:
+        proto, length, payload, number = packet
+        key = (proto, length)
+        matches = lookup.get(key, ())
+        known = set()
+
+        for i, fingerprint_entry, is_common in matches:
+          known.add(i)
+          remaining_common_packets[i].discard(key)
+          if not is_common:
+            continue
+
+          # Find the different indices in strings between the new payload and the fingerprint payload
+          diffs = fingerprint_entry.find_diffs(payload)
+
+          # Packet is different if diffs is not empty
+          if len(diffs) > 0:
+            # Kept as the text that is written to the CSV file, the index set is the same for every packet with this key
+            if key not in fingerprint_indices_by_key[i]:
+              fingerprint_indices_by_key[i][key] = str(fingerprint_entry.common_payload_indices)
+            add_difference(i, packet_number=number, proto=proto, length=length, payload=payload, new_packet=False, missing_packet=False, diff_indices=diffs, fingerprint_indices=fingerprint_indices_by_key[i][key])
+
+        if len(known) < len(versions):
+          for i in range(len(versions)):
+            if i not in known:
+              add_difference(i, packet_number=number, proto=proto, length=length, payload=payload, new_packet=True, missing_packet=False)
+
+      # Add all the missing packets
+      for i, fingerprint_version in enumerate(versions):
+        for proto, length in list(remaining_common_packets[i]):
+          add_difference(i, packet_number=0, proto=proto, length=length, payload=fingerprints[fingerprint_version][(proto, length)].reference_payload_str, new_packet=False, missing_packet=True)
+    finally:
+      for writer in writers or ():
+        writer.close()
+    stage.add(packets=total_packets, diff_rows=sum(writer.rows_written for writer in writers) if writers is not None else sum(f.number_of_packets for f in features))
+
+  # Write the different packets to new pcap files
+  if write_diffs:
+    with metrics.stage('filter_pcap', file=os.path.basename(pcap_file)) as stage:
+      for i, filename in enumerate(filenames):
+        output_pcap_file = os.path.join(result_dir, f'{filename}.pcap')
+        filter_pcap(input_file=pcap_file, output_file=output_pcap_file, packet_numbers=different_packet_numbers[i])
+        stage.add(files=1, packets=len(different_packet_numbers[i]))
+
+  if features:
+    for feature in features:
+      feature.total_packets = total_packets
+    # Named after the comparison CSV file, like the rows utils/aggregate_diffs.py reads from the files
+    return [feature.features(filename=f'{filename}.csv') for feature, filename in zip(features, filenames)]
 
 # Choose the files to be used for fingerprinting and testing
 # 
@@ -254,18 +443,44 @@ def choose_files(pcap_dir: str, fingerprint_version: str, test_versions: List[st
 
   fingerprint_pcap_files = [os.path.join(pcap_dir, f) for f in fingerprint_pcap_files]
 
-  # Create a directory to store the results
+  return fingerprint_pcap_files, test_pcap_files, create_result_dir(pcap_dir)
+
+# Create the directory that stores the comparison results of all the fingerprint versions
+def create_result_dir(pcap_dir):
   result_dir = os.path.join(pcap_dir, 'fingerprint_comparison')
   os.makedirs(result_dir, exist_ok=True)
-
-  return fingerprint_pcap_files, test_pcap_files, result_dir
+  return result_dir
    
-def compare_pcap_files_to_fingerprint(fingerprint, fingerprint_version, pcap_files, result_dir, pcap_dir, time=None):
-  for pcap_file in pcap_files:
-    pcap_file = os.path.join(pcap_dir, pcap_file)
+# Returns the aggregated_results.csv rows of the comparisons with compute_features
+def compare_pcap_files_to_fingerprint(fingerprint, fingerprint_version, pcap_files, result_dir, pcap_dir, time=None, backend=DEFAULT_EXTRACTION_BACKEND, workers=1, write_diffs=True, compute_features=False):
+  rows = []
+  pcap_files = [os.path.join(pcap_dir, pcap_file) for pcap_file in pcap_files]
+  for pcap_file, packets in extract_pcaps(pcap_files, time=time, backend=backend, workers=workers):
     print(f"Comparing {pcap_file} to fingerprint version {fingerprint_version}")
-    compare_pcap_to_fingerprint(fingerprint=fingerprint, pcap_file=pcap_file, result_dir=result_dir, fingerprint_version=fingerprint_version, time=time)
+    rows.extend(compare_pcap_to_fingerprint(fingerprint=fingerprint, pcap_file=pcap_file, result_dir=result_dir, fingerprint_version=fingerprint_version, time=time, backend=backend, packets=packets, write_diffs=write_diffs, compute_features=compute_features) or [])
     print(f"Finished comparing {pcap_file} to fingerprint version {fingerprint_version}\n")
+  return rows
+
+# Evaluation matrix in a single pass: all the fingerprints are built first and every test pcap file is then extracted once and compared to all the fingerprint versions it is a test file for.
+def compare_pcap_files_to_all_fingerprints(pcap_dir, jobs, versions, time=None, backend=DEFAULT_EXTRACTION_BACKEND, workers=1, rebuild_fingerprints=False, write_diffs=True, compute_features=False):
+  rows = []
+  result_dir = create_result_dir(pcap_dir)
+  fingerprints = {}
+  fingerprint_versions_by_file = {}
+  for job in jobs:
+    fingerprint_version = job.get('version')
+    fingerprint_pcap_files, test_pcap_files, _ = choose_files(pcap_dir=pcap_dir, fingerprint_version=fingerprint_version, test_versions=versions)
+    fingerprints[fingerprint_version] = load_or_create_version_fingerprint(pcap_dir=pcap_dir, fingerprint_version=fingerprint_version, pcap_files=fingerprint_pcap_files, time=time, backend=backend, workers=workers, rebuild=rebuild_fingerprints)
+    for pcap_file in test_pcap_files:
+      fingerprint_versions_by_file.setdefault(os.path.join(pcap_dir, pcap_file), []).append(fingerprint_version)
+
+  pcap_files = sorted(fingerprint_versions_by_file)
+  for pcap_file, packets in extract_pcaps(pcap_files, time=time, backend=backend, workers=workers):
+    fingerprint_versions = fingerprint_versions_by_file[pcap_file]
+    print(f"Comparing {pcap_file} to fingerprint versions {fingerprint_versions}")
+    rows.extend(compare_pcap_to_fingerprints(fingerprints={v: fingerprints[v] for v in fingerprint_versions}, pcap_file=pcap_file, result_dir=result_dir, time=time, backend=backend, packets=packets, write_diffs=write_diffs, compute_features=compute_features) or [])
+    print(f"Finished comparing {pcap_file} to fingerprint versions {fingerprint_versions}\n")
+  return rows
 
 def load_configuration(config_file, pcap_dir):
   # Load configuration from JSON file. If config file is not provided, use the default config.json in the pcap directory
@@ -299,21 +514,36 @@ def load_configuration(config_file, pcap_dir):
 
   return jobs, versions
 
-def main(pcap_dir, config_file = None, time=None):
+def main(pcap_dir, config_file = None, time=None, backend=DEFAULT_EXTRACTION_BACKEND, use_cache=True, cache_size_mb=DEFAULT_MAX_SIZE_MB, workers=1, rebuild_fingerprints=False, single_pass=False, features_only=False, keep_diffs=False):
+  global packet_cache
   now = datetime.now()
 
+  if use_cache:
+    packet_cache = PacketCache(os.path.join(pcap_dir, CACHE_DIR_NAME), max_size_mb=cache_size_mb)
+
   jobs, versions = load_configuration(config_file=config_file, pcap_dir=pcap_dir)
 
-  for job in jobs:
-    fingerprint_version = job.get('version')
-    print(f"Comparing fingerprint version {fingerprint_version} to the following versions: {versions}")
-    fingerprint_pcap_files, test_pcap_files, result_dir = choose_files(pcap_dir=pcap_dir, fingerprint_version=fingerprint_version, test_versions=versions)
-    fingerprint = create_version_fingerprint(pcap_files=fingerprint_pcap_files, time=time)
-    compare_pcap_files_to_fingerprint(fingerprint=fingerprint, fingerprint_version=fingerprint_version, pcap_files=test_pcap_files, result_dir=result_dir, pcap_dir=pcap_dir, time=time)
+  # With features_only the aggregated results are computed during the comparison and the comparison files are only written with keep_diffs
+  write_diffs = not features_only or keep_diffs
+  rows = []
+
+  if single_pass:
+    rows = compare_pcap_files_to_all_fingerprints(pcap_dir=pcap_dir, jobs=jobs, versions=versions, time=time, backend=backend, workers=workers, rebuild_fingerprints=rebuild_fingerprints, write_diffs=write_diffs, compute_features=features_only)
+  else:
+    for job in jobs:
+      fingerprint_version = job.get('version')
+      print(f"Comparing fingerprint version {fingerprint_version} to the following versions: {versions}")
+      fingerprint_pcap_files, test_pcap_files, result_dir = choose_files(pcap_dir=pcap_dir, fingerprint_version=fingerprint_version, test_versions=versions)
+      fingerprint = load_or_create_version_fingerprint(pcap_dir=pcap_dir, fingerprint_version=fingerprint_version, pcap_files=fingerprint_pcap_files, time=time, backend=backend, workers=workers, rebuild=rebuild_fingerprints)
+      rows.extend(compare_pcap_files_to_fingerprint(fingerprint=fingerprint, fingerprint_version=fingerprint_version, pcap_files=test_pcap_files, result_dir=result_dir, pcap_dir=pcap_dir, time=time, backend=backend, workers=workers, write_diffs=write_diffs, compute_features=features_only))
 
   # Aggregate the differences
-  result_dir = os.path.join(pcap_dir, 'fingerprint_comparison')
-  aggregate_diffs(result_dir)
+  result_dir = create_result_dir(pcap_dir)
+  with metrics.stage('aggregate_diffs'):
+    if features_only:
+      write_aggregated_results(result_dir, rows)
+    else:
+      aggregate_diffs(result_dir, workers=workers)
 
   print('---------------------------------')
   print(f"Completed. Time taken: {datetime.now() - now}")
@@ -323,9 +553,34 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Detect Helm chart version change.')
   parser.add_argument('pcap_dir', type=str, help='Directory containing the PCAP files')
   parser.add_argument('-c', '--config_file_path', required=False, type=str, help='Path to the JSON configuration file')
+  parser.add_argument('-b', '--backend', required=False, type=str, choices=EXTRACTION_BACKENDS, default=DEFAULT_EXTRACTION_BACKEND, help='Packet extraction backend. pyshark and tshark use tshark for dissection (tshark streams only the needed fields and is faster), raw parses the pcap files directly without tshark')
+  parser.add_argument('-t', '--time', required=False, type=float, help='Only use the packets captured within the first TIME seconds of every PCAP file')
+  parser.add_argument('-w', '--workers', required=False, type=int, default=1, help='Number of processes used to extract the packets from the PCAP files in parallel')
+  parser.add_argument('-s', '--single_pass', action='store_true', help='Build all the fingerprints first and extract every test PCAP file only once, comparing it to all the fingerprints in the same pass')
+  parser.add_argument('-f', '--features_only', action='store_true', help='Compute the aggregated results while comparing, without writing the comparison CSV and PCAP files and reading them back')
+  parser.add_argument('--keep_diffs', action='store_true', help='With --features_only, still write the comparison CSV and PCAP files')
+  parser.add_argument('-u', '--update_fingerprint', required=False, type=str, metavar='VERSION', help='Only update the saved fingerprint of the given version with the PCAP files given with --pcap_files, then exit')
+  parser.add_argument('--pcap_files', required=False, type=str, nargs='+', default=[], help='PCAP files used with --update_fingerprint')
+  parser.add_argument('--rebuild_fingerprints', action='store_true', help='Rebuild the version fingerprints even if matching fingerprint files exist')
+  parser.add_argument('--no_cache', action='store_true', help='Do not use the persistent cache of extracted packets')
+  parser.add_argument('--metrics_file', required=False, type=str, help='Write stage timings, packet counters and peak memory to this file')
+  parser.add_argument('--metrics_format', required=False, type=str, choices=metrics.METRICS_FORMATS, default='jsonl', help='Format of the metrics file: JSON lines, or a Prometheus textfile')
+  parser.add_argument('--cache_size_mb', required=False, type=int, default=DEFAULT_MAX_SIZE_MB, help='Maximum size of the extracted packets cache in megabytes')
 
   args = parser.parse_args()
   pcap_dir = args.pcap_dir
   config_file = args.config_file_path
+  backend = args.backend
+
+  if args.metrics_file:
+    metrics.enable(args.metrics_file, format=args.metrics_format)
+
+  if args.update_fingerprint:
+    if not args.pcap_files:
+      parser.error('--update_fingerprint requires --pcap_files')
+    if not os.path.exists(fingerprint_path(pcap_dir, args.update_fingerprint)):
+      parser.error(f'There is no saved fingerprint for version {args.update_fingerprint} in {fingerprint_path(pcap_dir, args.update_fingerprint)}. Build it first by running fingerprint.py without --update_fingerprint')
+    update_fingerprint_file(pcap_dir=pcap_dir, fingerprint_version=args.update_fingerprint, pcap_files=args.pcap_files, workers=args.workers)
+    exit(0)
 
-  main(config_file=config_file, pcap_dir=pcap_dir)
\ No newline at end of file
+  main(config_file=config_file, pcap_dir=pcap_dir, time=args.time, backend=backend, use_cache=not args.no_cache, cache_size_mb=args.cache_size_mb, workers=args.workers, rebuild_fingerprints=args.rebuild_fingerprints, single_pass=args.single_pass, features_only=args.features_only, keep_diffs=args.keep_diffs)
\ No newline at end of file
@@ -0,0 +1,232 @@
+import argparse
+import json
+import os
+import sys
+import time as time_module
+from datetime import datetime
+from fingerprint import build_fingerprint_lookup
+from utils.diff_features import DiffFeatures
+from utils.fingerprint_store import load_fingerprints as load_saved_fingerprints
+from utils.pcap_reader import PcapStream, decode_packet
+
+# Online version detection. Packets are read from a capture that is still running (a growing pcap file or the output of
+# tcpdump -w - on stdin), compared to the saved version fingerprints as they arrive and a verdict is printed at a fixed
+# interval. The per fingerprint features are the same ones utils/aggregate_diffs.py computes from the comparison CSV
+# files written by fingerprint.py, but they are updated packet by packet and nothing is written to disk.
+#
+# Only the incomplete tail of the stream and the distinct difference rows (as hashes) are kept, but the distinct rows
+# grow with the length of the capture when the payloads keep changing. With --tumbling the counters are reset after
+# every verdict, which keeps the memory use bounded by the traffic of one interval. Use it for captures that run for
+# a long time.
+#
+# With --progressive the capture is classified in growing time windows (e.g. 5s, 10s, 20s, ... of capture time) and
+# reading stops as soon as the verdict margin reaches --margin_threshold. Every window continues from the counters of
+# the previous one, so each packet is decoded and compared only once.
+
+DEFAULT_INTERVAL = 10
+DEFAULT_MARGIN_THRESHOLD = 0.1
+DEFAULT_POLL_INTERVAL = 0.5
+READ_SIZE = 1 << 16
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+# Load the saved fingerprints (see fingerprint.py) of the given versions, or all the saved fingerprints if versions is empty
+def load_fingerprints(pcap_dir, versions=None):
+    fingerprints = {}
+    for fingerprint_version, (fingerprint, header) in load_saved_fingerprints(pcap_dir, versions).items():
+        if header.get('backend') != 'raw':
+            log(f"Warning: fingerprint {fingerprint_version} was built with the {header.get('backend')} backend, the stream is decoded with the raw backend and some protocol names may differ")
+        fingerprints[fingerprint_version] = fingerprint
+    return fingerprints
+
+class StreamClassifier:
+    def __init__(self, fingerprints):
+        self.fingerprints = fingerprints
+        self.versions = list(fingerprints)
+        self.lookup = build_fingerprint_lookup(fingerprints)
+        self.fingerprint_indices = {} # (fingerprint index, key) -> written fingerprint_indices value, the same for every packet
+        self.flows = {} # Unfinished HTTP messages per TCP flow, see decode_packet. Flows continue over the window boundaries
+        self.reset()
+
+    def reset(self):
+        self.features = [DiffFeatures() for _ in self.versions]
+        self.remaining_common_packets = [self.fingerprints[v]['common_packets'].copy() for v in self.versions]
+        self.packets = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def add_record(self, record):
+        if self.first_timestamp is None:
+            self.first_timestamp = record.timestamp
+        self.last_timestamp = record.timestamp
+        proto, payload = decode_packet(record.linktype, record.data, self.flows)
+        self.add_packet(proto, payload.decode('latin-1'))
+
+    # Same comparison as compare_pcap_to_fingerprints in fingerprint.py, with the rows going to the feature counters
+    def add_packet(self, proto, payload):
+        self.packets += 1
+        length = len(payload)
+        key = (proto, length)
+        known = set()
+        for i, fingerprint_entry, is_common in self.lookup.get(key, ()):
+            known.add(i)
+            self.remaining_common_packets[i].discard(key)
+            if not is_common:
+                continue
+
+            diffs = fingerprint_entry.find_diffs(payload)
+            if len(diffs) > 0:
+                if (i, key) not in self.fingerprint_indices:
+                    self.fingerprint_indices[(i, key)] = str(fingerprint_entry.common_payload_indices)
+                self.features[i].add(proto=proto, length=length, payload=payload, new_packet=False, missing_packet=False, diff_indices=diffs, fingerprint_indices=self.fingerprint_indices[(i, key)])
+
+        if len(known) < len(self.versions):
+            for i in range(len(self.versions)):
+                if i not in known:
+                    self.features[i].add(proto=proto, length=length, payload=payload, new_packet=True, missing_packet=False)
+
+    # Features against every fingerprint so far and the verdict. The fingerprint packets that have not been seen yet
+    # are counted as missing, the same as if the capture ended now. The verdict is the version with the highest share
+    # of packets that match its fingerprint (benign_packets_%), margin is the difference to the second best version.
+    def summary(self, capture_name):
+        results = []
+        for i, fingerprint_version in enumerate(self.versions):
+            fingerprint = self.fingerprints[fingerprint_version]
+            missing_packets = [(proto, length, fingerprint[(proto, length)].reference_payload_str) for proto, length in self.remaining_common_packets[i]]
+            self.features[i].total_packets = self.packets
+            results.append(self.features[i].features(filename=f"{fingerprint_version}_to_{capture_name}", missing_packets=missing_packets))
+
+        ranking = sorted(range(len(self.versions)), key=lambda i: results[i]['benign_packets_%'], reverse=True)
+        best = ranking[0]
+        margin = results[best]['benign_packets_%'] - results[ranking[1]]['benign_packets_%'] if len(ranking) > 1 else results[best]['benign_packets_%']
+        return {
+            'time': datetime.now().isoformat(),
+            'packets': self.packets,
+            'capture_duration': self.last_timestamp - self.first_timestamp if self.packets else 0,
+            'verdict': self.versions[best] if self.packets else None,
+            'margin': margin if self.packets else 0,
+            'features': results,
+        }
+
+# Read a capture in chunks. '-' reads from stdin. With follow the file is polled for new data after reaching its end
+# (like tail -f) and empty chunks are yielded while waiting, so that the caller can keep its timers going.
+def read_chunks(source, follow=False, poll_interval=DEFAULT_POLL_INTERVAL):
+    if source == '-':
+        stream = sys.stdin.buffer
+        read = getattr(stream, 'read1', stream.read)
+        while True:
+            chunk = read(READ_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    with open(source, 'rb') as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if chunk:
+                yield chunk
+            elif follow:
+                time_module.sleep(poll_interval)
+                yield b''
+            else:
+                return
+
+def read_records(source, follow=False):
+    stream = PcapStream()
+    for chunk in read_chunks(source, follow=follow):
+        yield from stream.feed(chunk)
+
+# Classify the packets in windows of first_window, 2 * first_window, 4 * first_window, ... seconds from the first packet.
+# Returns the result of every window, the last one is the decision. A window is evaluated once the first packet past it
+# arrives, so it contains exactly the packets that a time cutoff of the same length would keep. If the margin never
+# reaches the threshold, the last result covers the whole capture (or max_window) and has decided set to False.
+def classify_progressive(classifier, records, capture_name, first_window, margin_threshold=DEFAULT_MARGIN_THRESHOLD, max_window=None):
+    started = time_module.monotonic()
+    window = first_window
+    results = []
+
+    def evaluate(window, decided):
+        result = classifier.summary(capture_name)
+        result.update({'window': window, 'decided': decided, 'time_to_decision': window if decided else None, 'elapsed': time_module.monotonic() - started})
+        results.append(result)
+        return result
+
+    evaluated_packets = 0
+    for record in records:
+        while classifier.packets and record.timestamp - classifier.first_timestamp >= window:
+            # Windows without new packets (a gap in the capture) would give the same result again
+            if classifier.packets > evaluated_packets:
+                evaluated_packets = classifier.packets
+                result = evaluate(window, decided=False)
+                if result['margin'] >= margin_threshold:
+                    result.update({'decided': True, 'time_to_decision': window})
+                    return results
+            if max_window and window * 2 > max_window:
+                return results
+            window *= 2
+        classifier.add_record(record)
+
+    # The capture ended before the margin was reached, use everything
+    result = evaluate(classifier.last_timestamp - classifier.first_timestamp if classifier.packets else 0, decided=False)
+    if classifier.packets and result['margin'] >= margin_threshold:
+        result.update({'decided': True, 'time_to_decision': result['window']})
+    return results
+
+def emit(result, output_file):
+    line = json.dumps(result)
+    print(line, flush=True)
+    if output_file:
+        with open(output_file, 'a') as f:
+            f.write(line + '\n')
+
+def main(pcap_dir, source, versions=None, interval=DEFAULT_INTERVAL, follow=False, tumbling=False, output_file=None, name=None, first_window=None, margin_threshold=DEFAULT_MARGIN_THRESHOLD, max_window=None):
+    fingerprints = load_fingerprints(pcap_dir, versions)
+    log(f"Loaded fingerprints: {list(fingerprints)}")
+
+    capture_name = name or ('stream' if source == '-' else os.path.splitext(os.path.basename(source))[0])
+    classifier = StreamClassifier(fingerprints)
+
+    if first_window:
+        for result in classify_progressive(classifier, read_records(source, follow=follow), capture_name, first_window=first_window, margin_threshold=margin_threshold, max_window=max_window):
+            emit(result, output_file)
+        if result['decided']:
+            log(f"Decided {result['verdict']} after {result['time_to_decision']} seconds of capture ({result['packets']} packets, {result['elapsed']:.2f} seconds to process)")
+        else:
+            log(f"No decision, the margin stayed below {margin_threshold}")
+        return
+
+    stream = PcapStream()
+    next_report = time_module.monotonic() + interval if interval else None
+    try:
+        for chunk in read_chunks(source, follow=follow):
+            for record in stream.feed(chunk):
+                classifier.add_record(record)
+
+            # Stdin blocks until tcpdump writes something, so a quiet capture delays the report until the next packet
+            if next_report is not None and time_module.monotonic() >= next_report:
+                emit(classifier.summary(capture_name), output_file)
+                if tumbling:
+                    classifier.reset()
+                next_report = time_module.monotonic() + interval
+    except KeyboardInterrupt:
+        pass
+
+    emit(classifier.summary(capture_name), output_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Detect the Helm chart version of a running capture using the saved version fingerprints.')
+    parser.add_argument('pcap_dir', type=str, help='Directory containing the PCAP files and the saved fingerprints (fingerprints folder)')
+    parser.add_argument('source', type=str, help="PCAP file to read, or - to read from stdin (e.g. tcpdump -U -w - | python monitor.py <pcap_dir> -)")
+    parser.add_argument('-v', '--versions', required=False, type=str, nargs='+', default=[], help='Only compare against the fingerprints of these versions')
+    parser.add_argument('-i', '--interval', required=False, type=float, default=DEFAULT_INTERVAL, help='Seconds between verdicts. 0 prints only the final verdict')
+    parser.add_argument('-f', '--follow', action='store_true', help='Keep reading the PCAP file as it grows, until interrupted')
+    parser.add_argument('-t', '--tumbling', action='store_true', help='Reset the counters after every verdict, so every verdict only covers the last interval. Keeps the memory use bounded on long captures')
+    parser.add_argument('-o', '--output_file', required=False, type=str, help='Also append the verdicts as JSON lines to this file')
+    parser.add_argument('-p', '--progressive', required=False, type=float, metavar='FIRST_WINDOW', help='Classify in doubling windows of capture time starting from FIRST_WINDOW seconds and stop once the margin reaches --margin_threshold')
+    parser.add_argument('-m', '--margin_threshold', required=False, type=float, default=DEFAULT_MARGIN_THRESHOLD, help='Verdict margin needed to stop early with --progressive')
+    parser.add_argument('--max_window', required=False, type=float, help='Largest window tried with --progressive')
+    parser.add_argument('-n', '--name', required=False, type=str, help='Name of the capture used in the feature filenames')
+
+    args = parser.parse_args()
+    main(pcap_dir=args.pcap_dir, source=args.source, versions=args.versions, interval=args.interval, follow=args.follow, tumbling=args.tumbling, output_file=args.output_file, name=args.name, first_window=args.progressive, margin_threshold=args.margin_threshold, max_window=args.max_window)
@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+import time as time_module
+from datetime import datetime
+import numpy as np
+from fingerprint import compare_pcap_to_fingerprints, extract_pcap
+from utils import metrics
+from utils.fingerprint_store import load_fingerprints
+from utils.forest_arrays import CLASSES, ForestEvaluator
+from utils.model_store import load_forests, model_dir
+
+# Classify new captures with the saved version fingerprints (fingerprint.py) and classifiers (classify.py), without
+# training anything. A capture is compared to the fingerprint of every version that has a saved classifier, the same
+# way fingerprint.py --features_only compares the test captures, and the features of each comparison are scored with
+# the classifier of that version. The probability of a version is its classifier's confidence that the capture comes
+# from that version, the verdict is the version with the highest probability.
+#
+# The classifiers are loaded as node arrays and all the captures are scored against all the versions in one call to
+# utils/forest_arrays.ForestEvaluator, which gives the same probabilities as scikit-learn.
+
+COMPARISON_DIR_NAME = 'fingerprint_comparison'
+
+# Load the saved classifiers and the fingerprints of their versions
+def load(pcap_dir, versions=None, models_dir=None):
+    models_dir = models_dir or model_dir(os.path.join(pcap_dir, COMPARISON_DIR_NAME))
+    with metrics.stage('load_models') as stage:
+        forests, index = load_forests(models_dir, versions)
+        stage.add(models=len(forests))
+    if not forests:
+        raise FileNotFoundError(f"No saved models for the versions {versions} in {models_dir}")
+
+    fingerprints = load_fingerprints(pcap_dir, list(forests))
+    for fingerprint_version in list(forests):
+        if fingerprint_version not in fingerprints:
+            print(f"Warning: no saved fingerprint for version {fingerprint_version}, it is not scored")
+            del forests[fingerprint_version]
+    return ForestEvaluator(forests), index, fingerprints
+
+# The aggregated results row of the capture compared to every fingerprint: {fingerprint_version: row}. The capture is
+# extracted with the time cutoff and backend the fingerprints were built with.
+def compare_capture(fingerprints, pcap_file, name=None):
+    versions_by_parameters = {}
+    for fingerprint_version, (_, header) in fingerprints.items():
+        versions_by_parameters.setdefault((header.get('time'), header.get('backend')), []).append(fingerprint_version)
+
+    capture_name = name or os.path.splitext(os.path.basename(pcap_file))[0]
+    rows = {}
+    for (time, backend), parameter_versions in versions_by_parameters.items():
+        packets = extract_pcap(pcap_file, time=time, backend=backend)
+        version_rows = compare_pcap_to_fingerprints(fingerprints={v: fingerprints[v][0] for v in parameter_versions}, pcap_file=pcap_file, result_dir=None, time=time, backend=backend, packets=packets, write_diffs=False, compute_features=True, new_version=capture_name)
+        rows.update(zip(parameter_versions, version_rows))
+    return rows
+
+# Probability of the is_same_version class for every capture and version, shape (captures, versions). rows is a list
+# with the {fingerprint_version: row} of every capture.
+def score(evaluator, feature_columns, rows):
+    X = np.array([[[capture_rows[v][column] for column in feature_columns] for v in evaluator.names] for capture_rows in rows], dtype=np.float64)
+    return evaluator.predict_proba(X)[:, :, CLASSES.index(1)]
+
+def predict(pcap_dir, pcap_files, versions=None, models_dir=None, name=None):
+    started = time_module.perf_counter()
+    evaluator, index, fingerprints = load(pcap_dir, versions, models_dir)
+    load_seconds = time_module.perf_counter() - started
+
+    rows = []
+    compare_seconds = []
+    for pcap_file in pcap_files:
+        print(f"Comparing {pcap_file}")
+        start = time_module.perf_counter()
+        rows.append(compare_capture(fingerprints, pcap_file, name=name))
+        compare_seconds.append(time_module.perf_counter() - start)
+
+    start = time_module.perf_counter()
+    with metrics.stage('score', captures=len(pcap_files)) as stage:
+        probabilities = score(evaluator, index['feature_columns'], rows)
+        stage.add(rows=probabilities.size)
+    score_seconds = time_module.perf_counter() - start
+
+    results = []
+    for pcap_file, capture_rows, capture_probabilities, seconds in zip(pcap_files, rows, probabilities, compare_seconds):
+        version_probabilities = dict(zip(evaluator.names, capture_probabilities.tolist()))
+        ranking = sorted(version_probabilities, key=version_probabilities.get, reverse=True)
+        results.append({
+            'time': datetime.now().isoformat(),
+            'capture': pcap_file,
+            'verdict': ranking[0],
+            'probability': version_probabilities[ranking[0]],
+            'margin': version_probabilities[ranking[0]] - version_probabilities[ranking[1]] if len(ranking) > 1 else version_probabilities[ranking[0]],
+            'probabilities': version_probabilities,
+            'features': [capture_rows[v] for v in evaluator.names],
+            'seconds': {'load': load_seconds, 'compare': seconds, 'score': score_seconds},
+        })
+    return results
+
+def main(pcap_dir, pcap_files, versions=None, models_dir=None, name=None, output_file=None):
+    for result in predict(pcap_dir, pcap_files, versions=versions, models_dir=models_dir, name=name):
+        print(f"\n{result['capture']}")
+        for fingerprint_version in sorted(result['probabilities'], key=result['probabilities'].get, reverse=True):
+            print(f"Version: {fingerprint_version}, Probability: {result['probabilities'][fingerprint_version]:.3f}")
+        print(f"Verdict: {result['verdict']} (margin {result['margin']:.3f}, {result['seconds']['compare']:.2f} seconds to compare)")
+
+        if output_file:
+            with open(output_file, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Detect the Helm chart version of a capture using the saved fingerprints and classifiers.')
+    parser.add_argument('pcap_dir', type=str, help='Directory containing the saved fingerprints (fingerprints folder) and classifiers (fingerprint_comparison/models folder)')
+    parser.add_argument('pcap_files', type=str, nargs='+', help='PCAP files to classify')
+    parser.add_argument('-v', '--versions', required=False, type=str, nargs='+', default=[], help='Only score these versions')
+    parser.add_argument('-m', '--models_dir', required=False, type=str, help='Folder of the saved classifiers, fingerprint_comparison/models inside pcap_dir by default')
+    parser.add_argument('-n', '--name', required=False, type=str, help='Name of the capture used in the feature filenames')
+    parser.add_argument('-o', '--output_file', required=False, type=str, help='Also append the results as JSON lines to this file')
+    parser.add_argument('--metrics_file', required=False, type=str, help='Write stage timings and peak memory to this file')
+    parser.add_argument('--metrics_format', required=False, type=str, choices=metrics.METRICS_FORMATS, default='jsonl', help='Format of the metrics file: JSON lines, or a Prometheus textfile')
+
+    args = parser.parse_args()
+    if args.metrics_file:
+        metrics.enable(args.metrics_file, format=args.metrics_format)
+    main(pcap_dir=args.pcap_dir, pcap_files=args.pcap_files, versions=args.versions, models_dir=args.models_dir, name=args.name, output_file=args.output_file)
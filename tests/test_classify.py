@@ -0,0 +1,59 @@
+import os
+import numpy as np
+import pandas as pd
+import classify
+from utils.aggregate_diffs import aggregate_filename, fieldnames
+from utils.incremental_forest import IncrementalForest, load_state, state_dir
+
+VERSIONS = ['1.0.0', '1.1.0', '2.0.0']
+
+# aggregated_results.csv rows of every fingerprint version compared to the given runs of every version. The rows of
+# the same version have fewer new packets, so the classifiers have something to learn.
+def aggregated_rows(runs, seed):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for fingerprint_version in VERSIONS:
+        for compared_version in VERSIONS:
+            for run in runs:
+                same = fingerprint_version == compared_version
+                row = {column: rng.integers(0, 1000) for column in fieldnames if column != 'filename'}
+                row['filename'] = f"{fingerprint_version}_to_{compared_version}_{run}.csv"
+                row['number_of_new_packets'] = rng.integers(0, 50) if same else rng.integers(30, 200)
+                rows.append(row)
+    return pd.DataFrame(rows, columns=fieldnames)
+
+def test_first_incremental_run_matches_classify(tmp_path):
+    file_path = str(tmp_path / aggregate_filename)
+    aggregated_rows(range(1, 13), seed=0).to_csv(file_path, index=False)
+
+    classify.classify(file_path, save_models=False)
+    classify.classify_incremental(file_path)
+
+    batch = pd.read_csv(tmp_path / 'prediction_results.csv')
+    incremental = pd.read_csv(os.path.join(state_dir(str(tmp_path)), 'prediction_results.csv'))
+    pd.testing.assert_frame_equal(incremental, batch)
+
+# A second run trains new trees on the appended rows only and keeps the trees of the first run
+def test_second_incremental_run_trains_on_new_rows(tmp_path, monkeypatch):
+    file_path = str(tmp_path / aggregate_filename)
+    first = aggregated_rows(range(1, 9), seed=1)
+    first.to_csv(file_path, index=False)
+    classify.classify_incremental(file_path, trees_per_batch=10)
+    first_forests = {version: load_state(state_dir(str(tmp_path)), version).forests[0] for version in VERSIONS}
+
+    added = aggregated_rows(range(9, 13), seed=2)
+    pd.concat([first, added]).to_csv(file_path, index=False)
+    batches = {}
+    add_batch = IncrementalForest.add_batch
+    def recording_add_batch(self, X, y, filenames, n_jobs=1):
+        batches[filenames[0].split('_to_')[0]] = set(filenames)
+        return add_batch(self, X, y, filenames, n_jobs=n_jobs)
+    monkeypatch.setattr(IncrementalForest, 'add_batch', recording_add_batch)
+    classify.classify_incremental(file_path, trees_per_batch=10)
+
+    X = first[[column for column in fieldnames if column != 'filename']].to_numpy(dtype=np.float64)
+    for version in VERSIONS:
+        assert batches[version] == set(added['filename'][added['filename'].str.startswith(f"{version}_to_")])
+        forest = load_state(state_dir(str(tmp_path)), version)
+        assert forest.batches == 2 and forest.n_trees == 20
+        assert np.array_equal(forest.forests[0].predict_proba(X), first_forests[version].predict_proba(X))
@@ -0,0 +1,24 @@
+import pandas as pd
+from fingerprint import escape_csv_delimiter
+from utils.diff_writer import DIFF_COLUMNS, DiffWriter
+
+PAYLOADS = ['plain', 'a,b,c', 'say "hi"', 'line\nbreak', 'cr\r\nlf', 'back\\slash', '\\"both", \n', '', 'é̶⠀']
+
+def rows():
+    for number, payload in enumerate(PAYLOADS, start=1):
+        # The payload columns the way add_diff_packet writes them, and the raw payload too
+        yield [number, len(PAYLOADS), 'HTTP', len(payload), False, False, escape_csv_delimiter(payload), escape_csv_delimiter(payload), payload, [0, 2], str({0, 1, 2})]
+        yield [number, len(PAYLOADS), 'DATA', len(payload), True, False, payload, '', '', '', '']
+
+# DiffWriter writes the same bytes as the DataFrame.to_csv call it replaced, also across several batches
+def test_diff_writer_matches_pandas(tmp_path):
+    expected_file = tmp_path / 'pandas.csv'
+    pd.DataFrame(list(rows()), columns=DIFF_COLUMNS).to_csv(expected_file, index=False, escapechar='\\')
+
+    written_file = tmp_path / 'writer.csv'
+    with DiffWriter(str(written_file), batch_size=4) as writer:
+        for row in rows():
+            writer.write(row)
+
+    assert writer.rows_written == 2 * len(PAYLOADS)
+    assert written_file.read_bytes() == expected_file.read_bytes()
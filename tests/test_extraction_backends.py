@@ -0,0 +1,59 @@
+import shutil
+import pytest
+from scapy.all import DNS, DNSQR, IP, TCP, UDP, VXLAN, ARP, Ether, IPv6, Raw, wrpcap
+from fingerprint import extract_pcap
+
+JSON_BODY = b'{"status": "ok", "version": "1.2.3"}'
+TEXT_BODY = b'ok\nready\n'
+LARGE_BODY = b'{"items": [' + b', '.join(b'"item-%d"' % i for i in range(200)) + b']}'
+
+def http_response(content_type, body):
+    return b'HTTP/1.1 200 OK\r\nContent-Type: ' + content_type + b'\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body
+
+def tcp(payload, sport=8080, dport=43000, seq=1000, src='10.0.0.2', dst='10.0.0.1'):
+    return Ether() / IP(src=src, dst=dst) / TCP(sport=sport, dport=dport, flags='PA', seq=seq) / Raw(payload)
+
+# Frames that cover the cases where a port/payload heuristic is most likely to drift from tshark, (frame, raw proto)
+def capture_frames():
+    large_response = http_response(b'application/json', LARGE_BODY)
+    first, second, third = large_response[:500], large_response[500:1000], large_response[1000:]
+    inner = Ether() / IP(src='10.1.0.1', dst='10.1.0.2') / TCP(sport=43001, dport=8080, flags='PA', seq=1) / Raw(b'GET /healthz HTTP/1.1\r\nHost: app\r\n\r\n')
+    return [
+        (Ether() / IP(src='10.0.0.1', dst='10.0.0.2') / TCP(sport=43000, dport=8080, flags='S'), 'TCP'),
+        (tcp(b'GET /status HTTP/1.1\r\nHost: app\r\n\r\n', sport=43000, dport=8080, src='10.0.0.1', dst='10.0.0.2'), 'HTTP'),
+        (tcp(http_response(b'application/json', JSON_BODY)), 'JSON'),
+        (tcp(http_response(b'text/plain; charset=utf-8', TEXT_BODY), seq=2000), 'DATA-TEXT-LINES'),
+        (tcp(b'HTTP/1.1 204 No Content\r\nContent-Length: 0\r\n\r\n', seq=3000), 'HTTP'),
+        # A response split over three segments, tshark names only the last one after the reassembled message
+        (tcp(first, sport=8081, seq=5000), 'TCP'),
+        (tcp(second, sport=8081, seq=5000 + len(first)), 'TCP'),
+        (tcp(third, sport=8081, seq=5000 + len(first) + len(second)), 'JSON'),
+        (Ether() / IP(src='10.0.0.3', dst='10.0.0.4') / UDP(sport=40000, dport=4789) / VXLAN(vni=1) / inner, 'HTTP'),
+        (Ether() / IP(src='10.0.0.1', dst='10.0.0.53') / UDP(sport=5000, dport=53) / DNS(qd=DNSQR(qname='app.default.svc')), 'DNS'),
+        (Ether() / IPv6() / TCP(sport=40001, dport=443, flags='PA') / Raw(bytes([23, 3, 3, 0, 5]) + b'abcde'), 'TLS'),
+        (Ether() / ARP(), 'ARP'),
+    ]
+
+@pytest.fixture(scope='module')
+def capture(tmp_path_factory):
+    pcap_file = str(tmp_path_factory.mktemp('backends') / 'capture.pcap')
+    frames = [frame for frame, _ in capture_frames()]
+    for i, frame in enumerate(frames):
+        frame.time = 1000 + i * 0.01
+    wrpcap(pcap_file, frames)
+    return pcap_file
+
+def test_raw_backend_protocols(capture):
+    packets = extract_pcap(capture, backend='raw')
+    assert [proto for proto, _, _, _ in packets] == [proto for _, proto in capture_frames()]
+    for (_, length, payload, number), (frame, _) in zip(packets, capture_frames()):
+        transport = frame[UDP] if UDP in frame else frame[TCP] if TCP in frame else None # The outer UDP header of the VXLAN frame
+        expected = bytes(transport.payload) if transport is not None else b''
+        assert payload.encode('latin-1') == expected, number
+        assert length == len(expected)
+
+@pytest.mark.skipif(shutil.which('tshark') is None, reason='tshark is not installed')
+def test_raw_backend_matches_pyshark(capture):
+    raw = [(proto, length, payload) for proto, length, payload, _ in extract_pcap(capture, backend='raw')]
+    reference = [(proto, length, payload) for proto, length, payload, _ in extract_pcap(capture, backend='pyshark')]
+    assert raw == reference
@@ -0,0 +1,37 @@
+import glob
+import os
+import pytest
+from fingerprint import compare_pcap_files_to_all_fingerprints, compare_pcap_to_fingerprint, create_version_fingerprint, update_version_fingerprint
+from utils.synthetic_pcap import generate_dataset
+
+@pytest.fixture(scope='module')
+def pcap_files(tmp_path_factory):
+    # Few packets per capture, so that some keys are common in the first files and drop out later
+    pcap_dir = generate_dataset(str(tmp_path_factory.mktemp('fingerprint')), versions=1, runs=6, packets=40, message_types=30)
+    return sorted(glob.glob(os.path.join(pcap_dir, '*.pcap')))
+
+def summary(fingerprint):
+    return {key: (entry.packet_count, entry.file_count, None if entry.stable_indices is None else entry.stable_indices.tolist())
+            for key, entry in fingerprint.items() if key != 'common_packets'}
+
+# Updating a fingerprint gives the same fingerprint as building it from all the files at once
+@pytest.mark.parametrize('initial_files', [0, 1, 3])
+def test_update_matches_rebuild(pcap_files, initial_files):
+    rebuilt = create_version_fingerprint(pcap_files, backend='raw')
+    fingerprint = create_version_fingerprint(pcap_files[:initial_files], backend='raw') if initial_files else {}
+    updated = update_version_fingerprint(fingerprint, pcap_files[initial_files:], backend='raw')
+    assert updated['common_packets'] == rebuilt['common_packets']
+    assert summary(updated) == summary(rebuilt)
+
+def test_single_pass_without_jobs(tmp_path):
+    pcap_dir = str(tmp_path / 'app-20240101000000')
+    os.makedirs(pcap_dir)
+    assert compare_pcap_files_to_all_fingerprints(pcap_dir=pcap_dir, jobs=[], versions=[], backend='raw') == []
+    assert os.path.isdir(os.path.join(pcap_dir, 'fingerprint_comparison'))
+
+def test_compare_needs_an_output(pcap_files, tmp_path):
+    fingerprint = create_version_fingerprint(pcap_files[:2], backend='raw')
+    with pytest.raises(ValueError):
+        compare_pcap_to_fingerprint(fingerprint=fingerprint, pcap_file=pcap_files[2], result_dir=str(tmp_path), fingerprint_version='1.0.0', backend='raw', write_diffs=False, compute_features=False)
+    rows = compare_pcap_to_fingerprint(fingerprint=fingerprint, pcap_file=pcap_files[2], result_dir=str(tmp_path), fingerprint_version='1.0.0', backend='raw', write_diffs=False, compute_features=True)
+    assert len(rows) == 1 and not os.listdir(tmp_path)
@@ -0,0 +1,22 @@
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from utils.forest_arrays import ForestEvaluator, export_forest, load_forest, save_forest
+
+def fit(seed, n_estimators):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(200, 5))
+    y = (X[:, 0] + 0.5 * X[:, 1] * X[:, 2] + rng.normal(scale=0.3, size=200) > 0).astype(int)
+    return RandomForestClassifier(n_estimators=n_estimators, random_state=seed).fit(X, y)
+
+# The evaluator gives exactly the probabilities and classes of scikit-learn, for forests of different sizes at once
+def test_forest_evaluator_matches_scikit_learn(tmp_path):
+    models = {'1.0.0': fit(0, 10), '1.1.0': fit(1, 25)}
+    save_forest(str(tmp_path / 'forest.npz'), export_forest(models['1.1.0']))
+    evaluator = ForestEvaluator({'1.0.0': export_forest(models['1.0.0']), '1.1.0': load_forest(str(tmp_path / 'forest.npz'))})
+    X = np.random.default_rng(2).normal(size=(50, 5))
+
+    probabilities = evaluator.predict_proba(X)
+    predictions = evaluator.predict(X)
+    for i, model in enumerate(models.values()):
+        assert np.array_equal(probabilities[:, i], model.predict_proba(X))
+        assert np.array_equal(predictions[:, i], model.predict(X))
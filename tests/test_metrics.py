@@ -0,0 +1,28 @@
+import os
+import re
+import subprocess
+import sys
+import pytest
+from conftest import REPOSITORY_DIR
+from utils.synthetic_pcap import generate_dataset
+
+def stage_calls(metrics_file):
+    with open(metrics_file) as f:
+        return sorted(line for line in f if re.match(r'helm_version_stage_calls_total\{', line))
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    return generate_dataset(str(tmp_path_factory.mktemp('metrics')), versions=2, runs=4, packets=200)
+
+# The stages recorded in the extraction workers are merged into the Prometheus file of the main process
+def test_prometheus_calls_do_not_depend_on_workers(dataset, tmp_path):
+    calls = {}
+    for workers in (1, 4):
+        metrics_file = str(tmp_path / f"workers_{workers}.prom")
+        subprocess.run([sys.executable, os.path.join(REPOSITORY_DIR, 'fingerprint.py'), dataset, '-b', 'raw', '--no_cache', '-f', '--rebuild_fingerprints', '-w', str(workers),
+                        '--metrics_file', metrics_file, '--metrics_format', 'prometheus'], check=True, capture_output=True)
+        calls[workers] = stage_calls(metrics_file)
+        assert not [f for f in os.listdir(tmp_path) if f.endswith('.part')]
+
+    assert any('stage="extract_pcap"' in line for line in calls[4])
+    assert calls[1] == calls[4]
@@ -0,0 +1,18 @@
+import os
+from fingerprint import choose_files
+from utils.synthetic_pcap import generate_dataset, version_names
+
+def test_version_names_are_not_substrings():
+    for count in (3, 31, 300):
+        names = version_names(count)
+        assert len(set(names)) == count
+        assert not [(a, b) for a in names for b in names if a != b and a in b]
+
+# choose_files selects the files of a version by substring, every version gets only its own files
+def test_choose_files_with_many_versions(tmp_path):
+    pcap_dir = generate_dataset(str(tmp_path), versions=34, runs=2, packets=5)
+    names = version_names(34)
+    for version in ('01.0.0', '11.0.0'):
+        fingerprint_pcap_files, test_pcap_files, _ = choose_files(pcap_dir=pcap_dir, fingerprint_version=version, test_versions=names)
+        assert [os.path.basename(f).split('_')[1] for f in fingerprint_pcap_files] == [version]
+        assert sorted(f.split('_')[1] for f in test_pcap_files) == sorted(names)
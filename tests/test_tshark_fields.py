@@ -0,0 +1,27 @@
+from utils.tshark_fields import highest_layer, parse_line
+
+# Lines as tshark -T fields prints them: frame.number, frame.protocols, tcp.payload and udp.payload
+
+def test_parse_line_without_payload():
+    assert parse_line('3\teth:ethertype:ip:tcp\t\t\n') == ('TCP', 0, '', 3)
+    assert parse_line('4\teth:ethertype:arp\t\t\r\n') == ('ARP', 0, '', 4)
+
+def test_parse_line_tcp_payload():
+    assert parse_line('7\teth:ethertype:ip:tcp:http\t474554202f\t\n') == ('HTTP', 5, 'GET /', 7)
+
+def test_parse_line_udp_payload():
+    # Older tshark versions separate the bytes with ':'
+    assert parse_line('8\teth:ethertype:ip:udp:dns\t\t12:34:01:00\n') == ('DNS', 4, '\x12\x34\x01\x00', 8)
+
+def test_parse_line_latin1_payload():
+    assert parse_line('9\teth:ethertype:ip:tcp:data\tff00e9\t\n') == ('DATA', 3, '\xff\x00\xe9', 9)
+
+def test_highest_layer_data():
+    assert highest_layer('eth:ethertype:ip:tcp:data') == 'DATA'
+    assert highest_layer('sll:ethertype:ipv6:udp:data') == 'DATA'
+
+# The certificate dissectors are nested in the TLS layer, pyshark reports TLS as the highest layer
+def test_highest_layer_skips_certificate_layers():
+    assert highest_layer('eth:ethertype:ip:tcp:tls:x509sat:x509af:x509ce:pkix1implicit') == 'TLS'
+    assert highest_layer('eth:ethertype:ip:tcp:tls:ber') == 'TLS'
+    assert highest_layer('x509af:ber') == 'BER'
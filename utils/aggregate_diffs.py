@@ -1,7 +1,9 @@
 import argparse
 import csv
+import json
 import os
-from statistics import mean
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 # import sys
 
 # # Increase the field size limit. Uncomment if needed.
@@ -15,68 +17,131 @@ fieldnames = [
             'number_of_new_packets', 'number_of_unique_new_packets', 'number_of_missing_packets', 'avg_change_in_payload_%', 'benign_packets_%'
 ]
 
-def process_directory(directory):
-    result = []
-    for filename in os.listdir(directory):
-        if filename.endswith('.csv') and filename != aggregate_filename and filename != prediction_results_filename: # Skip the aggregated results file and prediction results
-            file_path = os.path.join(directory, filename)
-            row = process_file(file_path)
-            result.append(row)
-    
-    return result
+manifest_filename = "aggregate_manifest.json"
+READ_SIZE = 1 << 20
+
+def list_comparison_files(directory):
+    # Skip the aggregated results file and prediction results
+    return sorted(filename for filename in os.listdir(directory) if filename.endswith('.csv') and filename != aggregate_filename and filename != prediction_results_filename)
+
+def process_directory(directory, workers=1, use_manifest=True):
+    filenames = list_comparison_files(directory)
+
+    # The manifest stores the feature row of every file together with the size and modification time the file had, so
+    # only new and changed files need to be read again
+    manifest_path = os.path.join(directory, manifest_filename)
+    manifest = load_manifest(manifest_path) if use_manifest else {}
+    stats = {filename: os.stat(os.path.join(directory, filename)) for filename in filenames}
+    rows = {}
+    changed = []
+    for filename in filenames:
+        entry = manifest.get(filename)
+        stat = stats[filename]
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            rows[filename] = entry['row']
+        else:
+            changed.append(filename)
+
+    if use_manifest:
+        print(f"{len(filenames) - len(changed)} of {len(filenames)} files unchanged since the last run")
+
+    paths = [os.path.join(directory, filename) for filename in changed]
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(process_file, paths, chunksize=max(1, len(paths) // (workers * 4))))
+    else:
+        results = [process_file(path) for path in paths]
+    rows.update(zip(changed, results))
+
+    if use_manifest:
+        save_manifest(manifest_path, {filename: {'size': stats[filename].st_size, 'mtime_ns': stats[filename].st_mtime_ns, 'row': rows[filename]} for filename in filenames})
+
+    return [rows[filename] for filename in filenames]
 
-def calculate_avg_payload_change(rows): 
-    change = 0
-    total_packets_added = 0
-    for row in rows:
-        if len(row['fingerprint_indices']) > 0 and row['new_packet'] == 'False':
-            change += len(row['diff_indices']) / len(row['fingerprint_indices'])
-            total_packets_added += 1
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
 
-    return change / total_packets_added if total_packets_added > 0 else 0
+def save_manifest(manifest_path, manifest):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(manifest_path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+# Lines of a text file split the same way str.splitlines splits them, with the NUL characters removed. Reading the file
+# like this gives the same rows as splitting the whole content at once, without holding the whole file in memory.
+def iter_lines(csvfile):
+    pending = ''
+    for chunk in iter(lambda: csvfile.read(READ_SIZE), ''):
+        lines = (pending + chunk.replace('\0', '')).splitlines(keepends=True)
+        pending = lines.pop() if lines else '' # The last line may continue in the next chunk (this includes a \r that may be followed by \n)
+        for line in lines:
+            yield line.splitlines()[0]
+    if pending:
+        yield pending.splitlines()[0]
 
 def process_file(file_path):
     with open(file_path, 'r', newline='', encoding='utf-8') as csvfile:
         print(f"Processing {file_path}")
-        content = csvfile.read()
-        content_without_null = content.replace('\0', '')
-        reader = csv.DictReader(content_without_null.splitlines())
-        rows = list(reader)
-        lengths = [int(row['length']) for row in rows]
-        unique_rows = list(set([(row['proto'], row['length'], row['payload'], row['new_packet']) for row in rows]))
+        reader = csv.DictReader(iter_lines(csvfile))
+
+        number_of_packets = 0
+        total_packets = None
+        length_sum = 0
+        unique_rows = set()
         number_of_new_packets = 0
         number_of_missing_packets = 0
-        number_of_unique_new_packets = 0
+        change = 0
+        total_packets_added = 0
 
-        for row in rows:
+        # The rows are handled one at a time, only the distinct rows are kept for the unique packet count
+        for row in reader:
+            if total_packets is None:
+                total_packets = int(row['total_packets'])
+            number_of_packets += 1
+            length_sum += int(row['length'])
+            unique_rows.add((row['proto'], row['length'], row['payload'], row['new_packet']))
             if row['new_packet'] == 'True':
                 number_of_new_packets += 1
             if row['missing_packet'] == 'True':
                 number_of_missing_packets += 1
+            if len(row['fingerprint_indices']) > 0 and row['new_packet'] == 'False':
+                change += len(row['diff_indices']) / len(row['fingerprint_indices'])
+                total_packets_added += 1
+
+        number_of_unique_new_packets = sum(1 for row in unique_rows if row[3] == 'True')
 
-        for row in unique_rows:
-            if row[3] == 'True':
-                number_of_unique_new_packets += 1
-        
         return {
             'filename': os.path.basename(file_path),
-            'number_of_packets': len(rows),
+            'number_of_packets': number_of_packets,
             'number_of_unique_packets': len(unique_rows),
-            'average_length': mean(lengths) if lengths else 0,
+            'average_length': mean_of_sum(length_sum, number_of_packets),
             # 'min_length': min(lengths) if lengths else 0,
             # 'max_length': max(lengths) if lengths else 0,
             'number_of_new_packets': number_of_new_packets,
             'number_of_unique_new_packets': number_of_unique_new_packets,
             'number_of_missing_packets': number_of_missing_packets,
-            'avg_change_in_payload_%': calculate_avg_payload_change(rows),
-            'benign_packets_%': (int(rows[0]['total_packets']) - len(rows)) / int(rows[0]['total_packets']) if rows and int(rows[0]['total_packets']) else 1,
+            'avg_change_in_payload_%': change / total_packets_added if total_packets_added > 0 else 0,
+            'benign_packets_%': (total_packets - number_of_packets) / total_packets if number_of_packets and total_packets else 1,
             # 'payload_diff_min_size': min(payload_diffs) if payload_diffs else 0,
             # 'payload_diff_max_size': max(payload_diffs) if payload_diffs else 0
         }
 
-def aggregate_diffs(directory):        
-    results = process_directory(directory)
-    
+# Same value as statistics.mean of the lengths: an int when the mean is integral, otherwise the correctly rounded float
+def mean_of_sum(total, count):
+    if count == 0:
+        return 0
+    return total // count if total % count == 0 else total / count
+
+def aggregate_diffs(directory, workers=1, use_manifest=True):
+    results = process_directory(directory, workers=workers, use_manifest=use_manifest)
+    write_aggregated_results(directory, results)
+
+# Write the feature rows, e.g. the ones fingerprint.py computes while comparing with --features_only
+def write_aggregated_results(directory, results):
     # Sort results by filename
     results.sort(key=lambda x: x['filename'])
     
@@ -93,6 +158,8 @@ def aggregate_diffs(directory):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Aggregate CSV files in a directory.')
     parser.add_argument('directory', type=str, help='Directory containing CSV files')
+    parser.add_argument('-w', '--workers', required=False, type=int, default=1, help='Number of processes used to read the CSV files in parallel')
+    parser.add_argument('--no_manifest', action='store_true', help='Read all the CSV files again instead of reusing the results of unchanged files')
     args = parser.parse_args()
 
-    aggregate_diffs(args.directory)
\ No newline at end of file
+    aggregate_diffs(args.directory, workers=args.workers, use_manifest=not args.no_manifest)
\ No newline at end of file
@@ -1,16 +1,93 @@
+import argparse
+import contextlib
+import glob
 import os
+import sys
+import time as time_module
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
 
-# Read the data directory to get the list of folders
-folders = os.listdir('../data')
-folders = [os.path.join('../data', f) for f in folders if os.path.isdir(os.path.join('../data', f))]
-# Find sub folders named 'fingerprint_comparison'
-folders = [os.path.join(f, 'fingerprint_comparison') for f in folders if os.path.exists(os.path.join(f, 'fingerprint_comparison'))]
+# Classify every application in the data folder: every fingerprint_comparison/aggregated_results.csv below the data
+# root is classified with classify.py in a pool of worker processes. classify.py (and pandas and scikit-learn) is
+# imported once and the workers are forked from this process, so the import cost is not paid again for every
+# application. The output of every application goes to a classify.log file next to its aggregated_results.csv.
+#
+# The results of all the applications are combined into classification_summary.csv (the prediction_results.csv rows
+# with the application folder in the first column) and the time every application took is written to
+# classification_timing.csv, both in the data root.
 
-files = []
-# Folders appended with aggregated_results.csv
-for folder in folders:
-    files.append(os.path.join(folder, 'aggregated_results.csv'))
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR) # Also works when started from inside utils/
 
-# Run classify.py on each file (script)
-for f in files: 
-    os.system(f'python3 ../classify.py {f}')
+from classify import classify, classify_incremental # noqa: E402
+from utils.aggregate_diffs import aggregate_filename # noqa: E402
+
+DEFAULT_DATA_ROOT = os.path.join(REPOSITORY_DIR, 'data')
+SUMMARY_FILENAME = 'classification_summary.csv'
+TIMING_FILENAME = 'classification_timing.csv'
+LOG_FILENAME = 'classify.log'
+
+def find_aggregated_results(data_root):
+    return sorted(glob.glob(os.path.join(data_root, '**', 'fingerprint_comparison', aggregate_filename), recursive=True))
+
+# The application folder of an aggregated_results.csv file, relative to the data root
+def application_name(file_path, data_root):
+    return os.path.relpath(os.path.dirname(os.path.dirname(file_path)), data_root)
+
+def count_rows(file_path):
+    with open(file_path) as f:
+        return max(sum(1 for _ in f) - 1, 0)
+
+def classify_application(file_path, jobs=1, incremental=False):
+    started = time_module.perf_counter()
+    log_path = os.path.join(os.path.dirname(file_path), LOG_FILENAME)
+    try:
+        with open(log_path, 'w') as log, contextlib.redirect_stdout(log):
+            if incremental:
+                results = classify_incremental(file_path, jobs=jobs)
+            else:
+                results = classify(file_path, jobs=jobs)
+        error = None
+    except Exception as e:
+        results = []
+        error = f"{type(e).__name__}: {e}"
+    return results, {'seconds': time_module.perf_counter() - started, 'versions': len(results), 'error': error}
+
+def classify_all(data_root=DEFAULT_DATA_ROOT, workers=1, jobs=1, incremental=False):
+    files = find_aggregated_results(data_root)
+    if not files:
+        print(f"No {aggregate_filename} files found below {data_root}")
+        return
+    print(f"Classifying {len(files)} applications with {workers} workers")
+
+    summary = []
+    timing = []
+    started = time_module.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(classify_application, file_path, jobs, incremental): file_path for file_path in files}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            application = application_name(file_path, data_root)
+            results, application_timing = future.result()
+            if application_timing['error']:
+                print(f"{application}: failed after {application_timing['seconds']:.2f} seconds, {application_timing['error']}")
+            else:
+                print(f"{application}: {application_timing['versions']} versions in {application_timing['seconds']:.2f} seconds")
+            summary.extend({'application': application, **result} for result in results)
+            timing.append({'application': application, 'rows': count_rows(file_path), **application_timing})
+
+    summary.sort(key=lambda row: row['application'])
+    timing.sort(key=lambda row: row['application'])
+    pd.DataFrame(summary).to_csv(os.path.join(data_root, SUMMARY_FILENAME), index=False)
+    pd.DataFrame(timing).to_csv(os.path.join(data_root, TIMING_FILENAME), index=False)
+    print(f"Classified {len(files)} applications in {time_module.perf_counter() - started:.2f} seconds. Results written to {os.path.join(data_root, SUMMARY_FILENAME)}, timing to {os.path.join(data_root, TIMING_FILENAME)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Classify the aggregated results of every application in the data folder.')
+    parser.add_argument('data_root', type=str, nargs='?', default=DEFAULT_DATA_ROOT, help='Folder that contains the application folders, the data folder of the repository by default')
+    parser.add_argument('-w', '--workers', required=False, type=int, default=1, help='Number of applications classified in parallel')
+    parser.add_argument('-j', '--jobs', required=False, type=int, default=1, help='Number of CPUs every application uses to train its classifiers (see classify.py --jobs)')
+    parser.add_argument('-i', '--incremental', action='store_true', help='Train incrementally (see classify.py --incremental)')
+    args = parser.parse_args()
+
+    classify_all(data_root=args.data_root, workers=args.workers, jobs=args.jobs, incremental=args.incremental)
@@ -0,0 +1,85 @@
+import numpy as np
+
+# Compact representation of one (proto, length) key of a version fingerprint.
+#
+# Only one payload and the positions that are the same in every fingerprint payload are needed when a pcap file is
+# compared to the fingerprint, so the full set of payloads is not kept (unless explicitly asked for debugging). The
+# stable positions are narrowed down one file at a time while the fingerprint is being built, which means that the
+# payloads of only one file need to be held in memory at once.
+
+class FingerprintEntry:
+    __slots__ = ('reference_payload', 'stable_mask', 'stable_indices', 'packet_count', 'file_count', 'payloads')
+
+    def __init__(self, reference_payload, keep_payloads=False):
+        self.reference_payload = reference_payload.encode('latin-1')
+        self.stable_mask = np.ones(len(self.reference_payload), dtype=bool) # Only used while building
+        self.stable_indices = None # Index array of the stable positions, set by finalize
+        self.packet_count = 0
+        self.file_count = 0
+        self.payloads = set() if keep_payloads else None
+
+    # Create a finalized entry from stored arrays, e.g. views into a memory mapped fingerprint file
+    @classmethod
+    def from_arrays(cls, reference_payload, stable_indices, packet_count, file_count):
+        entry = cls.__new__(cls)
+        entry.reference_payload = reference_payload
+        entry.stable_mask = None
+        entry.stable_indices = stable_indices
+        entry.packet_count = packet_count
+        entry.file_count = file_count
+        entry.payloads = None
+        return entry
+
+    # Narrow down the stable positions with the distinct payloads of one pcap file. Works both while building (on the
+    # mask) and on a finalized entry (on the index array), which is what makes incremental fingerprint updates possible.
+    def update(self, payloads, packet_count):
+        self.packet_count += packet_count
+        self.file_count += 1
+        if self.payloads is not None:
+            self.payloads.update(payloads)
+
+        length = len(self.reference_payload)
+        if self.stable_mask is not None:
+            if length == 0 or not self.stable_mask.any():
+                return
+            stacked = np.frombuffer(''.join(payloads).encode('latin-1'), dtype=np.uint8).reshape(len(payloads), length)
+            reference = np.frombuffer(self.reference_payload, dtype=np.uint8)
+            self.stable_mask &= (stacked == reference).all(axis=0)
+        elif self.stable_indices is not None and len(self.stable_indices) > 0:
+            indices = self.stable_indices
+            stacked = np.frombuffer(''.join(payloads).encode('latin-1'), dtype=np.uint8).reshape(len(payloads), length)
+            reference = np.frombuffer(self.reference_payload, dtype=np.uint8)
+            self.stable_indices = indices[(stacked[:, indices] == reference[indices]).all(axis=0)]
+
+    # Freeze the entry. Positions are only needed for the keys that appear in every fingerprint file.
+    def finalize(self, is_common):
+        if is_common:
+            dtype = np.uint16 if len(self.reference_payload) <= np.iinfo(np.uint16).max + 1 else np.uint32
+            self.stable_indices = np.flatnonzero(self.stable_mask).astype(dtype)
+        self.stable_mask = None
+
+    @property
+    def common_payload_indices(self):
+        return set(self.stable_indices.tolist()) if self.stable_indices is not None else set()
+
+    @property
+    def reference_payload_str(self):
+        return bytes(self.reference_payload).decode('latin-1')
+
+    # Return the stable positions where the given payload differs from the fingerprint
+    def find_diffs(self, payload):
+        indices = self.stable_indices
+        if indices is None or len(indices) == 0:
+            return []
+        new = np.frombuffer(payload.encode('latin-1'), dtype=np.uint8)
+        reference = np.frombuffer(self.reference_payload, dtype=np.uint8)
+        return indices[new[indices] != reference[indices]].tolist()
+
+    def nbytes(self):
+        size = len(self.reference_payload)
+        for array in (self.stable_mask, self.stable_indices):
+            if array is not None:
+                size += array.nbytes
+        if self.payloads is not None:
+            size += sum(len(p) for p in self.payloads)
+        return size
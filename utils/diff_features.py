@@ -0,0 +1,78 @@
+# Incremental version of the per comparison features computed by utils/aggregate_diffs.py (see fieldnames there).
+#
+# Instead of reading the rows back from a comparison CSV file, the rows are added one at a time while the packets are
+# compared and the features can be read at any point. The rows themselves are not kept, but the unique packet counts
+# are exact, so the hashes of all the distinct rows are kept. Memory use grows with the number of distinct rows, which
+# for a long capture with changing payloads (timestamps, IDs) is close to the number of rows. Start a new DiffFeatures
+# to bound it, see --tumbling in monitor.py.
+#
+# The features are computed exactly like process_file computes them from the CSV, including its quirks: the payload
+# change of a packet is the length of the written diff index list divided by the length of the written fingerprint
+# index set, i.e. the lengths of their text representations. The payloads are compared the way they look after the
+# CSV round trip in process_file: NUL characters and line breaks are removed (the line breaks are lost because the file
+# is split into lines before it is parsed).
+
+import re
+
+REMOVED_CHARACTERS = re.compile('[\0\n\r\x0b\x0c\x1c\x1d\x1e\x85]')
+
+def _row_hash(proto, length, payload, new_packet):
+    return hash((proto, length, REMOVED_CHARACTERS.sub('', payload), new_packet))
+
+class DiffFeatures:
+    def __init__(self):
+        self.total_packets = 0
+        self.number_of_packets = 0
+        self.length_sum = 0
+        self.number_of_new_packets = 0
+        self.number_of_missing_packets = 0
+        self.unique_rows = set()
+        self.unique_new_rows = set()
+        self.change = 0
+        self.changed_packets = 0
+
+    # Add one difference row, the same values that are written to the comparison CSV file with add_diff_packet
+    def add(self, proto, length, payload, new_packet, missing_packet, diff_indices='', fingerprint_indices=''):
+        self.number_of_packets += 1
+        self.length_sum += length
+        row_hash = _row_hash(proto, length, payload, new_packet)
+        self.unique_rows.add(row_hash)
+        if new_packet:
+            self.number_of_new_packets += 1
+            self.unique_new_rows.add(row_hash)
+        if missing_packet:
+            self.number_of_missing_packets += 1
+
+        # Only the packets that differ from the fingerprint have both index columns filled
+        if not new_packet and not missing_packet:
+            fingerprint_indices_length = len(str(fingerprint_indices))
+            if fingerprint_indices_length > 0:
+                self.change += len(str(diff_indices)) / fingerprint_indices_length
+                self.changed_packets += 1
+
+    # Features of the rows added so far. missing_packets is an optional list of (proto, length, payload) rows that are
+    # included without adding them permanently, e.g. the fingerprint packets that have not been seen yet in a capture
+    # that is still running.
+    def features(self, filename, missing_packets=()):
+        number_of_packets = self.number_of_packets + len(missing_packets)
+        length_sum = self.length_sum + sum(length for _, length, _ in missing_packets)
+        unique_rows = len(self.unique_rows | set(_row_hash(proto, length, payload, False) for proto, length, payload in missing_packets))
+
+        if number_of_packets == 0:
+            average_length = 0
+        elif length_sum % number_of_packets == 0:
+            average_length = length_sum // number_of_packets # statistics.mean returns an int for integral means
+        else:
+            average_length = length_sum / number_of_packets
+
+        return {
+            'filename': filename,
+            'number_of_packets': number_of_packets,
+            'number_of_unique_packets': unique_rows,
+            'average_length': average_length,
+            'number_of_new_packets': self.number_of_new_packets,
+            'number_of_unique_new_packets': len(self.unique_new_rows),
+            'number_of_missing_packets': self.number_of_missing_packets + len(missing_packets),
+            'avg_change_in_payload_%': self.change / self.changed_packets if self.changed_packets > 0 else 0,
+            'benign_packets_%': (self.total_packets - number_of_packets) / self.total_packets if number_of_packets and self.total_packets else 1,
+        }
@@ -0,0 +1,43 @@
+import csv
+import os
+
+# Streaming writer for the per comparison difference CSV files. Rows are buffered and appended to the file in batches,
+# so memory use does not grow with the number of differing packets. The CSV dialect is the same one pandas'
+# DataFrame.to_csv(index=False, escapechar='\\') uses, which keeps the output byte for byte identical to the files
+# written before.
+
+DIFF_COLUMNS = ['packet_number', 'total_packets', 'proto', 'length', 'new_packet', 'missing_packet', 'payload', 'payload_diff', 'payload_diff_invisible', 'diff_indices', 'fingerprint_indices']
+
+DEFAULT_BATCH_SIZE = 1000
+
+class DiffWriter:
+    def __init__(self, output_file, columns=DIFF_COLUMNS, batch_size=DEFAULT_BATCH_SIZE):
+        self.output_file = output_file
+        self.batch_size = batch_size
+        self.batch = []
+        self.rows_written = 0
+        self.file = open(output_file, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file, lineterminator=os.linesep, delimiter=',', quoting=csv.QUOTE_MINIMAL, doublequote=True, escapechar='\\', quotechar='"')
+        self.writer.writerow(columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.batch)
+        self.rows_written += len(self.batch)
+        self.batch = []
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
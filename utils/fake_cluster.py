@@ -0,0 +1,370 @@
+import fcntl
+import json
+import os
+import shlex
+import struct
+import sys
+import tempfile
+import time as time_module
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Fake kubectl, helm and minikube (and optionally tcpdump) for running application_capture.py without a Kubernetes
+# cluster, e.g. to try out the capture slots:
+#
+#   python3 utils/fake_cluster.py install /tmp/fake-bin
+#   PATH=/tmp/fake-bin:$PATH python3 application_capture.py
+#
+# install writes small wrapper scripts that call this file. The fake cluster keeps its state (profiles, releases and
+# pods, the files on the nodes) in FAKE_CLUSTER_DIR, by default the state folder next to the wrappers. Every
+# command is appended to commands.log in that folder.
+#
+# Only the commands and flags application_capture.py uses are supported. The fake fails the way the real tools do when
+# slots are not isolated from each other: installing a release that already exists in the same cluster and namespace,
+# using a profile that is not running, copying from a node of another profile or starting a second capture to a file
+# that is still being written.
+#
+# The pods of a release get their IP and turn ready one after the other, every FAKE_CLUSTER_READY_SECONDS (0 by
+# default), so a pod may not have an IP yet when the first pod is ready. kubectl wait blocks until the pod is ready and
+# kubectl get pods --watch prints the pods again when they change, until it is killed.
+#
+# A capture waits FAKE_CLUSTER_CAPTURE_SECONDS (1 by default) instead of the timeout and writes UDP packets between the
+# pods of every release on the node, with the release and chart version in the payload, and some node traffic that the
+# filter step should drop. With tcpdump -w - the capture is written to the standard output, filtered with the hosts of
+# the filter expression. With --tcpdump a fake tcpdump is also installed, which only supports reading a capture and
+# keeping the packets of the given hosts (tcpdump -r in -w out 'not arp and (host a or host b)').
+
+STATE_DIR_ENV = 'FAKE_CLUSTER_DIR'
+CAPTURE_SECONDS_ENV = 'FAKE_CLUSTER_CAPTURE_SECONDS'
+READY_SECONDS_ENV = 'FAKE_CLUSTER_READY_SECONDS'
+TOOLS = ['kubectl', 'helm', 'minikube']
+DEFAULT_PROFILE = 'minikube'
+PODS_PER_RELEASE = 2
+PACKETS_PER_POD = 5
+
+PCAP_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+ETHERNET_HEADER = bytes.fromhex('0242ac110002' '0242ac110003' '0800')
+
+class CommandError(Exception):
+    def __init__(self, message, returncode=1):
+        super().__init__(message)
+        self.returncode = returncode
+
+def state_dir():
+    return os.environ.get(STATE_DIR_ENV) or os.path.join(tempfile.gettempdir(), 'fake_cluster')
+
+# The state is a JSON file that every command reads and writes under an exclusive lock, the slots run their commands
+# at the same time
+@contextmanager
+def cluster_state():
+    directory = state_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'state.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(directory, 'state.json')
+        state = {'profiles': {}, 'releases': {}, 'captures': [], 'next_pod': 1}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+        yield state
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+def log_command(tool, args):
+    directory = state_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'commands.log'), 'a') as f:
+        f.write(f"{time_module.time():.3f} {shlex.join([tool] + args)}\n")
+
+def node_file(profile, path):
+    return os.path.join(state_dir(), 'nodes', profile, path.strip('/').replace('/', '_'))
+
+def running_profile(state, profile):
+    if not state['profiles'].get(profile, {}).get('running'):
+        raise CommandError(f'Error: context "{profile}" does not exist, profile "{profile}" is not running')
+    return state['profiles'][profile]
+
+def release_key(profile, namespace, release):
+    return f"{profile}/{namespace}/{release}"
+
+def pods(state, profile, namespace=None):
+    for key, release in state['releases'].items():
+        release_profile, release_namespace, _ = key.split('/')
+        if release_profile == profile and (namespace is None or release_namespace == namespace):
+            yield from release['pods']
+
+# Split the global flags (-p, --context, --kube-context, -n, --namespace) from the other arguments
+def parse_flags(args, flags):
+    values = {}
+    rest = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        name, _, value = arg.partition('=')
+        if name in flags:
+            if not value:
+                i += 1
+                value = args[i]
+            values[flags[name]] = value
+        else:
+            rest.append(arg)
+        i += 1
+    return values, rest
+
+# HELM
+
+def helm(args):
+    flags, args = parse_flags(args, {'--kube-context': 'profile', '--namespace': 'namespace', '-n': 'namespace', '--version': 'version', '--timeout': 'timeout'})
+    profile = flags.get('profile', DEFAULT_PROFILE)
+    namespace = flags.get('namespace', 'default')
+
+    if args[:2] in (['repo', 'add'], ['repo', 'update']):
+        return ''
+    if args[:2] == ['show', 'chart']:
+        return f"apiVersion: v2\nname: {args[2].split('/')[-1]}\nversion: {flags.get('version')}\n"
+
+    with cluster_state() as state:
+        running_profile(state, profile)
+        if args[0] == 'install':
+            release, chart = args[1], args[2]
+            key = release_key(profile, namespace, release)
+            if key in state['releases']:
+                raise CommandError("Error: INSTALLATION FAILED: cannot re-use a name that is still in use")
+            release_pods = []
+            for k in range(PODS_PER_RELEASE):
+                number = state['next_pod']
+                state['next_pod'] += 1
+                release_pods.append({
+                    'name': f"{release}-{chart.split('/')[-1]}-{k}",
+                    'namespace': namespace,
+                    'release': release,
+                    'ip': f"10.244.{number // 250}.{number % 250 + 2}",
+                    'ip_at': time_module.time() + float(os.environ.get(READY_SECONDS_ENV, '0')) * (k + 0.5),
+                    'ready_at': time_module.time() + float(os.environ.get(READY_SECONDS_ENV, '0')) * (k + 1),
+                })
+            state['releases'][key] = {'chart': chart, 'version': flags.get('version'), 'pods': release_pods}
+            return f"NAME: {release}\nNAMESPACE: {namespace}\nSTATUS: deployed\n"
+        if args[0] == 'uninstall':
+            key = release_key(profile, namespace, args[1])
+            if state['releases'].pop(key, None) is None and '--ignore-not-found' not in args:
+                raise CommandError(f"Error: uninstall: Release not loaded: {args[1]}: release: not found")
+            return f'release "{args[1]}" uninstalled\n'
+    raise CommandError(f"fake helm does not support: {shlex.join(args)}")
+
+# KUBECTL
+
+def pod_json(pod):
+    now = time_module.time()
+    status = {
+        'phase': 'Running' if now >= pod['ip_at'] else 'Pending',
+        'conditions': [{'type': 'Ready', 'status': 'True' if now >= pod['ready_at'] else 'False', 'lastTransitionTime': datetime.fromtimestamp(pod['ready_at'], timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}],
+    }
+    if now >= pod['ip_at']:
+        status.update(podIP=pod['ip'], podIPs=[{'ip': pod['ip']}])
+    return {
+        'metadata': {'name': pod['name'], 'namespace': pod['namespace'], 'labels': {'app.kubernetes.io/instance': pod['release']}},
+        'status': status,
+    }
+
+def namespace_pods(profile, namespace):
+    with cluster_state() as state:
+        running_profile(state, profile)
+        return list(pods(state, profile, namespace))
+
+def watch_pods(profile, namespace, matching):
+    printed = {}
+    while True:
+        for pod in matching(namespace_pods(profile, namespace)):
+            text = json.dumps(pod_json(pod), indent=4)
+            if printed.get(pod['name']) != text:
+                printed[pod['name']] = text
+                sys.stdout.write(text + '\n')
+                sys.stdout.flush()
+        time_module.sleep(0.1)
+
+def kubectl(args):
+    flags, args = parse_flags(args, {'--context': 'profile', '--namespace': 'namespace', '-n': 'namespace', '-l': 'selector', '-o': 'output', '--for': 'for', '--timeout': 'timeout'})
+    profile = flags.get('profile', DEFAULT_PROFILE)
+    namespace = flags.get('namespace', 'default')
+
+    current_pods = namespace_pods(profile, namespace)
+
+    def matching(pod_list):
+        if 'selector' not in flags:
+            return pod_list
+        label, _, value = flags['selector'].partition('=')
+        return [pod for pod in pod_list if label == 'app.kubernetes.io/instance' and pod['release'] == value]
+
+    if args[:2] == ['get', 'pods']:
+        if '--watch' in args or '-w' in args:
+            watch_pods(profile, namespace, matching)
+        selected = matching(current_pods)
+        if flags.get('output') == 'json':
+            return json.dumps({'apiVersion': 'v1', 'kind': 'List', 'items': [pod_json(pod) for pod in selected]}, indent=4) + '\n'
+        if flags.get('output') == 'wide':
+            lines = ["NAME READY STATUS RESTARTS AGE IP NODE NOMINATED-NODE READINESS-GATES"]
+            lines += [f"{pod['name']} 1/1 Running 0 1m {pod['ip'] if time_module.time() >= pod['ip_at'] else '<none>'} {profile} <none> <none>" for pod in selected]
+            return '\n'.join(lines) + '\n'
+    if args[0] == 'wait':
+        pod_name = args[1].split('/', 1)[1]
+        pod = next((pod for pod in current_pods if pod['name'] == pod_name), None)
+        if pod is None:
+            raise CommandError(f'Error from server (NotFound): pods "{pod_name}" not found')
+        time_module.sleep(max(pod['ready_at'] - time_module.time(), 0))
+        return f"pod/{pod_name} condition met\n"
+    if args[:3] == ['delete', 'pvc', '--all']:
+        return f"No resources found in {namespace} namespace.\n"
+    raise CommandError(f"fake kubectl does not support: {shlex.join(args)}")
+
+# MINIKUBE
+
+def capture_bytes(capture_pods):
+    timestamp = time_module.time()
+    frames = []
+    for pod in capture_pods:
+        release_pods = [other for other in capture_pods if other['release'] == pod['release'] and other['namespace'] == pod['namespace']]
+        peer = release_pods[(release_pods.index(pod) + 1) % len(release_pods)]
+        for k in range(PACKETS_PER_POD):
+            frames.append(udp_frame(pod['ip'], peer['ip'], f"{pod['release']} {pod['version']} {k}".encode()))
+    frames.append(udp_frame('192.168.49.2', '10.96.0.1', b'node traffic'))
+
+    data = bytearray(PCAP_HEADER)
+    for frame in frames:
+        timestamp += 0.001
+        seconds = int(timestamp)
+        data += struct.pack('<IIII', seconds, int((timestamp - seconds) * 1e6), len(frame), len(frame))
+        data += frame
+    return bytes(data)
+
+# Keep the packets from or to the hosts of a tcpdump filter expression like 'not arp and (host a or host b)', all the
+# packets without host terms
+def filter_capture(data, expression):
+    words = expression.replace('(', ' ').replace(')', ' ').split()
+    hosts = {words[i + 1] for i, word in enumerate(words) if word == 'host'}
+    output = bytearray(data[:24])
+    offset = 24
+    while offset + 16 <= len(data):
+        length = struct.unpack_from('<I', data, offset + 8)[0]
+        frame = data[offset + 16:offset + 16 + length]
+        source, destination = ('.'.join(map(str, frame[14 + k:18 + k])) for k in (12, 16))
+        if not hosts or source in hosts or destination in hosts:
+            output += data[offset:offset + 16 + length]
+        offset += 16 + length
+    return bytes(output)
+
+def udp_frame(source, destination, payload):
+    udp_header = struct.pack('!HHHH', 40000, 7000, 8 + len(payload), 0)
+    ip_header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28 + len(payload), 0, 0x4000, 64, 17, 0, bytes(map(int, source.split('.'))), bytes(map(int, destination.split('.'))))
+    return ETHERNET_HEADER + ip_header + udp_header + payload
+
+def minikube_ssh(profile, command):
+    words = shlex.split(command)
+    if 'tcpdump' in words and '-w' in words:
+        # tcpdump -w - streams the capture to the standard output, the filter expression is the last argument
+        path = words[words.index('-w') + 1]
+        with cluster_state() as state:
+            node = running_profile(state, profile)
+            if not node.get('tcpdump'):
+                raise CommandError("sudo: tcpdump: command not found")
+            if path != '-' and [profile, path] in state['captures']:
+                raise CommandError(f"tcpdump: {path}: another capture is writing to this file")
+            state['captures'].append([profile, path])
+
+        time_module.sleep(float(os.environ.get(CAPTURE_SECONDS_ENV, '1')))
+
+        with cluster_state() as state:
+            state['captures'].remove([profile, path])
+            capture_pods = [dict(pod, version=release['version']) for key, release in state['releases'].items() if key.startswith(f"{profile}/") for pod in release['pods']]
+        data = capture_bytes(capture_pods)
+        if path == '-':
+            expression = words[-1] if words.index('-w') + 2 < len(words) else ''
+            sys.stdout.buffer.write(filter_capture(data, expression))
+            sys.stdout.flush()
+        else:
+            os.makedirs(os.path.dirname(node_file(profile, path)), exist_ok=True)
+            with open(node_file(profile, path), 'wb') as f:
+                f.write(data)
+        raise CommandError("ssh: Process exited with status 124", returncode=124)
+
+    with cluster_state() as state:
+        node = running_profile(state, profile)
+        if 'apt' in words:
+            node['tcpdump'] = True
+        elif 'rm' in words:
+            path = words[words.index('-f') + 1]
+            if os.path.exists(node_file(profile, path)):
+                os.remove(node_file(profile, path))
+    return ''
+
+def minikube(args):
+    flags, args = parse_flags(args, {'-p': 'profile', '--profile': 'profile'})
+    profile = flags.get('profile', DEFAULT_PROFILE)
+
+    if args[0] == 'start':
+        with cluster_state() as state:
+            state['profiles'][profile] = {'running': True, 'tcpdump': False}
+        return f'Done! kubectl is now configured to use "{profile}" cluster and "default" namespace by default\n'
+    if args[0] == 'stop':
+        with cluster_state() as state:
+            running_profile(state, profile)['running'] = False
+        return '1 node stopped.\n'
+    if args[0] == 'delete':
+        with cluster_state() as state:
+            state['profiles'].pop(profile, None)
+            state['releases'] = {key: release for key, release in state['releases'].items() if not key.startswith(f"{profile}/")}
+        return f'Removed all traces of the "{profile}" cluster.\n'
+    if args[0] == 'ssh':
+        return minikube_ssh(profile, ' '.join(args[1:]))
+    if args[0] == 'cp':
+        node, _, path = args[1].partition(':')
+        if node != profile:
+            raise CommandError(f'Error: node "{node}" not found in profile "{profile}"')
+        with cluster_state() as state:
+            running_profile(state, profile)
+        if not os.path.exists(node_file(profile, path)):
+            raise CommandError(f"Error: {path}: no such file on node {node}")
+        with open(node_file(profile, path), 'rb') as source, open(args[2], 'wb') as destination:
+            destination.write(source.read())
+        return ''
+    raise CommandError(f"fake minikube does not support: {shlex.join(args)}")
+
+# TCPDUMP
+
+def tcpdump(args):
+    if '-r' not in args or '-w' not in args:
+        raise CommandError("fake tcpdump only filters a capture: tcpdump -r <in> -w <out> '<filter>'")
+    with open(args[args.index('-r') + 1], 'rb') as f:
+        data = f.read()
+    with open(args[args.index('-w') + 1], 'wb') as f:
+        f.write(filter_capture(data, args[-1]))
+    return ''
+
+COMMANDS = {'kubectl': kubectl, 'helm': helm, 'minikube': minikube, 'tcpdump': tcpdump}
+
+def install(bin_dir, with_tcpdump=False):
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in TOOLS + (['tcpdump'] if with_tcpdump else []):
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\nexport {STATE_DIR_ENV}="${{{STATE_DIR_ENV}:-{os.path.join(os.path.abspath(bin_dir), "state")}}}"\n')
+            f.write(f'exec {shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} {tool} "$@"\n')
+        os.chmod(path, 0o755)
+    print(f"Installed the fake {', '.join(TOOLS)}{' and tcpdump' if with_tcpdump else ''} in {bin_dir}. Use them with:")
+    print(f"PATH={os.path.abspath(bin_dir)}:$PATH python3 application_capture.py")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == 'install':
+        install(sys.argv[2], with_tcpdump='--tcpdump' in sys.argv[3:])
+        sys.exit(0)
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        print(f"Usage: {sys.argv[0]} install <bin_dir> [--tcpdump] | {{{','.join(COMMANDS)}}} <arguments>", file=sys.stderr)
+        sys.exit(2)
+
+    tool, arguments = sys.argv[1], sys.argv[2:]
+    log_command(tool, arguments)
+    try:
+        sys.stdout.write(COMMANDS[tool](arguments))
+    except CommandError as e:
+        print(e, file=sys.stderr)
+        sys.exit(e.returncode)
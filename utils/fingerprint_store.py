@@ -0,0 +1,176 @@
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from datetime import datetime
+import numpy as np
+from utils.compact_fingerprint import FingerprintEntry
+
+# Binary file format for version fingerprints, so that a fingerprint can be built once and reused by later comparison
+# runs and other tools without dissecting the fingerprint pcap files again.
+#
+# Layout (little-endian):
+#   0   magic            8 bytes, b'VDFPRINT'
+#   8   format version   uint32
+#   12  header length    uint32
+#   16  sha256           32 bytes, checksum of everything after the first 48 bytes
+#   48  header           JSON: build parameters (version, source files, time cutoff, backend), protocol names and
+#                        the sizes of the sections below
+#   ... entries          structured array, one row per (proto, length) key, 8 byte aligned
+#   ... indices          uint32 array with the stable positions of all keys, 8 byte aligned
+#   ... payloads         reference payloads of all keys
+#
+# On load the file is memory mapped and the stable position arrays and reference payloads of the entries are views into
+# the mapping, so loading a fingerprint does not depend on its size.
+
+MAGIC = b'VDFPRINT'
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct('<8sII32s')
+FINGERPRINT_DIR_NAME = 'fingerprints'
+FINGERPRINT_FILE_EXTENSION = '.vdfp'
+
+ENTRY_DTYPE = np.dtype([
+    ('proto', '<u4'),
+    ('length', '<u8'),
+    ('is_common', 'u1'),
+    ('packet_count', '<u8'),
+    ('file_count', '<u4'),
+    ('payload_offset', '<u8'),
+    ('indices_offset', '<u8'),
+    ('indices_count', '<u8'),
+])
+
+class FingerprintFormatError(Exception):
+    pass
+
+def _align(size, alignment=8):
+    return (size + alignment - 1) // alignment * alignment
+
+def fingerprint_path(pcap_dir, fingerprint_version):
+    return os.path.join(pcap_dir, FINGERPRINT_DIR_NAME, f"{fingerprint_version}{FINGERPRINT_FILE_EXTENSION}")
+
+# Describes the pcap files a fingerprint was built from. Name and size are enough to notice new or re-captured files.
+def describe_source_files(pcap_files):
+    return [{'name': os.path.basename(f), 'size': os.path.getsize(f)} for f in sorted(pcap_files)]
+
+def build_parameters(fingerprint_version, pcap_files, time, backend):
+    return {
+        'fingerprint_version': fingerprint_version,
+        'source_files': describe_source_files(pcap_files),
+        'time': time,
+        'backend': backend,
+    }
+
+def save_fingerprint(fingerprint, path, parameters):
+    common_packets = fingerprint['common_packets']
+    keys = sorted(key for key in fingerprint if key != 'common_packets')
+    protos = sorted(set(proto for proto, _ in keys))
+    proto_codes = {proto: i for i, proto in enumerate(protos)}
+
+    entries = np.zeros(len(keys), dtype=ENTRY_DTYPE)
+    indices = []
+    payloads = []
+    indices_offset = 0
+    payload_offset = 0
+    for i, key in enumerate(keys):
+        entry = fingerprint[key]
+        stable_indices = entry.stable_indices if entry.stable_indices is not None else np.empty(0, dtype=np.uint32)
+        entries[i] = (proto_codes[key[0]], key[1], key in common_packets, entry.packet_count, entry.file_count, payload_offset, indices_offset, len(stable_indices))
+        indices.append(stable_indices.astype('<u4'))
+        payloads.append(bytes(entry.reference_payload))
+        indices_offset += len(stable_indices)
+        payload_offset += len(entry.reference_payload)
+
+    indices = np.concatenate(indices) if indices else np.empty(0, dtype='<u4')
+    payloads = b''.join(payloads)
+
+    header = dict(parameters)
+    header.update({
+        'created': datetime.now().isoformat(),
+        'protos': protos,
+        'entry_count': len(keys),
+        'indices_count': len(indices),
+        'payloads_size': len(payloads),
+    })
+    header_bytes = json.dumps(header).encode('utf-8')
+    body_start = _align(PREAMBLE.size + len(header_bytes))
+    header_bytes += b' ' * (body_start - PREAMBLE.size - len(header_bytes)) # Pad with whitespace so the JSON stays valid
+
+    entries_bytes = entries.tobytes()
+    entries_bytes += b'\0' * (_align(len(entries_bytes)) - len(entries_bytes))
+    indices_bytes = indices.tobytes()
+    indices_bytes += b'\0' * (_align(len(indices_bytes)) - len(indices_bytes))
+    body = header_bytes + entries_bytes + indices_bytes + payloads
+
+    checksum = hashlib.sha256(body).digest()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes), checksum))
+            f.write(body)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_parameters(path):
+    with open(path, 'rb') as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size:
+            raise FingerprintFormatError(f"{path} is not a fingerprint file")
+        magic, version, header_length, _ = PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise FingerprintFormatError(f"{path} is not a fingerprint file")
+        if version != FORMAT_VERSION:
+            raise FingerprintFormatError(f"{path} has unsupported format version {version}, expected {FORMAT_VERSION}")
+        return json.loads(f.read(header_length).decode('utf-8'))
+
+# Load a fingerprint saved with save_fingerprint. Returns (fingerprint, header), where header contains the build
+# parameters. The checksum is verified unless verify is False.
+def load_fingerprint(path, verify=True):
+    header = read_parameters(path)
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    _, _, header_length, checksum = PREAMBLE.unpack_from(buf, 0)
+    if verify and hashlib.sha256(memoryview(buf)[PREAMBLE.size:]).digest() != checksum:
+        raise FingerprintFormatError(f"Checksum mismatch in {path}, the file is corrupted")
+
+    entries_offset = PREAMBLE.size + header_length
+    entries = np.frombuffer(buf, dtype=ENTRY_DTYPE, count=header['entry_count'], offset=entries_offset)
+    indices_offset = entries_offset + _align(entries.nbytes)
+    indices = np.frombuffer(buf, dtype='<u4', count=header['indices_count'], offset=indices_offset)
+    payloads_offset = indices_offset + _align(indices.nbytes)
+    payloads = memoryview(buf)[payloads_offset:payloads_offset + header['payloads_size']]
+
+    protos = header['protos']
+    fingerprint = {}
+    common_packets = set()
+    for row in entries.tolist():
+        proto_code, length, is_common, packet_count, file_count, payload_offset, index_offset, index_count = row
+        key = (protos[proto_code], length)
+        stable_indices = indices[index_offset:index_offset + index_count] if is_common else None
+        fingerprint[key] = FingerprintEntry.from_arrays(reference_payload=payloads[payload_offset:payload_offset + length], stable_indices=stable_indices, packet_count=packet_count, file_count=file_count)
+        if is_common:
+            common_packets.add(key)
+    fingerprint['common_packets'] = common_packets
+    return fingerprint, header
+
+# Load the fingerprints saved in the fingerprints folder of pcap_dir, only the given versions if versions is not empty.
+# Returns {fingerprint_version: (fingerprint, header)} in version file order.
+def load_fingerprints(pcap_dir, versions=None):
+    fingerprints = {}
+    for path in sorted(glob.glob(os.path.join(pcap_dir, FINGERPRINT_DIR_NAME, f'*{FINGERPRINT_FILE_EXTENSION}'))):
+        fingerprint, header = load_fingerprint(path)
+        if versions and header['fingerprint_version'] not in versions:
+            continue
+        fingerprints[header['fingerprint_version']] = (fingerprint, header)
+
+    if not fingerprints:
+        raise FileNotFoundError(f"No saved fingerprints found in {os.path.join(pcap_dir, FINGERPRINT_DIR_NAME)}. Run fingerprint.py first.")
+    return fingerprints
@@ -0,0 +1,129 @@
+import numpy as np
+
+# Trained random forests as flat NumPy arrays, for scoring feature rows without going through scikit-learn's input
+# validation and per tree dispatch.
+#
+# export_forest flattens the trees of a RandomForestClassifier into one set of node arrays: the feature and threshold
+# of every split, the left and right child of every node and the class probabilities of every node. Leaves point to
+# themselves, so a tree has reached its leaf when a step does not move it anymore.
+#
+# ForestEvaluator combines the exported forests of several versions and walks all the trees of all the forests for a
+# batch of rows at the same time, one tree level per step. This is meant for scoring a few rows with low latency, for
+# large batches scikit-learn's compiled tree traversal is faster. The probabilities are computed the way scikit-learn
+# computes them: the rows are converted to float32 before they are compared to the thresholds, the leaf values are
+# normalized per tree and the trees are summed in order and divided by the number of trees, so the results are exactly
+# the same as predict_proba and predict.
+#
+# The classifiers of classify.py have the classes 0 (other version) and 1 (same version). The probabilities are always
+# returned for both, a class the forest has not seen during training gets the probability 0.
+
+CLASSES = [0, 1]
+
+def export_forest(model):
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset = 0
+    depth = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        nodes = np.arange(tree.node_count)
+        leaf = tree.children_left < 0
+        features.append(np.where(leaf, 0, tree.feature).astype(np.int32))
+        thresholds.append(np.where(leaf, 0.0, tree.threshold))
+        lefts.append(np.where(leaf, nodes, tree.children_left).astype(np.int32) + offset)
+        rights.append(np.where(leaf, nodes, tree.children_right).astype(np.int32) + offset)
+
+        # Same normalization as DecisionTreeClassifier.predict_proba. The columns are in the order of the classes of the
+        # forest (the trees only know the class indices).
+        value = tree.value[:, 0, :estimator.n_classes_]
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        probabilities = np.zeros((tree.node_count, len(CLASSES)))
+        for column, label in enumerate(model.classes_):
+            probabilities[:, CLASSES.index(int(label))] = value[:, column] / normalizer[:, 0]
+        values.append(probabilities)
+
+        roots.append(offset)
+        offset += tree.node_count
+        depth = max(depth, tree.max_depth)
+
+    return {
+        'feature': np.concatenate(features),
+        'threshold': np.concatenate(thresholds),
+        'left': np.concatenate(lefts),
+        'right': np.concatenate(rights),
+        'value': np.concatenate(values),
+        'roots': np.array(roots, dtype=np.int32),
+        'depth': np.array(depth, dtype=np.int32),
+        'n_features': np.array(model.n_features_in_, dtype=np.int32),
+    }
+
+def save_forest(path, forest):
+    np.savez(path, **forest)
+
+def load_forest(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+class ForestEvaluator:
+    # forests is {name: exported forest}, the models are in the order of the dict
+    def __init__(self, forests):
+        self.names = list(forests)
+        self.n_features = int(next(iter(forests.values()))['n_features']) if forests else 0
+        if any(int(forest['n_features']) != self.n_features for forest in forests.values()):
+            raise ValueError("All the forests need to use the same features")
+
+        # All the nodes in one set of arrays, followed by a leaf with zero probabilities. Forests with fewer trees are
+        # padded with that leaf, which does not change the sums.
+        arrays = list(forests.values())
+        starts = np.cumsum([0] + [len(forest['feature']) for forest in arrays]).tolist()
+        padding_leaf = starts[-1]
+        self.n_trees = np.array([len(forest['roots']) for forest in arrays])
+        self.roots = np.full((len(arrays), max(self.n_trees, default=0)), padding_leaf, dtype=np.int64)
+        for i, forest in enumerate(arrays):
+            self.roots[i, :len(forest['roots'])] = forest['roots'] + starts[i]
+
+        self.feature = np.concatenate([forest['feature'] for forest in arrays] + [np.zeros(1, dtype=np.int32)])
+        self.threshold = np.concatenate([forest['threshold'] for forest in arrays] + [np.zeros(1)])
+        self.left = np.concatenate([forest['left'] + start for forest, start in zip(arrays, starts)] + [np.array([padding_leaf])])
+        self.right = np.concatenate([forest['right'] + start for forest, start in zip(arrays, starts)] + [np.array([padding_leaf])])
+        self.value = np.concatenate([forest['value'] for forest in arrays] + [np.zeros((1, len(CLASSES)))])
+        self.depth = max((int(forest['depth']) for forest in arrays), default=0)
+
+    # Class probabilities of every row for every model, shape (rows, models, classes). X is either (rows, features),
+    # the same rows for all the models, or (rows, models, features) with a separate row for every model.
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float32) # scikit-learn compares float32 values to the thresholds
+        if X.ndim == 2:
+            X = np.broadcast_to(X[:, np.newaxis, :], (X.shape[0], len(self.names), X.shape[1]))
+        if X.shape[1:] != (len(self.names), self.n_features):
+            raise ValueError(f"Expected rows with {len(self.names)} models and {self.n_features} features, got the shape {X.shape}")
+
+        rows, models, features = X.shape
+        trees = self.roots.shape[1]
+        X = np.ascontiguousarray(X).reshape(-1)
+        nodes = np.broadcast_to(self.roots, (rows, models, trees)).reshape(-1).copy()
+        row_offsets = np.repeat(np.arange(rows * models) * features, trees)
+
+        # Only the trees that have not reached a leaf yet are walked further
+        active = np.arange(nodes.size)
+        for _ in range(self.depth):
+            current = nodes[active]
+            go_left = X[row_offsets[active] + self.feature[current]] <= self.threshold[current]
+            following = np.where(go_left, self.left[current], self.right[current])
+            nodes[active] = following
+            active = active[following != current]
+            if active.size == 0:
+                break
+
+        # Summed tree by tree like RandomForestClassifier.predict_proba, a different summation order could change the
+        # last bit of the result
+        leaf_values = self.value[nodes].reshape(rows, models, trees, len(CLASSES))
+        probabilities = np.zeros((rows, models, len(CLASSES)))
+        for tree in range(trees):
+            probabilities += leaf_values[:, :, tree]
+        probabilities /= self.n_trees[np.newaxis, :, np.newaxis]
+        return probabilities
+
+    # Predicted class of every row for every model, shape (rows, models)
+    def predict(self, X):
+        return np.array(CLASSES)[np.argmax(self.predict_proba(X), axis=2)]
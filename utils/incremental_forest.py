@@ -0,0 +1,100 @@
+import os
+import joblib
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import train_test_split
+from utils.forest_arrays import CLASSES
+from utils.model_store import write_atomic
+
+# Random forest of a fingerprint version that is trained in batches, for classify.py --incremental.
+#
+# Every batch contains the aggregated_results.csv rows that were not seen before. The rows are split into training and
+# test rows like classify.py splits all the rows, a new set of trees is trained on the training rows only and the test
+# rows are added to the test rows of the earlier batches. The trees of earlier batches are kept as they are, so the cost
+# of an update depends only on the number of new rows. The forest predicts the average of all its trees, the same as a
+# RandomForestClassifier with all the trees would.
+#
+# The state of every version (the trees, the test rows and the filenames of the rows used so far) is saved to
+# fingerprint_comparison/incremental/<version>.joblib. With a single batch of all the rows the forest and its results
+# are the same as the ones classify.py trains without --incremental.
+
+INCREMENTAL_DIR_NAME = 'incremental'
+STATE_FILE_EXTENSION = '.joblib'
+DEFAULT_TREES_PER_BATCH = 100
+
+class IncrementalForest:
+    def __init__(self, feature_columns, trees_per_batch=DEFAULT_TREES_PER_BATCH, max_trees=None, random_state=42):
+        self.feature_columns = list(feature_columns)
+        self.trees_per_batch = trees_per_batch
+        self.max_trees = max_trees
+        self.random_state = random_state
+        self.forests = [] # One RandomForestClassifier per batch, oldest first
+        self.batches = 0
+        self.seen = set() # Filenames of the rows used so far
+        self.test_X = np.empty((0, len(self.feature_columns)))
+        self.test_y = np.empty(0, dtype=np.int64)
+
+    @property
+    def n_trees(self):
+        return sum(len(forest.estimators_) for forest in self.forests)
+
+    # Train new trees on a batch of rows. Returns the number of training and test rows of the batch.
+    def add_batch(self, X, y, filenames, n_jobs=1):
+        if len(y) > 1:
+            X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
+        else:
+            X_train, X_test, y_train, y_test = X, X[:0], y, y[:0]
+
+        if len(y_train) > 0:
+            forest = RandomForestClassifier(n_estimators=self.trees_per_batch, random_state=self.random_state + self.batches, n_jobs=n_jobs)
+            forest.fit(X_train, y_train)
+            forest.set_params(n_jobs=None)
+            self.forests.append(forest)
+
+            # The oldest trees are dropped first, the newest batch is always kept
+            while self.max_trees and self.n_trees > self.max_trees and len(self.forests) > 1:
+                self.forests.pop(0)
+
+        self.test_X = np.concatenate([self.test_X, X_test])
+        self.test_y = np.concatenate([self.test_y, y_test])
+        self.seen.update(filenames)
+        self.batches += 1
+        return len(y_train), len(y_test)
+
+    # Class probabilities for CLASSES, the average over all the trees. Every batch is weighted by its number of trees.
+    def predict_proba(self, X):
+        n_trees = self.n_trees
+        probabilities = np.zeros((len(X), len(CLASSES)))
+        for forest in self.forests:
+            forest_probabilities = forest.predict_proba(X) * (len(forest.estimators_) / n_trees)
+            for column, label in enumerate(forest.classes_):
+                probabilities[:, CLASSES.index(int(label))] += forest_probabilities[:, column]
+        return probabilities
+
+    def predict(self, X):
+        return np.array(CLASSES)[np.argmax(self.predict_proba(X), axis=1)]
+
+    @property
+    def feature_importances_(self):
+        if not self.forests:
+            return np.zeros(len(self.feature_columns))
+        if len(self.forests) == 1:
+            return self.forests[0].feature_importances_ # Averaging would change the last bits
+        return np.average([forest.feature_importances_ for forest in self.forests], axis=0, weights=[len(forest.estimators_) for forest in self.forests])
+
+def state_dir(result_dir):
+    return os.path.join(result_dir, INCREMENTAL_DIR_NAME)
+
+def state_path(directory, fingerprint_version):
+    return os.path.join(directory, f"{fingerprint_version}{STATE_FILE_EXTENSION}")
+
+# Load the saved forest of a version, or None if there is none yet
+def load_state(directory, fingerprint_version):
+    path = state_path(directory, fingerprint_version)
+    if not os.path.exists(path):
+        return None
+    return joblib.load(path)
+
+def save_state(directory, fingerprint_version, forest):
+    os.makedirs(directory, exist_ok=True)
+    write_atomic(state_path(directory, fingerprint_version), lambda f: joblib.dump(forest, f))
@@ -0,0 +1,196 @@
+import atexit
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time as time_module
+from datetime import datetime
+
+# Stage level instrumentation: how long every pipeline stage takes, how many packets/bytes/rows it handled and the peak
+# memory of the process at the end of the stage.
+#
+#   with metrics.stage('compare_pcap', version=fingerprint_version) as stage:
+#       ...
+#       stage.add(packets=len(packets), bytes=os.path.getsize(pcap_file))
+#
+# Instrumentation is disabled by default. stage() then returns a shared object that does nothing, so the stages cost
+# one function call. Stages are placed around whole files and steps, never around single packets.
+#
+# Two output formats are supported:
+#   jsonl      - one JSON object per finished stage, appended to the file. Forked worker processes append to the same
+#                file, every line is written with a single write call.
+#   prometheus - totals per stage and label set in the Prometheus text format, written when the process exits. The file
+#                can be picked up by the node_exporter textfile collector. Per file labels are left out to keep the
+#                number of series bounded.
+#
+# It is enabled with enable(), or by setting the METRICS_FILE (and optionally METRICS_FORMAT) environment variables,
+# which also covers scripts that are run as subprocesses.
+
+METRICS_FILE_ENV = 'METRICS_FILE'
+METRICS_FORMAT_ENV = 'METRICS_FORMAT'
+METRICS_FORMATS = ['jsonl', 'prometheus']
+PROMETHEUS_PREFIX = 'helm_version'
+PROMETHEUS_EXCLUDED_LABELS = ('file', 'run')
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class Stage:
+    __slots__ = ('name', 'labels', 'counters', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counters = {}
+        self.start = None
+
+    def add(self, **counters):
+        for counter, value in counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def __enter__(self):
+        self.start = time_module.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if _recorder is not None:
+            _recorder.record(self, time_module.perf_counter() - self.start, failed=exc_type is not None)
+        return False
+
+class _DisabledStage:
+    __slots__ = ()
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+DISABLED_STAGE = _DisabledStage()
+
+class JsonLinesRecorder:
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.fd = os.open(output_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def record(self, stage, seconds, failed):
+        line = {'time': datetime.now().isoformat(), 'stage': stage.name}
+        line.update(stage.labels)
+        line.update(stage.counters)
+        line.update({'seconds': seconds, 'failed': failed, 'peak_rss_bytes': peak_rss_bytes(), 'pid': os.getpid()})
+        os.write(self.fd, (json.dumps(line) + '\n').encode('utf-8'))
+
+    def close(self):
+        os.close(self.fd)
+
+# Forked worker processes (the ProcessPoolExecutors of fingerprint.py, aggregate_diffs.py and classify.py) inherit the
+# recorder. Pool workers exit without running atexit handlers, so a worker writes its own totals to a part file next to
+# the output file after every stage, and the process that created the recorder merges the part files when it closes.
+class PrometheusRecorder:
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.pid = os.getpid()
+        self.totals_pid = self.pid
+        self.totals = {} # (stage, labels) -> {'calls', 'failures', 'seconds', counters...}
+        self.lock = threading.Lock() # application_capture.py records the stages of its slots from several threads
+
+    def part_file(self, pid):
+        return f"{self.output_file}.{self.pid}.{pid}.part"
+
+    def record(self, stage, seconds, failed):
+        labels = tuple(sorted((k, str(v)) for k, v in stage.labels.items() if k not in PROMETHEUS_EXCLUDED_LABELS))
+        with self.lock:
+            if self.totals_pid != os.getpid():
+                # First stage of a forked worker, the totals of the parent were copied at the fork
+                self.totals_pid = os.getpid()
+                self.totals = {}
+            totals = self.totals.setdefault((stage.name, labels), {'calls': 0, 'failures': 0, 'seconds': 0.0})
+            totals['calls'] += 1
+            totals['failures'] += int(failed)
+            totals['seconds'] += seconds
+            for counter, value in stage.counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+            if self.totals_pid != self.pid:
+                part = json.dumps([[name, list(map(list, labels)), totals] for (name, labels), totals in self.totals.items()])
+                write_text_atomic(self.part_file(self.totals_pid), part)
+
+    def merge_parts(self):
+        prefix = os.path.basename(f"{self.output_file}.{self.pid}.")
+        directory = os.path.dirname(os.path.abspath(self.output_file))
+        for filename in sorted(os.listdir(directory)):
+            if not (filename.startswith(prefix) and filename.endswith('.part')):
+                continue
+            path = os.path.join(directory, filename)
+            with open(path) as f:
+                parts = json.load(f)
+            os.remove(path)
+            for name, labels, part_totals in parts:
+                totals = self.totals.setdefault((name, tuple(map(tuple, labels))), {'calls': 0, 'failures': 0, 'seconds': 0.0})
+                for metric, value in part_totals.items():
+                    totals[metric] = totals.get(metric, 0) + value
+
+    def close(self):
+        # Only the process that created the recorder writes the file
+        if os.getpid() != self.pid:
+            return
+        self.merge_parts()
+
+        def escape(value):
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        metrics = {}
+        for (name, labels), totals in sorted(self.totals.items()):
+            label_text = ','.join(f'{k}="{escape(v)}"' for k, v in (('stage', name),) + labels)
+            for metric, value in totals.items():
+                metrics.setdefault(metric, []).append(f"{PROMETHEUS_PREFIX}_stage_{metric}_total{{{label_text}}} {value}")
+
+        lines = []
+        for metric, samples in metrics.items():
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_{metric}_total counter")
+            lines.extend(samples)
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_peak_rss_bytes gauge")
+        lines.append(f"{PROMETHEUS_PREFIX}_peak_rss_bytes {peak_rss_bytes()}")
+
+        # Written to a temporary file first so that the collector never reads a partial file
+        write_text_atomic(self.output_file, '\n'.join(lines) + '\n')
+
+def write_text_atomic(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+_recorder = None
+
+def enable(output_file, format='jsonl'):
+    global _recorder
+    if format not in METRICS_FORMATS:
+        raise ValueError(f"Unknown metrics format: {format}. Available formats: {METRICS_FORMATS}")
+    disable()
+    _recorder = JsonLinesRecorder(output_file) if format == 'jsonl' else PrometheusRecorder(output_file)
+    atexit.register(disable)
+
+def disable():
+    global _recorder
+    if _recorder is not None:
+        recorder, _recorder = _recorder, None
+        recorder.close()
+
+def enabled():
+    return _recorder is not None
+
+def stage(name, **labels):
+    if _recorder is None:
+        return DISABLED_STAGE
+    return Stage(name, labels)
+
+if os.environ.get(METRICS_FILE_ENV):
+    enable(os.environ[METRICS_FILE_ENV], os.environ.get(METRICS_FORMAT_ENV, 'jsonl'))
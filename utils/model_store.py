@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import tempfile
+from datetime import datetime
+import joblib
+import sklearn
+from utils.forest_arrays import export_forest, load_forest, save_forest
+
+# Saved classifiers of classify.py, so that new captures can be classified without training again (see predict.py).
+#
+# The models are saved next to aggregated_results.csv:
+#   fingerprint_comparison/models/<version>.joblib   RandomForestClassifier of a fingerprint version
+#   fingerprint_comparison/models/<version>.npz      the same forest as node arrays (see utils/forest_arrays.py)
+#   fingerprint_comparison/models/models.json        feature schema and training metadata of all the models
+#
+# models.json is written last and only lists the models of the last training run, model files of versions that are
+# not listed there are ignored. The feature columns are the columns of aggregated_results.csv the models were trained
+# on, in the order the models expect them.
+
+MODEL_DIR_NAME = 'models'
+MODEL_FILE_EXTENSION = '.joblib'
+FOREST_FILE_EXTENSION = '.npz'
+MODEL_INDEX_FILENAME = 'models.json'
+FORMAT_VERSION = 2 # 2 added the node arrays
+
+class ModelFormatError(Exception):
+    pass
+
+def model_dir(result_dir):
+    return os.path.join(result_dir, MODEL_DIR_NAME)
+
+def write_atomic(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Save the model of a fingerprint version and return its description for the index
+def save_model(directory, fingerprint_version, model, **metadata):
+    os.makedirs(directory, exist_ok=True)
+    filename = f"{fingerprint_version}{MODEL_FILE_EXTENSION}"
+    forest_filename = f"{fingerprint_version}{FOREST_FILE_EXTENSION}"
+    write_atomic(os.path.join(directory, filename), lambda f: joblib.dump(model, f))
+    write_atomic(os.path.join(directory, forest_filename), lambda f: save_forest(f, export_forest(model)))
+    description = {
+        'file': filename,
+        'forest_file': forest_filename,
+        'classes': [int(c) for c in model.classes_],
+        'parameters': {k: v for k, v in model.get_params().items() if isinstance(v, (int, float, str, bool, type(None)))},
+    }
+    description.update(metadata)
+    return description
+
+# Write the index of the saved models. models is {fingerprint_version: description returned by save_model}.
+def save_index(directory, feature_columns, models, aggregated_results):
+    os.makedirs(directory, exist_ok=True)
+    index = {
+        'format_version': FORMAT_VERSION,
+        'created': datetime.now().isoformat(),
+        'sklearn_version': sklearn.__version__,
+        'label': 'is_same_version',
+        'feature_columns': list(feature_columns),
+        'aggregated_results': {
+            'file': os.path.basename(aggregated_results),
+            'sha256': file_sha256(aggregated_results),
+        },
+        'models': models,
+    }
+    write_atomic(os.path.join(directory, MODEL_INDEX_FILENAME), lambda f: f.write(json.dumps(index, indent=2).encode('utf-8')))
+    return index
+
+def load_index(directory):
+    path = os.path.join(directory, MODEL_INDEX_FILENAME)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No saved models found in {directory}. Run classify.py first.")
+    with open(path, 'r') as f:
+        index = json.load(f)
+    if index.get('format_version') != FORMAT_VERSION:
+        raise ModelFormatError(f"{path} has unsupported format version {index.get('format_version')}, expected {FORMAT_VERSION}")
+    return index
+
+# Load the saved models, only the given versions if versions is not empty. Returns ({fingerprint_version: model}, index).
+def load_models(directory, versions=None):
+    index = load_index(directory)
+    if index['sklearn_version'] != sklearn.__version__:
+        print(f"Warning: the models in {directory} were saved with scikit-learn {index['sklearn_version']}, running {sklearn.__version__}")
+
+    models = {}
+    for fingerprint_version, description in index['models'].items():
+        if versions and fingerprint_version not in versions:
+            continue
+        models[fingerprint_version] = joblib.load(os.path.join(directory, description['file']))
+    return models, index
+
+# Load the saved models as node arrays for utils/forest_arrays.ForestEvaluator, only the given versions if versions is
+# not empty. Returns ({fingerprint_version: forest}, index).
+def load_forests(directory, versions=None):
+    index = load_index(directory)
+    forests = {}
+    for fingerprint_version, description in index['models'].items():
+        if versions and fingerprint_version not in versions:
+            continue
+        forests[fingerprint_version] = load_forest(os.path.join(directory, description['forest_file']))
+    return forests, index
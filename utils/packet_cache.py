@@ -0,0 +1,145 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+from utils.pcap_reader import RecordIndex
+
+# Persistent on-disk cache for extracted packets. Extracting a pcap file (especially with tshark) is by far the most
+# expensive step of the fingerprinting and the same test files are extracted once for every fingerprint version.
+#
+# Entries are keyed by the content hash of the pcap file, the extraction backend and the time cutoff, so renaming or
+# copying a capture does not invalidate it but changing its content does. Each entry is a single uncompressed .npz file
+# that stores the packet table column by column:
+#   protos       - unique protocol names
+#   proto_codes  - index into protos for every packet
+#   numbers      - packet (frame) numbers
+#   offsets      - start offset of every payload in the payload blob, with the total length appended
+#   payloads     - all the payloads concatenated, latin-1 encoded
+#
+# The cache also stores record offset indexes of the pcap files, which make writing a subset of a pcap file a matter of
+# copying the needed byte ranges.
+#
+# The cache is bounded by size. The modification time of an entry is bumped on every hit and the least recently used
+# entries are evicted first.
+
+CACHE_FORMAT_VERSION = 2
+CACHE_DIR_NAME = '.packet_cache'
+DEFAULT_MAX_SIZE_MB = 4096
+HASH_CHUNK_SIZE = 1 << 20
+
+class PacketCache:
+    def __init__(self, cache_dir, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hashes = {} # (path, size, mtime) -> content hash. Hashing is cheap but not free.
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file_hash(self, pcap_file):
+        stat = os.stat(pcap_file)
+        stat_key = (os.path.abspath(pcap_file), stat.st_size, stat.st_mtime_ns)
+        if stat_key not in self.hashes:
+            digest = hashlib.sha256()
+            with open(pcap_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            self.hashes[stat_key] = digest.hexdigest()
+        return self.hashes[stat_key]
+
+    def entry_path(self, pcap_file, backend, time=None):
+        time_key = str(time) if time else 'all'
+        return os.path.join(self.cache_dir, f"{self.file_hash(pcap_file)}-{backend}-{time_key}-v{CACHE_FORMAT_VERSION}.npz")
+
+    def contains(self, pcap_file, backend, time=None):
+        return os.path.exists(self.entry_path(pcap_file, backend, time))
+
+    # Returns the cached (proto, length, payload, packet_number) list or None if the file has not been cached
+    def get(self, pcap_file, backend, time=None):
+        path = self.entry_path(pcap_file, backend, time)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                protos = entry['protos'].tolist()
+                proto_codes = entry['proto_codes'].tolist()
+                numbers = entry['numbers'].tolist()
+                offsets = entry['offsets'].tolist()
+                payloads = entry['payloads'].tobytes()
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            return None # Missing or corrupted entry (e.g. a write was interrupted), extract again
+
+        os.utime(path) # Mark as recently used
+        packets = []
+        for i, number in enumerate(numbers):
+            payload = payloads[offsets[i]:offsets[i + 1]].decode('latin-1')
+            packets.append((protos[proto_codes[i]], len(payload), payload, number))
+        return packets
+
+    def put(self, pcap_file, backend, time, packets):
+        protos = {}
+        proto_codes = np.empty(len(packets), dtype=np.uint32)
+        numbers = np.empty(len(packets), dtype=np.uint64)
+        offsets = np.empty(len(packets) + 1, dtype=np.uint64)
+        blob = bytearray()
+        for i, (proto, length, payload, number) in enumerate(packets):
+            proto_codes[i] = protos.setdefault(proto, len(protos))
+            numbers[i] = int(number)
+            offsets[i] = len(blob)
+            blob += payload.encode('latin-1')
+        offsets[len(packets)] = len(blob)
+
+        path = self.entry_path(pcap_file, backend, time)
+        self._write(path, protos=np.array(list(protos), dtype=str), proto_codes=proto_codes, numbers=numbers, offsets=offsets, payloads=np.frombuffer(bytes(blob), dtype=np.uint8))
+        self.evict()
+
+    # Record offset index of a pcap file (see utils.pcap_reader.build_record_index), used for subsetting pcap files
+    def index_path(self, pcap_file):
+        return os.path.join(self.cache_dir, f"{self.file_hash(pcap_file)}-index-v{CACHE_FORMAT_VERSION}.npz")
+
+    def get_index(self, pcap_file):
+        path = self.index_path(pcap_file)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                index = RecordIndex(entry['numbers'], entry['offsets'], entry['sizes'])
+        except (FileNotFoundError, ValueError, KeyError, OSError):
+            return None
+
+        os.utime(path)
+        return index
+
+    def put_index(self, pcap_file, index):
+        self._write(self.index_path(pcap_file), numbers=index.numbers, offsets=index.offsets, sizes=index.sizes)
+        self.evict()
+
+    def _write(self, path, **arrays):
+        # Write to a temporary file first so that concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    # Remove the least recently used entries until the cache fits into max_size
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -0,0 +1,495 @@
+import mmap
+import struct
+from collections import namedtuple
+import numpy as np
+
+# Minimal pcap/pcapng reader used as a tshark free extraction backend. Records are read straight from a memory mapped file
+# and only the link, network and transport headers are decoded. The payload is whatever follows the TCP/UDP header,
+# which is the same byte range tshark exposes as tcp.payload/udp.payload.
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002 # Obsolete packet block, still written by some old tools
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW_OLD = 12
+LINKTYPE_RAW_OLD_ALT = 14
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113 # tcpdump -i any (older libpcap)
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276 # tcpdump -i any (libpcap >= 1.10)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_ARP = 0x0806
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = frozenset((0x8100, 0x88a8, 0x9100))
+
+# A single captured frame. offset and size point to the whole record (record header included) inside the file so that
+# the record can be copied to another file without re-encoding it. The file header and pcapng blocks that do not contain
+# packets are reported with number 0 by the internal iterators, they are needed when a subset of the file is written.
+PcapRecord = namedtuple('PcapRecord', ['number', 'timestamp', 'linktype', 'offset', 'size', 'data'])
+
+# Well known ports and the protocol name tshark gives to the highest layer for them. Only used when the payload itself
+# does not identify the protocol (see classify_payload).
+TCP_PORTS = {
+    53: 'DNS',
+    389: 'LDAP',
+    1883: 'MQTT',
+    2181: 'ZOOKEEPER',
+    3306: 'MYSQL',
+    5432: 'PGSQL',
+    5672: 'AMQP',
+    6379: 'RESP',
+    9042: 'CQL',
+    9092: 'KAFKA',
+    11211: 'MEMCACHE',
+    27017: 'MONGO',
+}
+
+UDP_PORTS = {
+    53: 'DNS',
+    67: 'DHCP',
+    68: 'DHCP',
+    123: 'NTP',
+    137: 'NBNS',
+    161: 'SNMP',
+    443: 'QUIC',
+    1900: 'SSDP',
+    4789: 'VXLAN',
+    5353: 'MDNS',
+    8472: 'VXLAN',
+}
+
+IP_PROTOCOLS = {
+    1: 'ICMP',
+    2: 'IGMP',
+    47: 'GRE',
+    50: 'ESP',
+    58: 'ICMPV6',
+    89: 'OSPF',
+    112: 'VRRP',
+    132: 'SCTP',
+}
+
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+
+HTTP_PREFIXES = (b'GET ', b'POST ', b'PUT ', b'HEAD ', b'DELETE ', b'PATCH ', b'OPTIONS ', b'CONNECT ', b'HTTP/1.')
+HTTP2_PREFACE = b'PRI * HTTP/2.0'
+
+# Highest layer tshark reports for an HTTP body, by Content-Type. Types that are not listed are 'MEDIA', and text types
+# that are not listed are line based text.
+HTTP_MEDIA_TYPES = {
+    'application/json': 'JSON',
+    'application/xml': 'XML',
+    'text/xml': 'XML',
+    'application/x-www-form-urlencoded': 'URLENCODED-FORM',
+}
+
+# HTTP messages that are split over several TCP segments, see decode_packet. Older entries are dropped when there are
+# more, so lost segments can not make the pending messages grow without a limit.
+MAX_PENDING_HTTP_MESSAGES = 4096
+
+def _open(pcap_file):
+    with open(pcap_file, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            return b''
+
+def _iter_pcap(buf, include_data=True):
+    magic_le = struct.unpack_from('<I', buf, 0)[0]
+    if magic_le in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+        endian = '<'
+    else:
+        endian = '>'
+    magic = struct.unpack_from(endian + 'I', buf, 0)[0]
+    divisor = 1e9 if magic == PCAP_MAGIC_NSEC else 1e6
+    linktype = struct.unpack_from(endian + 'I', buf, 20)[0] & 0x0fffffff
+    record_header = struct.Struct(endian + 'IIII')
+
+    yield PcapRecord(0, 0.0, linktype, 0, 24, None)
+
+    offset = 24
+    number = 1
+    end = len(buf)
+    while offset + 16 <= end:
+        ts_sec, ts_frac, incl_len, _ = record_header.unpack_from(buf, offset)
+        data_start = offset + 16
+        data_end = data_start + incl_len
+        if data_end > end:
+            break # Truncated capture, tcpdump was killed in the middle of a write
+        yield PcapRecord(number, ts_sec + ts_frac / divisor, linktype, offset, 16 + incl_len, buf[data_start:data_end] if include_data else None)
+        offset = data_end
+        number += 1
+
+def _iter_pcapng(buf, include_data=True):
+    end = len(buf)
+    offset = 0
+    number = 1
+    endian = '<'
+    interfaces = [] # (linktype, ticks per second)
+    while offset + 12 <= end:
+        block_type = struct.unpack_from(endian + 'I', buf, offset)[0]
+        if block_type == PCAPNG_SHB:
+            byte_order = struct.unpack_from('<I', buf, offset + 8)[0]
+            endian = '<' if byte_order == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            interfaces = [] # Interfaces are scoped to a section
+        block_length = struct.unpack_from(endian + 'I', buf, offset + 4)[0]
+        if block_length < 12 or offset + block_length > end:
+            break
+
+        if block_type == PCAPNG_IDB:
+            linktype = struct.unpack_from(endian + 'H', buf, offset + 8)[0]
+            interfaces.append((linktype, _pcapng_ticks_per_second(buf, offset, block_length, endian)))
+        elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+            if block_type == PCAPNG_EPB:
+                interface_id, ts_high, ts_low, captured_len = struct.unpack_from(endian + 'IIII', buf, offset + 8)
+            else:
+                interface_id, _, ts_high, ts_low, captured_len = struct.unpack_from(endian + 'HHIII', buf, offset + 8)
+            linktype, ticks = interfaces[interface_id]
+            data_start = offset + 28
+            timestamp = ((ts_high << 32) | ts_low) / ticks
+            yield PcapRecord(number, timestamp, linktype, offset, block_length, buf[data_start:data_start + captured_len] if include_data else None)
+            number += 1
+            offset += block_length
+            continue
+        elif block_type == PCAPNG_SPB:
+            linktype, _ = interfaces[0]
+            original_len = struct.unpack_from(endian + 'I', buf, offset + 8)[0]
+            captured_len = min(original_len, block_length - 16)
+            data_start = offset + 12
+            yield PcapRecord(number, 0.0, linktype, offset, block_length, buf[data_start:data_start + captured_len] if include_data else None)
+            number += 1
+            offset += block_length
+            continue
+
+        yield PcapRecord(0, 0.0, None, offset, block_length, None)
+        offset += block_length
+
+def _pcapng_ticks_per_second(buf, offset, block_length, endian):
+    # Walk the IDB options looking for if_tsresol (code 9). Defaults to microseconds.
+    option_offset = offset + 16
+    options_end = offset + block_length - 4
+    while option_offset + 4 <= options_end:
+        code, length = struct.unpack_from(endian + 'HH', buf, option_offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            tsresol = buf[option_offset + 4]
+            return 2 ** (tsresol & 0x7f) if tsresol & 0x80 else 10 ** tsresol
+        option_offset += 4 + ((length + 3) & ~3)
+    return 10 ** 6
+
+def is_pcapng(pcap_file):
+    with open(pcap_file, 'rb') as f:
+        header = f.read(4)
+    return len(header) == 4 and struct.unpack('<I', header)[0] == PCAPNG_SHB
+
+def _iter_all(pcap_file, include_data):
+    buf = _open(pcap_file)
+    if len(buf) < 24:
+        return
+    try:
+        if struct.unpack_from('<I', buf, 0)[0] == PCAPNG_SHB:
+            yield from _iter_pcapng(buf, include_data=include_data)
+        else:
+            yield from _iter_pcap(buf, include_data=include_data)
+    finally:
+        if isinstance(buf, mmap.mmap):
+            buf.close()
+
+# Iterate over all the records in a pcap or pcapng file. Frame numbers start from 1, the same as tshark's frame.number.
+def iter_records(pcap_file):
+    for record in _iter_all(pcap_file, include_data=True):
+        if record.number:
+            yield record
+
+# Incremental parser for a pcap or pcapng byte stream that is still being written, e.g. the output of tcpdump -w - or a
+# capture file that is growing. Data is fed in arbitrary chunks and the complete records are returned as soon as they
+# are available. Only the incomplete tail of the stream and the headers that are needed to decode the following records
+# (the pcap file header, or the section header and interface blocks of the current pcapng section) are kept in memory.
+# The offsets of the returned records are positions in the whole stream.
+class PcapStream:
+    def __init__(self):
+        self.pending = bytearray()
+        self.preamble = b''
+        self.pcapng = None
+        self.endian = '<'
+        self.position = 0 # Stream offset of the first pending byte
+        self.packets = 0
+
+    def feed(self, data):
+        self.pending += data
+        if self.pcapng is None:
+            if len(self.pending) < 24:
+                return []
+            self.pcapng = struct.unpack_from('<I', self.pending, 0)[0] == PCAPNG_SHB
+            if not self.pcapng:
+                self.preamble = bytes(self.pending[:24])
+                del self.pending[:24]
+                self.position = 24
+
+        # The iterators need the headers in front of the records to know the link type and byte order
+        preamble_size = len(self.preamble)
+        buf = self.preamble + bytes(self.pending)
+        preamble = self.preamble
+        consumed = preamble_size
+        records = []
+        for record in (_iter_pcapng(buf) if self.pcapng else _iter_pcap(buf)):
+            if record.offset < preamble_size:
+                continue
+            consumed = record.offset + record.size
+            offset = self.position + record.offset - preamble_size
+            if record.number:
+                self.packets += 1
+                records.append(record._replace(number=self.packets, offset=offset))
+                continue
+
+            block_type = struct.unpack_from(self.endian + 'I', buf, record.offset)[0]
+            if block_type == PCAPNG_SHB:
+                self.endian = '<' if struct.unpack_from('<I', buf, record.offset + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+                preamble = buf[record.offset:consumed] # A new section starts, the previous interfaces are not needed anymore
+            elif block_type == PCAPNG_IDB:
+                preamble += buf[record.offset:consumed]
+
+        self.preamble = preamble
+        del self.pending[:consumed - preamble_size]
+        self.position += consumed - preamble_size
+        return records
+
+# Offsets of every record in a pcap file: the packet number (0 for the file header and non-packet pcapng blocks), the byte offset and the size of the record.
+RecordIndex = namedtuple('RecordIndex', ['numbers', 'offsets', 'sizes'])
+
+def build_record_index(pcap_file):
+    numbers, offsets, sizes = [], [], []
+    for record in _iter_all(pcap_file, include_data=False):
+        numbers.append(record.number)
+        offsets.append(record.offset)
+        sizes.append(record.size)
+    return RecordIndex(np.array(numbers, dtype=np.uint64), np.array(offsets, dtype=np.uint64), np.array(sizes, dtype=np.uint64))
+
+# Write the packets with the given numbers from input_file to output_file. The records are copied as is, without
+# dissecting them, and the output has the same format (pcap or pcapng) as the input. If a record index of the input is
+# given, only the needed byte ranges are read from the input.
+def subset_pcap(input_file, output_file, packet_numbers, index=None):
+    wanted = np.unique(np.array([int(n) for n in packet_numbers if int(n) > 0], dtype=np.uint64))
+    last_wanted = int(wanted[-1]) if len(wanted) else 0
+
+    with open(output_file, 'wb') as out:
+        if index is not None:
+            selected = (index.numbers == 0) | np.isin(index.numbers, wanted)
+            # Stop after the last wanted packet, the same as the streaming path below
+            stop = np.flatnonzero(index.numbers > last_wanted)
+            if len(stop):
+                selected[stop[0]:] = False
+            with open(input_file, 'rb') as src:
+                for offset, size in zip(index.offsets[selected].tolist(), index.sizes[selected].tolist()):
+                    src.seek(offset)
+                    out.write(src.read(size))
+            return
+
+        buf = _open(input_file)
+        if len(buf) < 24:
+            return
+        wanted = set(wanted.tolist())
+        try:
+            records = _iter_pcapng(buf, include_data=False) if struct.unpack_from('<I', buf, 0)[0] == PCAPNG_SHB else _iter_pcap(buf, include_data=False)
+            for record in records:
+                if record.number > last_wanted:
+                    break
+                if record.number == 0 or record.number in wanted:
+                    out.write(buf[record.offset:record.offset + record.size])
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+# Returns (ethertype, network layer bytes) for the given link layer frame. Ethertype is None if the frame is not understood.
+def _strip_link_layer(linktype, data):
+    if linktype == LINKTYPE_ETHERNET:
+        if len(data) < 14:
+            return None, b''
+        ethertype = struct.unpack_from('!H', data, 12)[0]
+        offset = 14
+        while ethertype in ETHERTYPE_VLAN and len(data) >= offset + 4:
+            ethertype = struct.unpack_from('!H', data, offset + 2)[0]
+            offset += 4
+        return ethertype, data[offset:]
+    if linktype == LINKTYPE_LINUX_SLL:
+        if len(data) < 16:
+            return None, b''
+        return struct.unpack_from('!H', data, 14)[0], data[16:]
+    if linktype == LINKTYPE_LINUX_SLL2:
+        if len(data) < 20:
+            return None, b''
+        return struct.unpack_from('!H', data, 0)[0], data[20:]
+    if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        if len(data) < 4:
+            return None, b''
+        family = struct.unpack_from('!I' if linktype == LINKTYPE_LOOP else '=I', data, 0)[0]
+        return (ETHERTYPE_IPV4 if family == 2 else ETHERTYPE_IPV6), data[4:]
+    if linktype in (LINKTYPE_RAW, LINKTYPE_RAW_OLD, LINKTYPE_RAW_OLD_ALT, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        if not data:
+            return None, b''
+        return (ETHERTYPE_IPV4 if data[0] >> 4 == 4 else ETHERTYPE_IPV6), data
+    return None, b''
+
+# Highest layer name of an HTTP body with the given Content-Type header value
+def http_media_layer(content_type):
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    if not media_type:
+        return 'DATA'
+    if media_type in HTTP_MEDIA_TYPES:
+        return HTTP_MEDIA_TYPES[media_type]
+    if media_type.endswith('+json'):
+        return 'JSON'
+    if media_type.endswith('+xml'):
+        return 'XML'
+    if media_type.startswith('text/'):
+        return 'DATA-TEXT-LINES'
+    return 'MEDIA'
+
+# Classify a TCP payload that starts an HTTP/1.x message. Returns (proto, missing) where missing is the number of bytes
+# of the message that are not in this payload, or None if the message length is not known from its headers. tshark
+# dissects the body too, so a message with a body is named after the body type (JSON, DATA-TEXT-LINES, ...).
+def classify_http(payload):
+    header_end = payload.find(b'\r\n\r\n')
+    if header_end < 0:
+        return 'HTTP', None
+    headers = {}
+    for line in payload[:header_end].split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip().decode('latin-1')
+    body_length = len(payload) - header_end - 4
+    if 'chunked' in headers.get(b'transfer-encoding', '').lower():
+        return (http_media_layer(headers.get(b'content-type', '')) if body_length else 'HTTP'), None
+    try:
+        content_length = int(headers[b'content-length'])
+    except (KeyError, ValueError):
+        content_length = body_length
+    if not content_length:
+        return 'HTTP', 0
+    return http_media_layer(headers.get(b'content-type', '')), max(content_length - body_length, 0)
+
+# Guess the name of the protocol carried in a TCP/UDP payload. Mirrors the highest layer names tshark uses for the
+# protocols that are common in Kubernetes traffic. Anything not recognized is 'DATA', which is also what tshark reports
+# for payloads it has no dissector for.
+def classify_payload(transport, src_port, dst_port, payload):
+    if transport == 'TCP':
+        if payload.startswith(HTTP2_PREFACE):
+            return 'HTTP2'
+        if payload.startswith(HTTP_PREFIXES):
+            return classify_http(payload)[0]
+        if len(payload) >= 5 and 20 <= payload[0] <= 24 and payload[1] == 3 and payload[2] <= 4:
+            return 'TLS'
+        ports = TCP_PORTS
+    else:
+        ports = UDP_PORTS
+    for port in (min(src_port, dst_port), max(src_port, dst_port)):
+        if port in ports:
+            if ports[port] == 'VXLAN' and len(payload) > 8:
+                # tshark dissects the encapsulated frame, the highest layer is the one of the inner frame
+                return decode_packet(LINKTYPE_ETHERNET, payload[8:])[0]
+            return ports[port]
+    return 'DATA'
+
+# Decode a single frame into (proto, payload). The payload is the raw TCP/UDP payload bytes, or b'' if there is none.
+# tshark reassembles HTTP messages that are split over several TCP segments: every segment but the last one is 'TCP' and
+# the last one is named after the whole message. Pass the same flows dict for all the frames of a capture to do the same,
+# it keeps the number of missing bytes of the unfinished messages per TCP flow.
+def decode_packet(linktype, data, flows=None):
+    ethertype, network = _strip_link_layer(linktype, data)
+    if ethertype == ETHERTYPE_ARP:
+        return 'ARP', b''
+
+    if ethertype == ETHERTYPE_IPV4:
+        if len(network) < 20:
+            return 'IP', b''
+        header_length = (network[0] & 0x0f) * 4
+        total_length, _, fragment, _, protocol = struct.unpack_from('!HHHBB', network, 2)
+        if total_length >= header_length:
+            network = network[:total_length] # Drop the ethernet trailer/padding
+        if fragment & 0x1fff:
+            return 'IP', b'' # Non-first fragment, there is no transport header to decode
+        transport = network[header_length:]
+        addresses = network[12:20]
+        network_proto = 'IP'
+    elif ethertype == ETHERTYPE_IPV6:
+        if len(network) < 40:
+            return 'IPV6', b''
+        payload_length = struct.unpack_from('!H', network, 4)[0]
+        protocol = network[6]
+        transport = network[40:40 + payload_length]
+        addresses = network[8:40]
+        while protocol in IPV6_EXTENSION_HEADERS and len(transport) >= 8:
+            protocol, length = transport[0], (transport[1] + 1) * 8
+            transport = transport[length:]
+        if protocol == 44:
+            return 'IPV6', b'' # Fragment header
+        network_proto = 'IPV6'
+    elif ethertype is None:
+        return 'DATA', b''
+    else:
+        return 'ETH', b''
+
+    if protocol == 6:
+        if len(transport) < 20:
+            return 'TCP', b''
+        src_port, dst_port = struct.unpack_from('!HH', transport, 0)
+        payload = transport[(transport[12] >> 4) * 4:]
+        if not payload:
+            return 'TCP', b''
+        if flows is None:
+            return classify_payload('TCP', src_port, dst_port, payload), payload
+        return _reassemble_http(flows, (addresses, src_port, dst_port), src_port, dst_port, payload), payload
+    if protocol == 17:
+        if len(transport) < 8:
+            return 'UDP', b''
+        src_port, dst_port, udp_length = struct.unpack_from('!HHH', transport, 0)
+        payload = transport[8:udp_length] if udp_length >= 8 else transport[8:]
+        if not payload:
+            return 'UDP', b''
+        return classify_payload('UDP', src_port, dst_port, payload), payload
+    return IP_PROTOCOLS.get(protocol, network_proto), b''
+
+def _reassemble_http(flows, flow, src_port, dst_port, payload):
+    if flow in flows:
+        missing, proto = flows.pop(flow)
+        if missing > len(payload):
+            flows[flow] = (missing - len(payload), proto)
+            return 'TCP'
+        return proto
+    if not payload.startswith(HTTP_PREFIXES):
+        return classify_payload('TCP', src_port, dst_port, payload)
+    proto, missing = classify_http(payload)
+    if not missing:
+        return proto
+    if len(flows) >= MAX_PENDING_HTTP_MESSAGES:
+        del flows[next(iter(flows))]
+    flows[flow] = (missing, proto)
+    return 'TCP'
+
+# Read a pcap file and return a list of (proto, payload bytes, packet_number) tuples. If time is given only the packets
+# captured within the first time seconds are returned, the same as the frame.time_relative display filter.
+def read_packets(pcap_file, time=None):
+    cutoff = float(time) if time else None
+    first_timestamp = None
+    packets = []
+    flows = {}
+    for record in iter_records(pcap_file):
+        if cutoff is not None:
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+            if record.timestamp - first_timestamp >= cutoff:
+                continue
+        proto, payload = decode_packet(record.linktype, record.data, flows)
+        packets.append((proto, payload, record.number))
+    return packets
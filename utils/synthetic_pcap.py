@@ -0,0 +1,158 @@
+import json
+import os
+import random
+import struct
+
+# Deterministic synthetic capture datasets, used for benchmarking the pipeline without the real dataset or a cluster.
+#
+# An application version is modelled as a set of message types. Every message type has a protocol, a payload and a few
+# dynamic positions (ids, counters, timestamps) that get a new value in every packet. A capture is a sequence of
+# packets that pick message types at random. The next version is derived from the previous one by changing
+# mutation_rate of its message types: either some bytes of the payload change, the payload grows, or the message type
+# is replaced by a new one. The same parameters and seed always produce byte for byte the same files.
+#
+# The files are written the way application_capture.py lays them out: <output_dir>/<app>-<timestamp>/<app>_<version>_<run>.pcap
+# together with a config.json, so the result can be used with fingerprint.py as is.
+
+DEFAULT_PROTO_MIX = {'HTTP': 0.3, 'TLS': 0.3, 'DNS': 0.1, 'DATA': 0.3}
+LENGTH_DISTRIBUTIONS = ['lognormal', 'uniform', 'fixed']
+DATASET_TIMESTAMP = '20240101000000'
+
+PCAP_HEADER = struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)
+ETHERNET_HEADER = bytes.fromhex('0242ac110002' '0242ac110003' '0800')
+
+# (transport, server port) of every protocol. The payload prefixes below make the raw backend (and tshark) detect them.
+PROTOCOL_PORTS = {
+    'HTTP': ('TCP', 80),
+    'TLS': ('TCP', 443),
+    'DNS': ('UDP', 53),
+    'DATA': ('TCP', 7000),
+}
+
+def version_names(count):
+    # fingerprint.choose_files matches versions by substring, so no name may be a substring of another one. The major
+    # version is zero padded to the same width for all the names: names of the same length are only substrings of each
+    # other when they are equal, and the '_' around the version in the file names can not be part of a match.
+    width = len(str(1 + (count - 1) // 3)) if count > 0 else 1
+    return [f"{1 + i // 3:0{width}d}.{i % 3}.0" for i in range(count)]
+
+def _payload_length(rng, length_distribution, mean_length, max_length):
+    if length_distribution == 'fixed':
+        length = mean_length
+    elif length_distribution == 'uniform':
+        length = rng.randint(1, 2 * mean_length)
+    else:
+        length = int(rng.lognormvariate(0, 1) * mean_length / 1.6487) # e^(1/2) is the mean of lognormvariate(0, 1)
+    return max(8, min(length, max_length))
+
+def _payload(rng, proto, length):
+    body = bytearray(rng.getrandbits(8) for _ in range(length))
+    if proto == 'HTTP':
+        prefix = b'GET /'
+    elif proto == 'TLS':
+        prefix = b'\x17\x03\x03' + struct.pack('!H', max(length - 5, 0))
+    elif proto == 'DATA':
+        prefix = b'\x00' # Not a known payload prefix
+    else:
+        prefix = b''
+    body[:len(prefix)] = prefix[:length]
+    return body, len(prefix)
+
+class MessageType:
+    def __init__(self, rng, proto, length, dynamic_rate):
+        self.proto = proto
+        self.payload, self.header_size = _payload(rng, proto, length)
+        self.dynamic = self._dynamic_positions(rng, dynamic_rate)
+        self.client = rng.randrange(2, 250)
+        self.weight = rng.paretovariate(1.5) # A few message types make up most of the traffic, like in real captures
+
+    def _dynamic_positions(self, rng, dynamic_rate):
+        positions = range(self.header_size, len(self.payload))
+        return sorted(rng.sample(positions, int(len(positions) * dynamic_rate)))
+
+    def mutate(self, rng, dynamic_rate):
+        mutated = MessageType.__new__(MessageType)
+        mutated.__dict__.update(self.__dict__)
+        mutated.payload = bytearray(self.payload)
+        if rng.random() < 0.5:
+            for position in rng.sample(range(self.header_size, len(self.payload)), max(1, (len(self.payload) - self.header_size) // 10)):
+                mutated.payload[position] = rng.getrandbits(8)
+        else:
+            mutated.payload += bytes(rng.getrandbits(8) for _ in range(rng.randint(1, 16)))
+            if self.proto == 'TLS':
+                mutated.payload[3:5] = struct.pack('!H', len(mutated.payload) - 5)
+            mutated.dynamic = mutated._dynamic_positions(rng, dynamic_rate)
+        return mutated
+
+    def packet(self, rng):
+        payload = bytearray(self.payload)
+        for position in self.dynamic:
+            payload[position] = rng.getrandbits(8)
+        return bytes(payload)
+
+def _frame(message_type, payload):
+    transport, port = PROTOCOL_PORTS[message_type.proto]
+    if transport == 'TCP':
+        transport_header = struct.pack('!HHIIBBHHH', 40000 + message_type.client, port, 0, 0, 0x50, 0x18, 65535, 0, 0)
+        protocol = 6
+    else:
+        transport_header = struct.pack('!HHHH', 40000 + message_type.client, port, 8 + len(payload), 0)
+        protocol = 17
+    ip_header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(transport_header) + len(payload), 0, 0x4000, 64, protocol, 0, bytes((10, 0, 0, message_type.client)), bytes((10, 0, 1, 1)))
+    return ETHERNET_HEADER + ip_header + transport_header + payload
+
+def generate_versions(versions, seed=0, message_types=50, proto_mix=DEFAULT_PROTO_MIX, length_distribution='lognormal', mean_length=200, max_length=1400, mutation_rate=0.1, dynamic_rate=0.05):
+    rng = random.Random(f"{seed}-versions")
+    protos = list(proto_mix)
+    weights = [proto_mix[p] for p in protos]
+
+    def new_message_type():
+        proto = rng.choices(protos, weights)[0]
+        return MessageType(rng, proto, _payload_length(rng, length_distribution, mean_length, max_length), dynamic_rate)
+
+    current = [new_message_type() for _ in range(message_types)]
+    models = {}
+    for version in versions:
+        if models:
+            changed = rng.sample(range(message_types), int(round(message_types * mutation_rate)))
+            current = list(current)
+            for i in changed:
+                current[i] = new_message_type() if rng.random() < 0.3 else current[i].mutate(rng, dynamic_rate)
+        models[version] = current
+    return models
+
+def write_capture(path, model, packets, seed, duration=60.0):
+    rng = random.Random(seed)
+    weights = [m.weight for m in model]
+    timestamp = 1704067200.0
+    with open(path, 'wb') as f:
+        f.write(PCAP_HEADER)
+        for message_type in rng.choices(model, weights, k=packets):
+            frame = _frame(message_type, message_type.packet(rng))
+            timestamp += rng.expovariate(packets / duration)
+            seconds = int(timestamp)
+            f.write(struct.pack('<IIII', seconds, int((timestamp - seconds) * 1e6), len(frame), len(frame)))
+            f.write(frame)
+
+# Write a dataset and return the application data folder
+def generate_dataset(output_dir, app_name='bench', versions=3, runs=10, packets=1000, seed=0, message_types=50, proto_mix=DEFAULT_PROTO_MIX, length_distribution='lognormal', mean_length=200, max_length=1400, mutation_rate=0.1, dynamic_rate=0.05, duration=60.0):
+    pcap_dir = os.path.join(output_dir, f"{app_name}-{DATASET_TIMESTAMP}")
+    os.makedirs(pcap_dir, exist_ok=True)
+
+    names = version_names(versions)
+    models = generate_versions(names, seed=seed, message_types=message_types, proto_mix=proto_mix, length_distribution=length_distribution, mean_length=mean_length, max_length=max_length, mutation_rate=mutation_rate, dynamic_rate=dynamic_rate)
+    for version in names:
+        for run in range(1, runs + 1):
+            write_capture(os.path.join(pcap_dir, f"{app_name}_{version}_{run}.pcap"), models[version], packets, seed=f"{seed}-{version}-{run}", duration=duration)
+
+    config = {
+        'name': app_name,
+        'reruns_default': runs,
+        'timeout': f"{int(duration)}s",
+        'url': 'synthetic',
+        'label': app_name,
+        'jobs': [{'version': version} for version in names],
+    }
+    with open(os.path.join(pcap_dir, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+    return pcap_dir
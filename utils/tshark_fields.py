@@ -0,0 +1,116 @@
+import binascii
+import shutil
+import subprocess
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Streaming tshark extraction backend. Instead of a JSON dissection tree that pyshark turns into Python objects, tshark
+# only prints the handful of fields the fingerprinting needs as tab separated text, which is parsed line by line.
+
+FIELDS = ['frame.number', 'frame.protocols', 'tcp.payload', 'udp.payload']
+
+# Dissectors that only add nested sub trees (certificates, ASN.1 etc.). They cost dissection time and show up in
+# frame.protocols, but pyshark never reports them as the highest layer because they are not top level layers in the
+# JSON output. Disabling them makes tshark faster and keeps frame.protocols in line with pyshark's highest_layer.
+DISABLED_PROTOCOLS = [
+    'ber',
+    'cms',
+    'ocsp',
+    'pkcs1',
+    'pkix1explicit',
+    'pkix1implicit',
+    'x509af',
+    'x509ce',
+    'x509if',
+    'x509sat',
+]
+
+NESTED_PROTOCOLS = frozenset(DISABLED_PROTOCOLS)
+
+def tshark_command(pcap_file, time=None):
+    tshark = shutil.which('tshark')
+    if not tshark:
+        raise FileNotFoundError('tshark was not found in PATH. Install tshark or use the raw extraction backend.')
+
+    command = [tshark, '-n', '-r', pcap_file, '-T', 'fields', '-E', 'occurrence=f', '-E', 'quote=n']
+    for field in FIELDS:
+        command += ['-e', field]
+    for protocol in DISABLED_PROTOCOLS:
+        command += ['--disable-protocol', protocol]
+    if time:
+        command += ['-Y', f"frame.time_relative < {time}"]
+    return command
+
+def highest_layer(protocols):
+    layers = protocols.split(':')
+    for layer in reversed(layers):
+        if layer not in NESTED_PROTOCOLS:
+            return layer.upper()
+    return layers[-1].upper()
+
+def decode_payload(hex_payload):
+    # Older tshark versions print bytes fields with ':' separators, newer ones without
+    return binascii.unhexlify(hex_payload.replace(':', '')).decode('latin-1', errors='ignore')
+
+# Parse one line of tshark output into a (proto, length, payload, packet_number) tuple, the same as extract_packet
+def parse_line(line):
+    number, protocols, tcp_payload, udp_payload = line.rstrip('\r\n').split('\t')
+    payload = ''
+    if tcp_payload:
+        payload = decode_payload(tcp_payload)
+    if udp_payload:
+        payload = decode_payload(udp_payload)
+    return highest_layer(protocols), len(payload), payload, int(number)
+
+# Stream the packets of a pcap file through a single tshark process. Packets are yielded as soon as tshark prints them.
+# stderr goes to a temporary file: a pipe that is only read at the end blocks tshark once it fills up with warnings
+# (e.g. on a corrupt or truncated capture) while stdout is still being read.
+def stream_packets(pcap_file, time=None):
+    with tempfile.TemporaryFile(mode='w+') as stderr_file:
+        process = subprocess.Popen(tshark_command(pcap_file, time=time), stdout=subprocess.PIPE, stderr=stderr_file, text=True, bufsize=1 << 16)
+        try:
+            for line in process.stdout:
+                if line.strip():
+                    yield parse_line(line)
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+            if returncode != 0:
+                stderr_file.seek(0)
+                raise Exception(f"tshark failed on {pcap_file} with error: {stderr_file.read()}")
+
+def read_packets(pcap_file, time=None):
+    return list(stream_packets(pcap_file, time=time))
+
+# Long lived extraction worker that processes a list of pcap files. While the caller consumes the packets of one file,
+# the next files are already being dissected in the background so that the tshark start up cost is hidden.
+class TsharkFieldsExtractor:
+    def __init__(self, prefetch=2):
+        self.prefetch = max(1, prefetch)
+        self.executor = ThreadPoolExecutor(max_workers=self.prefetch)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    # Yields (pcap_file, packets) tuples in the same order as pcap_files
+    def extract_many(self, pcap_files, time=None):
+        pending = deque()
+        files = iter(pcap_files)
+        for pcap_file in files:
+            pending.append((pcap_file, self.executor.submit(read_packets, pcap_file, time)))
+            if len(pending) >= self.prefetch:
+                break
+
+        while pending:
+            pcap_file, future = pending.popleft()
+            next_file = next(files, None)
+            if next_file is not None:
+                pending.append((next_file, self.executor.submit(read_packets, next_file, time)))
+            yield pcap_file, future.result()